@@ -0,0 +1,556 @@
+"""
+storage and document store backends shared by the services
+
+By default Cloud Storage and Firestore are used. With STORAGE_BACKEND=local and DOCUMENT_STORE_BACKEND=sqlite the
+services run on one machine without network, blobs are stored in LOCAL_STORAGE_DIR and documents in the SQLite
+database SQLITE_PATH. The local implementations provide the subset of the google client interfaces the services use.
+"""
+from typing import Callable, Dict, Optional
+import base64
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from pathlib import Path
+
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'gcs')
+DOCUMENT_STORE_BACKEND = os.getenv('DOCUMENT_STORE_BACKEND', 'firestore')
+LOCAL_STORAGE_DIR = Path(os.getenv('LOCAL_STORAGE_DIR', '/tmp/kita-menu/storage'))
+SQLITE_PATH = Path(os.getenv('SQLITE_PATH', '/tmp/kita-menu/documents.sqlite3'))
+# Local uploads are pushed as Pub/Sub style storage notification to this url, e.g. the local menu recognizer
+LOCAL_NOTIFICATION_URL = os.getenv('LOCAL_NOTIFICATION_URL')
+# Document read by warm_up_document_store, it is never written
+WARM_UP_COLLECTION = u'warm-up'
+WARM_UP_DOCUMENT = u'connect'
+
+
+def storage_client():
+    """
+    creates the configured storage client
+
+    Returns
+    -------
+    google.cloud.storage.Client or LocalStorageClient
+        storage client
+    """
+    if STORAGE_BACKEND == 'local':
+        return LocalStorageClient(LOCAL_STORAGE_DIR, LOCAL_NOTIFICATION_URL)
+    from google.cloud import storage
+    return storage.Client()
+
+def document_store():
+    """
+    creates the configured document store
+
+    Returns
+    -------
+    google.cloud.firestore.Client or SqliteDocumentStore
+        document store
+    """
+    if DOCUMENT_STORE_BACKEND == 'sqlite':
+        return SqliteDocumentStore(SQLITE_PATH)
+    from google.cloud import firestore
+    return firestore.Client()
+
+def warm_up_document_store(db):
+    """
+    connects a document store client by reading a document which doesn't exist, so the Firestore client fetches its
+    credentials and opens the gRPC channel before the first request needs them. The read is billed like any other, but
+    only once per instance start. SQLite connections belong to their thread, so there is nothing to warm up.
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client or SqliteDocumentStore
+        document store
+    """
+    if isinstance(db, SqliteDocumentStore):
+        return
+    db.collection(WARM_UP_COLLECTION).document(WARM_UP_DOCUMENT).get()
+
+def start_upload(blob, content_type: str = None):
+    """
+    starts an upload of a blob, whose data is written to the upload while it arrives. The blob is only created by
+    finish(), an aborted upload leaves no blob behind.
+
+    Parameters
+    ----------
+    blob : google.cloud.storage.Blob or LocalBlob
+        blob to upload to, cloud storage blobs are uploaded in chunks of their chunk_size
+    content_type : str, optional
+        content type of the blob
+
+    Returns
+    -------
+    ResumableUpload or LocalUpload
+        upload with write, finish and abort
+    """
+    if isinstance(blob, LocalBlob):
+        return LocalUpload(blob)
+    return ResumableUpload(blob.create_resumable_upload_session(content_type=content_type), blob.chunk_size)
+
+
+def transactional(func: Callable) -> Callable:
+    """
+    decorator like firestore.transactional, which works with transactions of both document stores
+
+    Parameters
+    ----------
+    func : Callable
+        function taking the transaction as first argument
+
+    Returns
+    -------
+    Callable
+        decorated function
+    """
+    @functools.wraps(func)
+    def wrapper(transaction, *args, **kwargs):
+        if isinstance(transaction, SqliteTransaction):
+            with transaction:
+                return func(transaction, *args, **kwargs)
+        from google.cloud import firestore
+        return firestore.transactional(func)(transaction, *args, **kwargs)
+    return wrapper
+
+
+class ResumableUpload:
+    """
+    resumable upload to cloud storage, which sends the written data in chunks and creates the object on finish
+
+    Parameters
+    ----------
+    session_url : str
+        url of the resumable upload session, it authorizes the upload, so no credentials are needed
+    chunk_size : int
+        bytes per request, a multiple of 256 KiB
+    """
+
+    def __init__(self, session_url: str, chunk_size: int):
+        self.session_url = session_url
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        # Only the last chunk may be smaller, so at most one chunk is held in memory
+        while len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def finish(self):
+        self._put(bytes(self._buffer), self._offset + len(self._buffer))
+        self._buffer.clear()
+
+    def abort(self):
+        try:
+            urllib.request.urlopen(urllib.request.Request(self.session_url, method='DELETE')).close()
+        except urllib.error.HTTPError as e:
+            # Cloud storage answers a cancelled upload with 499
+            e.close()
+
+    def _put(self, chunk: bytes, total_size: int = None):
+        total = '*' if total_size is None else total_size
+        content_range = f'bytes {self._offset}-{self._offset + len(chunk) - 1}/{total}' if chunk else f'bytes */{total}'
+        request = urllib.request.Request(self.session_url, data=chunk, method='PUT',
+                                         headers={'Content-Range': content_range})
+        try:
+            urllib.request.urlopen(request).close()
+        except urllib.error.HTTPError as e:
+            e.close()
+            # 308 confirms the chunks of an unfinished upload with the range of the bytes persisted so far
+            if e.code != 308:
+                raise
+            persisted = int(e.headers['Range'].rsplit('-', 1)[1]) + 1 if e.headers.get('Range') else 0
+            if persisted != self._offset + len(chunk):
+                raise IOError(f'cloud storage persisted {persisted} of {self._offset + len(chunk)} bytes') from e
+        self._offset += len(chunk)
+
+
+class LocalBlob:
+    """
+    blob stored as file in a local directory
+    """
+
+    def __init__(self, bucket, name: str, chunk_size: int = None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.md5_hash = None
+        self.crc32c = None
+        self.generation = None
+        self.size = None
+
+    @property
+    def path(self) -> Path:
+        return self.bucket.path / self.name
+
+    def reload(self):
+        data = self.path.read_bytes()
+        self._set_metadata(data)
+
+    def _set_metadata(self, data: bytes):
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        # crc32 instead of crc32c, which isn't in the standard library, is good enough to detect changes
+        self.crc32c = base64.b64encode(zlib.crc32(data).to_bytes(4, 'big')).decode()
+        self.generation = str(self.path.stat().st_mtime_ns)
+        self.size = len(data)
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def download_as_bytes(self, start: int = None, end: int = None) -> bytes:
+        data = self.path.read_bytes()
+        if start is not None or end is not None:
+            data = data[start or 0:None if end is None else end + 1]
+        return data
+
+    def upload_from_file(self, file_obj, rewind: bool = False, content_type: str = None):
+        if rewind:
+            file_obj.seek(0)
+        self.upload_from_string(file_obj.read(), content_type)
+
+    def upload_from_string(self, data: bytes, content_type: str = None):
+        upload = LocalUpload(self)
+        upload.write(data)
+        upload.finish()
+
+    def delete(self):
+        self.path.unlink()
+
+
+class LocalUpload:
+    """
+    upload of a local blob, which like an upload to cloud storage only exists once the upload is finished
+    """
+
+    def __init__(self, blob: LocalBlob):
+        self.blob = blob
+        blob.path.parent.mkdir(parents=True, exist_ok=True)
+        # Concurrent uploads of the same name are written to different files, the last finished one wins
+        self._tmp_path = blob.path.with_name(f'{blob.path.name}.{uuid.uuid4().hex}.part')
+        self._file = self._tmp_path.open('wb')
+
+    def write(self, data: bytes) -> int:
+        return self._file.write(data)
+
+    def finish(self):
+        self._file.close()
+        self._tmp_path.replace(self.blob.path)
+        self.blob._set_metadata(self.blob.path.read_bytes())
+        self.blob.bucket.client.notify(self.blob)
+
+    def abort(self):
+        self._file.close()
+        self._tmp_path.unlink()
+
+
+class LocalBucket:
+    """
+    bucket stored as local directory
+    """
+
+    def __init__(self, client, name: str):
+        self.client = client
+        self.name = name
+
+    @property
+    def path(self) -> Path:
+        return self.client.root / self.name
+
+    def blob(self, name: str, chunk_size: int = None) -> LocalBlob:
+        return LocalBlob(self, name, chunk_size)
+
+    def get_blob(self, name: str) -> Optional[LocalBlob]:
+        blob = self.blob(name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+    def list_blobs(self, prefix: str = ''):
+        for path in sorted(self.path.rglob('*')):
+            name = path.relative_to(self.path).as_posix()
+            if path.is_file() and not name.endswith('.part') and name.startswith(prefix):
+                yield self.get_blob(name)
+
+
+class LocalStorageClient:
+    """
+    storage client working on a local directory
+    """
+
+    def __init__(self, root: Path, notification_url: str = None):
+        self.root = Path(root)
+        self.notification_url = notification_url
+
+    def bucket(self, name: str) -> LocalBucket:
+        return LocalBucket(self, name)
+
+    def list_blobs(self, bucket_name: str, prefix: str = ''):
+        return self.bucket(bucket_name).list_blobs(prefix)
+
+    def notify(self, blob: LocalBlob):
+        """
+        pushes a storage notification of an uploaded blob in the background, like Cloud Storage does through Pub/Sub
+        """
+        if not self.notification_url:
+            return
+        data = {
+            'bucket': blob.bucket.name,
+            'name': blob.name,
+            'generation': blob.generation,
+            'md5Hash': blob.md5_hash,
+            'crc32c': blob.crc32c,
+            'size': str(blob.size)
+        }
+        envelope = {
+            'message': {
+                'data': base64.b64encode(json.dumps(data).encode()).decode(),
+                'messageId': '{:s}-{:s}'.format(blob.name, blob.generation)
+            }
+        }
+        request = urllib.request.Request(
+            self.notification_url, data=json.dumps(envelope).encode(), headers={'Content-Type': 'application/json'})
+
+        def push():
+            try:
+                urllib.request.urlopen(request).close()
+            except Exception as e:
+                logging.exception(e)
+        threading.Thread(target=push, daemon=True).start()
+
+
+class SqliteDocumentSnapshot:
+    """
+    snapshot of a document like firestore's DocumentSnapshot
+    """
+
+    def __init__(self, reference, data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[dict]:
+        return self._data
+
+
+def _dumps(data: dict) -> str:
+    # Datetimes are kept apart from strings, so they are read back as datetimes like firestore timestamps
+    def encode(value):
+        if isinstance(value, datetime.datetime):
+            return {'__datetime__': value.isoformat()}
+        raise TypeError(f'{type(value).__name__} can\'t be stored')
+    return json.dumps(data, default=encode)
+
+def _loads(data: str) -> dict:
+    def decode(obj: dict):
+        if obj.keys() == {'__datetime__'}:
+            return datetime.datetime.fromisoformat(obj['__datetime__'])
+        return obj
+    return json.loads(data, object_hook=decode)
+
+
+class SqliteWatch:
+    """
+    in process snapshot listener of a document
+    """
+
+    def __init__(self, store, key, callback):
+        self.store = store
+        self.key = key
+        self.callback = callback
+
+    def unsubscribe(self):
+        self.store.remove_listener(self)
+
+
+class SqliteDocumentReference:
+    """
+    reference to a document like firestore's DocumentReference
+    """
+
+    def __init__(self, store, collection: str, document_id: str):
+        self.store = store
+        self.collection = collection
+        self.id = document_id
+
+    def get(self, transaction=None) -> SqliteDocumentSnapshot:
+        row = self.store.connection().execute(
+            'SELECT data FROM documents WHERE collection = ? AND id = ?', (self.collection, self.id)).fetchone()
+        return SqliteDocumentSnapshot(self, _loads(row[0]) if row else None)
+
+    def set(self, data: dict):
+        batch = self.store.batch()
+        batch.set(self, data)
+        batch.commit()
+
+    def create(self, data: dict):
+        """
+        creates the document
+
+        Raises
+        ------
+        sqlite3.IntegrityError
+            if the document already exists
+        """
+        self.store.connection().execute(
+            'INSERT INTO documents (collection, id, data) VALUES (?, ?, ?)',
+            (self.collection, self.id, _dumps(data)))
+        self.store.notify([self])
+
+    def delete(self):
+        self.store.connection().execute(
+            'DELETE FROM documents WHERE collection = ? AND id = ?', (self.collection, self.id))
+        self.store.notify([self])
+
+    def on_snapshot(self, callback) -> SqliteWatch:
+        """
+        calls callback with the current snapshot and after every write of this process
+        """
+        return self.store.add_listener(self, callback)
+
+
+class SqliteCollection:
+    """
+    collection of documents like firestore's CollectionReference
+    """
+
+    def __init__(self, store, name: str):
+        self.store = store
+        self.id = name
+
+    def document(self, document_id: str) -> SqliteDocumentReference:
+        return SqliteDocumentReference(self.store, self.id, document_id)
+
+    def stream(self):
+        rows = self.store.connection().execute('SELECT id, data FROM documents WHERE collection = ?', (self.id,))
+        for document_id, data in rows.fetchall():
+            yield SqliteDocumentSnapshot(self.document(document_id), _loads(data))
+
+
+class SqliteWriteBatch:
+    """
+    writes several documents atomically like firestore's WriteBatch
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._writes = []
+
+    def set(self, reference: SqliteDocumentReference, data: dict):
+        self._writes.append((reference, data))
+
+    def commit(self):
+        connection = self.store.connection()
+        in_transaction = connection.in_transaction
+        if not in_transaction:
+            connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)',
+                [(ref.collection, ref.id, _dumps(data)) for ref, data in self._writes])
+            if not in_transaction:
+                connection.execute('COMMIT')
+        except Exception:
+            if not in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        if not in_transaction:
+            self.store.notify([ref for ref, _ in self._writes])
+
+
+class SqliteTransaction(SqliteWriteBatch):
+    """
+    read-write transaction, the writes are committed when the transactional function returns
+    """
+
+    def __enter__(self):
+        self.store.connection().execute('BEGIN IMMEDIATE')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = self.store.connection()
+        if exc_type is not None:
+            connection.execute('ROLLBACK')
+            return False
+        try:
+            super().commit()
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self.store.notify([ref for ref, _ in self._writes])
+        return False
+
+
+class SqliteDocumentStore:
+    """
+    document store in a SQLite database, providing the subset of firestore.Client used by the services
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._listeners: Dict[tuple, list] = {}
+        self._listeners_lock = threading.Lock()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS documents (collection TEXT, id TEXT, data TEXT, PRIMARY KEY (collection, id))')
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        returns the connection of the current thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(str(self.path), isolation_level=None, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def collection(self, name: str) -> SqliteCollection:
+        return SqliteCollection(self, name)
+
+    def batch(self) -> SqliteWriteBatch:
+        return SqliteWriteBatch(self)
+
+    def transaction(self) -> SqliteTransaction:
+        return SqliteTransaction(self)
+
+    def add_listener(self, reference: SqliteDocumentReference, callback) -> SqliteWatch:
+        watch = SqliteWatch(self, (reference.collection, reference.id), callback)
+        with self._listeners_lock:
+            self._listeners.setdefault(watch.key, []).append(watch)
+        callback([reference.get()], [], time.time())
+        return watch
+
+    def remove_listener(self, watch: SqliteWatch):
+        with self._listeners_lock:
+            watches = self._listeners.get(watch.key, [])
+            if watch in watches:
+                watches.remove(watch)
+
+    def notify(self, references):
+        for reference in references:
+            with self._listeners_lock:
+                watches = list(self._listeners.get((reference.collection, reference.id), []))
+            if watches:
+                snapshot = reference.get()
+                for watch in watches:
+                    watch.callback([snapshot], [], time.time())
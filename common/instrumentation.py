@@ -0,0 +1,290 @@
+"""
+timing and event metrics shared by the services
+
+With METRICS_ENABLED=1 the durations of the instrumented stages are recorded in the histogram
+kita_menu_stage_seconds{stage=...}, events like cache hits are counted in kita_menu_<event>_total and current
+values like the messages in flight of the pull worker are kept in the gauges kita_menu_<name>. They are exposed for
+Prometheus on the /metrics endpoint added by add_metrics_endpoint, or by start_metrics_server for processes without a
+web app. With TRACING_ENABLED=1 every stage also opens an OpenTelemetry span, if the opentelemetry api is installed
+and configured.
+
+Disabled instrumentation costs next to nothing: timed returns the undecorated function, stage a shared no-op context
+manager and count returns immediately, and prometheus_client isn't even imported.
+
+The metrics are kept in the registry of this module, so they can be read in process, e.g.
+
+    registry().get_sample_value('kita_menu_stage_seconds_count', {'stage': 'extract_text'})
+
+Only the registry of the serving process is exposed, so functions run in a process pool record their metrics with
+run_recorded and return them together with their result, which replay records in the serving process, e.g.
+
+    instrumentation.replay(pool.submit(instrumentation.run_recorded, process_image, bucket, name, lang).result())
+"""
+from typing import Any, Callable, List, Tuple
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0') == '1'
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', '0') == '1'
+METRICS_PREFIX = 'kita_menu'
+# Buckets in seconds from a cached lookup up to the OCR of a large page
+STAGE_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = None
+_stage_seconds = None
+_counters = {}
+_gauges = {}
+_tracer = None
+_lock = threading.Lock()
+_noop = contextlib.nullcontext()
+# Metrics of the call run_recorded is running in this pool process, None outside of it
+_recorded = None
+
+
+def registry():
+    """
+    returns the registry of the metrics, created on first use
+
+    Returns
+    -------
+    prometheus_client.CollectorRegistry
+        registry with the stage histogram and the event counters
+    """
+    global _registry, _stage_seconds, _tracer
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                import prometheus_client
+                if TRACING_ENABLED:
+                    try:
+                        from opentelemetry import trace
+                        _tracer = trace.get_tracer(__name__)
+                    except ImportError:
+                        logging.warning('TRACING_ENABLED is set, but opentelemetry is not installed')
+                new_registry = prometheus_client.CollectorRegistry()
+                _stage_seconds = prometheus_client.Histogram(
+                    f'{METRICS_PREFIX}_stage_seconds', 'duration of instrumented stages', ['stage'],
+                    buckets=STAGE_BUCKETS, registry=new_registry)
+                _registry = new_registry
+    return _registry
+
+def observe(name: str, seconds: float):
+    """
+    records the duration of a stage, which has been measured elsewhere
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    seconds : float
+        duration
+    """
+    if METRICS_ENABLED:
+        _observe(name, seconds)
+
+def _observe(name: str, seconds: float):
+    if _recorded is not None:
+        _recorded.append(('observe', name, seconds))
+        return
+    registry()
+    _stage_seconds.labels(name).observe(seconds)
+
+@contextlib.contextmanager
+def _stage(name: str):
+    registry()
+    span = _tracer.start_as_current_span(name) if _tracer is not None else _noop
+    start = time.perf_counter()
+    try:
+        with span:
+            yield
+    finally:
+        _observe(name, time.perf_counter() - start)
+
+def stage(name: str):
+    """
+    context manager measuring the duration of a stage and opening a span for it
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+
+    Returns
+    -------
+    ContextManager
+        context manager of the stage
+    """
+    if not METRICS_ENABLED:
+        return _noop
+    return _stage(name)
+
+def timed(name: str) -> Callable:
+    """
+    decorator measuring every call of a function as stage
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+
+    Returns
+    -------
+    Callable
+        decorator, which returns the function itself if the metrics are disabled
+    """
+    def decorator(func: Callable) -> Callable:
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(event: str, amount: float = 1):
+    """
+    increments the counter of an event
+
+    Parameters
+    ----------
+    event : str
+        name of the event, e.g. 'menu_cache_hits'
+    amount : float, optional
+        increment, by default 1
+    """
+    if not METRICS_ENABLED:
+        return
+    if _recorded is not None:
+        _recorded.append(('count', event, amount))
+        return
+    counter = _counters.get(event)
+    if counter is None:
+        import prometheus_client
+        event_registry = registry()
+        with _lock:
+            counter = _counters.get(event)
+            if counter is None:
+                counter = prometheus_client.Counter(
+                    f'{METRICS_PREFIX}_{event}', event.replace('_', ' '), registry=event_registry)
+                _counters[event] = counter
+    counter.inc(amount)
+
+def gauge(name: str, value: float):
+    """
+    sets the gauge of a current value
+
+    Parameters
+    ----------
+    name : str
+        name of the value, e.g. 'worker_in_flight'
+    value : float
+        current value
+    """
+    if not METRICS_ENABLED:
+        return
+    if _recorded is not None:
+        _recorded.append(('gauge', name, value))
+        return
+    metric = _gauges.get(name)
+    if metric is None:
+        import prometheus_client
+        gauge_registry = registry()
+        with _lock:
+            metric = _gauges.get(name)
+            if metric is None:
+                metric = prometheus_client.Gauge(
+                    f'{METRICS_PREFIX}_{name}', name.replace('_', ' '), registry=gauge_registry)
+                _gauges[name] = metric
+    metric.set(value)
+
+def run_recorded(func: Callable, *args, **kwargs) -> Tuple[Any, List[tuple]]:
+    """
+    calls a function in a process of a pool and records its metrics instead of adding them to the registry of the
+    process, which is never exposed. A pool process runs one call at a time, so the metrics of all threads of the
+    process belong to it. The metrics of a call which raises are lost.
+
+    Parameters
+    ----------
+    func : Callable
+        function to call with the remaining arguments
+
+    Returns
+    -------
+    Tuple[Any, List[tuple]]
+        result of the function and its metrics for replay
+    """
+    global _recorded
+    if not METRICS_ENABLED:
+        return func(*args, **kwargs), []
+    _recorded = []
+    try:
+        result = func(*args, **kwargs)
+        return result, _recorded
+    finally:
+        _recorded = None
+
+def replay(recorded_result: Tuple[Any, List[tuple]]) -> Any:
+    """
+    records the metrics returned by run_recorded in this process
+
+    Parameters
+    ----------
+    recorded_result : Tuple[Any, List[tuple]]
+        result of run_recorded
+
+    Returns
+    -------
+    Any
+        result of the function run_recorded called
+    """
+    result, metrics = recorded_result
+    for kind, name, value in metrics:
+        if kind == 'observe':
+            observe(name, value)
+        elif kind == 'gauge':
+            gauge(name, value)
+        else:
+            count(name, value)
+    return result
+
+def add_metrics_endpoint(app, path: str = '/metrics'):
+    """
+    adds the endpoint for Prometheus to a flask app, if the metrics are enabled
+
+    Parameters
+    ----------
+    app : flask.Flask
+        app to add the endpoint to
+    path : str, optional
+        path of the endpoint, by default '/metrics'
+    """
+    if not METRICS_ENABLED:
+        return
+
+    def metrics():
+        import prometheus_client
+        headers = {'Content-Type': prometheus_client.CONTENT_TYPE_LATEST}
+        return prometheus_client.generate_latest(registry()), 200, headers
+    app.add_url_rule(path, 'metrics', metrics, methods=['GET'])
+
+def start_metrics_server(port: int):
+    """
+    serves the metrics for Prometheus on a port in a background thread, if the metrics are enabled, for processes
+    without a flask app like the pull worker
+
+    Parameters
+    ----------
+    port : int
+        port of the metrics endpoint
+    """
+    if not METRICS_ENABLED:
+        return
+    import prometheus_client
+    prometheus_client.start_http_server(port, registry=registry())
@@ -0,0 +1,162 @@
+"""
+Kitas shared by several users
+
+All parents of a Kita get the same menu, so users can join a Kita instead of uploading the menu themselves. The menu
+and progress documents of a Kita are stored under the id of the Kita instead of the user id, e.g. menus/kita-<token>,
+and uploads of members are named after the Kita. The recognizer thereby recognizes a menu once per Kita and writes it
+once, without knowing about Kitas. The services resolve the owner of the menu of a user with the MembershipIndex.
+"""
+from typing import Optional
+from collections import OrderedDict, namedtuple
+import datetime
+import secrets
+import threading
+import time
+
+
+KITA_ID_PREFIX = 'kita-'
+
+Membership = namedtuple('Membership', ['kita_id', 'kita_name'])
+
+
+def create_kita(db, name: str, user_id: str) -> str:
+    """
+    creates a Kita with an empty menu and makes the user its first member
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client or backends.SqliteDocumentStore
+        document store
+    name : str
+        name of the Kita
+    user_id : str
+        amazon user id of the creator
+
+    Returns
+    -------
+    str
+        id of the Kita, which other users need to join it
+    """
+    kita_id = KITA_ID_PREFIX + secrets.token_urlsafe(8)
+    batch = db.batch()
+    batch.set(db.collection(u'kitas').document(kita_id), {
+        'name': name,
+        'created_by': user_id,
+        'created_at': time.time()
+    })
+    batch.set(db.collection(u'menus').document(kita_id), {
+        'cw': datetime.date.today().isocalendar()[1],
+        'menu': {},
+        'weeks': {}
+    })
+    batch.set(db.collection(u'memberships').document(user_id), {'kita': kita_id, 'name': name})
+    batch.commit()
+    return kita_id
+
+def join_kita(db, kita_id: str, user_id: str) -> Optional[Membership]:
+    """
+    makes a user member of a Kita, a previous membership is replaced
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client or backends.SqliteDocumentStore
+        document store
+    kita_id : str
+        id of the Kita
+    user_id : str
+        amazon user id
+
+    Returns
+    -------
+    Optional[Membership]
+        new membership, None if there is no Kita with the id
+    """
+    if not kita_id.startswith(KITA_ID_PREFIX) or '/' in kita_id:
+        return None
+    kita = db.collection(u'kitas').document(kita_id).get().to_dict()
+    if kita is None:
+        return None
+    # The name is stored with the membership, so resolving a membership needs a single read
+    db.collection(u'memberships').document(user_id).set({'kita': kita_id, 'name': kita['name']})
+    return Membership(kita_id, kita['name'])
+
+def leave_kita(db, user_id: str):
+    """
+    ends the membership of a user, who gets the own menu again
+
+    Parameters
+    ----------
+    db : google.cloud.firestore.Client or backends.SqliteDocumentStore
+        document store
+    user_id : str
+        amazon user id
+    """
+    db.collection(u'memberships').document(user_id).delete()
+
+
+class MembershipIndex:
+    """
+    read-through cache of the memberships keyed by user id, bounded in size with LRU and TTL eviction. Changes of other
+    instances are picked up after the TTL.
+    """
+
+    def __init__(self, db, max_size: int = 1024, ttl: float = 600, collection: str = u'memberships'):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.collection = collection
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[Membership]:
+        """
+        returns the membership of a user
+
+        Parameters
+        ----------
+        user_id : str
+            amazon user id
+
+        Returns
+        -------
+        Optional[Membership]
+            membership or None if the user isn't member of a Kita
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] >= time.time():
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        doc = self.db.collection(self.collection).document(user_id).get().to_dict()
+        membership = Membership(doc['kita'], doc.get('name')) if doc is not None else None
+        with self._lock:
+            self._entries[user_id] = (time.time() + self.ttl, membership)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return membership
+
+    def menu_owner(self, user_id: str) -> str:
+        """
+        returns the id under which the menu of a user is stored
+
+        Parameters
+        ----------
+        user_id : str
+            amazon user id
+
+        Returns
+        -------
+        str
+            id of the Kita of the user or the user id itself
+        """
+        membership = self.get(user_id)
+        return membership.kita_id if membership is not None else user_id
+
+    def invalidate(self, user_id: str):
+        """
+        removes the cached membership of a user, e.g. after joining or leaving a Kita
+        """
+        with self._lock:
+            self._entries.pop(user_id, None)
@@ -0,0 +1,44 @@
+"""helpers for the menu documents shared by the services"""
+from typing import Dict, Optional
+import datetime
+
+
+def week_key(date: datetime.date) -> str:
+    """
+    returns the key of the iso week of a date, under which its menu is stored
+
+    Parameters
+    ----------
+    date : datetime.date
+        any day of the week
+
+    Returns
+    -------
+    str
+        iso year and week, e.g. '2020-W12'
+    """
+    year, week = date.isocalendar()[:2]
+    return '{:d}-W{:02d}'.format(year, week)
+
+def get_week_menu(menu_doc: dict, date: datetime.date) -> Optional[Dict[str, str]]:
+    """
+    returns the menu of the week of a date from a menu document
+
+    Parameters
+    ----------
+    menu_doc : dict
+        menu document with the menus by week key, documents written before multi-week support only have the
+        calendar week 'cw' and its 'menu'
+    date : datetime.date
+        any day of the week
+
+    Returns
+    -------
+    Optional[Dict[str, str]]
+        dictionary with weekdays as keys and the food as values, None if there is no menu for the week
+    """
+    if 'weeks' in menu_doc:
+        return menu_doc['weeks'].get(week_key(date))
+    if menu_doc.get('cw') == date.isocalendar()[1]:
+        return menu_doc['menu']
+    return None
@@ -0,0 +1,127 @@
+"""
+speech responses of the skill, which are precomputed by the recognizer when a menu is written
+
+A menu is written once but read on every invocation, so the recognizer stores the ready to speak responses of each
+week in the menu document under 'responses', keyed by week key and by weekday or 'week'. The skill only looks them up.
+"""
+from typing import Dict, List
+from collections import namedtuple
+import datetime
+
+from menus import get_week_menu, week_key
+
+
+SpeechResponse = namedtuple('SpeechResponse', ['title', 'speech'])
+
+WEEKDAYS = ('Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag', 'Samstag', 'Sonntag')
+WEEKEND = ('Samstag', 'Sonntag')
+# Key of the response for the whole week
+WEEK = 'week'
+
+WEEKEND_RESPONSE = SpeechResponse('Wochenede', 'Für das Wochenende gibt es keinen Speiseplan.')
+NO_MENU_FOR_DAY = SpeechResponse(
+    'Kein Speiseplan für diese Woche vorhanden',
+    'Leider ist für diese Woche noch kein Speiseplan vorhanden. Lade einen neuen hoch, um ihn dir Ansagen lassen zu '
+    'können.')
+NO_MENU_FOR_WEEK = SpeechResponse(
+    'Kein Speiseplan für diese Woche vorhanden',
+    'Leider ist für diese Woche noch kein Speiseplan vorhanden. Lades Sie einen neuen hoch, um ihn dir Ansagen lassen '
+    'zu können.')
+USER_NOT_FOUND_FOR_DAY = SpeechResponse(
+    'Kita Speiseplan Fehler', 'Der angegebener Benutzer wurde leider nicht gefunden.')
+USER_NOT_FOUND_FOR_WEEK = SpeechResponse(
+    'Kita Speiseplan Fehler',
+    'Der angegebener Benutzer wurde leider nicht gefunden. Loggen Sie sich bitte initial auf der Website ein.')
+
+
+def day_response(menu: Dict[str, str], day: str) -> SpeechResponse:
+    """
+    formats the response for the food of one day
+
+    Parameters
+    ----------
+    menu : Dict[str, str]
+        menu of the week with weekdays as keys and the food as values
+    day : str
+        weekday
+
+    Returns
+    -------
+    SpeechResponse
+        card title and speech text
+    """
+    if day in WEEKEND:
+        return WEEKEND_RESPONSE
+    food = menu.get(day)
+    if not food:
+        return SpeechResponse('Kein Essen eingetragen', f'Für {day} ist im Speiseplan kein Essen eingetragen.')
+    return SpeechResponse(f'Das Essen für heute ist {food}', f'{day} gibt es: {food}.')
+
+def week_response(menu: Dict[str, str]) -> SpeechResponse:
+    """
+    formats the response for the food of the whole week
+
+    Parameters
+    ----------
+    menu : Dict[str, str]
+        menu of the week with weekdays as keys and the food as values
+
+    Returns
+    -------
+    SpeechResponse
+        card title and speech text
+    """
+    parts = ['Am {:s} gibt es {:s}'.format(day, food) for day, food in menu.items()]
+    return SpeechResponse('Das Essen für diese Woche', '\n'.join(parts))
+
+def build_responses(weeks: Dict[str, Dict[str, str]]) -> Dict[str, Dict[str, List[str]]]:
+    """
+    precomputes the responses of all weeks of a menu document
+
+    Parameters
+    ----------
+    weeks : Dict[str, Dict[str, str]]
+        menus by week key
+
+    Returns
+    -------
+    Dict[str, Dict[str, List[str]]]
+        title and speech text by week key and by weekday or WEEK
+    """
+    responses = {}
+    for key, menu in weeks.items():
+        if not menu:
+            continue
+        week = {day: list(day_response(menu, day)) for day in WEEKDAYS}
+        week[WEEK] = list(week_response(menu))
+        responses[key] = week
+    return responses
+
+def get_response(menu_doc: dict, date: datetime.date, day: str = WEEK) -> SpeechResponse:
+    """
+    looks up the response for a day or the week of a date
+
+    Parameters
+    ----------
+    menu_doc : dict
+        menu document of the user
+    date : datetime.date
+        requested day or any day of the requested week
+    day : str, optional
+        weekday of the date, by default WEEK for the response of the whole week
+
+    Returns
+    -------
+    SpeechResponse
+        card title and speech text
+    """
+    no_menu = NO_MENU_FOR_WEEK if day == WEEK else NO_MENU_FOR_DAY
+    if 'responses' in menu_doc:
+        week = menu_doc['responses'].get(week_key(date))
+        return SpeechResponse(*week[day]) if week is not None else no_menu
+
+    # Documents written before the responses were precomputed
+    menu = get_week_menu(menu_doc, date)
+    if not menu:
+        return no_menu
+    return week_response(menu) if day == WEEK else day_response(menu, day)
@@ -0,0 +1,341 @@
+"""
+recognition of many menu images in one run, e.g. to reprocess the whole corpus after an improvement of the recognizer
+
+The images are downloaded by a pool of threads while a pool of processes recognizes the downloaded ones, so downloads
+overlap with OCR and at most as many images as download threads are held in memory. Cached menus of an unchanged
+pipeline are neither downloaded nor recognized. Each image is claimed like a notification claims its object, so a
+batch never overwrites the menu of a newer upload, which a notification has finished meanwhile. The menus are written
+with batched commits and a status is reported per image, e.g.
+
+    python batch.py --bucket kita-menu-images --prefix '' --processes 4 --output report.json
+
+The same batch can be started with a POST of {"bucket": ..., "prefix": ...} or {"bucket": ..., "names": [...]} to the
+/batch endpoint of main.py. It runs in the background with BATCH_ENDPOINT_PROCESSES processes, one batch at a time per
+instance, and its report, which is kept in the document store, is polled from /batch/<id> of any instance.
+"""
+from typing import Iterable, List, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+import backends
+import instrumentation
+from recognizer import get_storage_client, init_recognition_process, recognize_image
+from notifications import (PRELOAD_LANGUAGES, SKIPPED, ObjectInProcessing, claim_object, db, menu_cache,
+                           release_object, set_menu)
+from cache import cache_key
+
+
+BATCH_PROCESSES = int(os.getenv('BATCH_PROCESSES', os.cpu_count() or 1))
+# Downloads running concurrently, more than processes keeps the processes busy while images are downloaded
+BATCH_DOWNLOADS = int(os.getenv('BATCH_DOWNLOADS', 2 * BATCH_PROCESSES))
+# Images per commit, each adds two writes and a firestore batch holds at most 500
+BATCH_COMMIT_SIZE = int(os.getenv('BATCH_COMMIT_SIZE', 200))
+# Batches of the endpoint leave half of the cores to the notifications handled by the same instance
+BATCH_ENDPOINT_PROCESSES = int(os.getenv('BATCH_ENDPOINT_PROCESSES', max(1, (os.cpu_count() or 1) // 2)))
+# Seconds between the heartbeats of a running job, a job without heartbeat for three of them is reported as failed
+BATCH_JOB_HEARTBEAT = float(os.getenv('BATCH_JOB_HEARTBEAT', 60))
+# Items per document of a job's report, which stays far below the document size limit of 1 MiB
+BATCH_REPORT_CHUNK = int(os.getenv('BATCH_REPORT_CHUNK', 2000))
+
+
+class BatchWriter:
+    """
+    collects the menus of several images and commits them together, safe to use from several threads
+    """
+
+    def __init__(self, commit_size: int = BATCH_COMMIT_SIZE):
+        self.commit_size = commit_size
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, user_id: str, recognition: dict, object_version: str, item: dict):
+        """
+        adds the menu of a claimed image, item is the report of the image, whose status is set to 'failed' if the
+        commit fails and to 'skipped' if the claim was taken over by a newer upload meanwhile
+        """
+        with self._lock:
+            self._pending.append((user_id, recognition, object_version, item))
+            if len(self._pending) < self.commit_size:
+                return
+            pending, self._pending = self._pending, []
+        self._commit(pending)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            self._commit(pending)
+
+    @staticmethod
+    def _commit(pending):
+        try:
+            written = set_claimed_menus(db.transaction(), pending)
+        except Exception as e:
+            logging.exception(e)
+            for *_, item in pending:
+                item['status'] = 'failed'
+                item['error'] = 'commit failed: {}'.format(e)
+            return
+        for i, (*_, item) in enumerate(pending):
+            if i not in written:
+                item['status'] = 'skipped'
+                item['error'] = 'superseded by a newer upload'
+
+
+@backends.transactional
+def set_claimed_menus(transaction, pending) -> set:
+    """
+    writes the menus of the images whose claim is still held, the others were claimed by a notification of a newer
+    upload after the batch had claimed them
+
+    Parameters
+    ----------
+    transaction : google.cloud.firestore.Transaction or backends.SqliteTransaction
+        transaction to run in
+    pending : list
+        user id, recognition, version and report of each image
+
+    Returns
+    -------
+    set
+        indices of the images whose menus were written
+    """
+    refs = [db.collection(u'progress').document(user_id) for user_id, *_ in pending]
+    # Transactions read all documents before their first write
+    snapshots = [ref.get(transaction=transaction) for ref in refs]
+    written = set()
+    for i, ((user_id, recognition, object_version, _), snapshot) in enumerate(zip(pending, snapshots)):
+        progress = snapshot.to_dict() if snapshot.exists else None
+        if not progress or progress.get('state') != 'processing' or progress.get('version') != object_version:
+            continue
+        # Batches always know the generation of the blob, which is the version
+        set_menu(transaction, user_id, recognition, object_version, int(object_version))
+        written.add(i)
+    return written
+
+
+def recognize_batch(bucket_name: str, names: Iterable[str] = None, prefix: str = '', lang: str = 'de',
+                    processes: int = BATCH_PROCESSES, downloads: int = BATCH_DOWNLOADS,
+                    commit_size: int = BATCH_COMMIT_SIZE, use_cache: bool = True) -> List[dict]:
+    """
+    recognizes the menus of many images and writes them like single notifications would
+
+    Parameters
+    ----------
+    bucket_name : str
+        name of the bucket
+    names : Iterable[str], optional
+        names of the images, all images with the prefix if not given
+    prefix : str, optional
+        prefix of the images if no names are given, by default all images of the bucket
+    lang : str, optional
+        language code of the menus, by default 'de'
+    processes : int, optional
+        number of recognition processes, by default BATCH_PROCESSES
+    downloads : int, optional
+        number of concurrent downloads, by default BATCH_DOWNLOADS
+    commit_size : int, optional
+        images per commit, by default BATCH_COMMIT_SIZE
+    use_cache : bool, optional
+        whether cached menus are used, by default True
+
+    Returns
+    -------
+    List[dict]
+        report per image with its 'name', 'status' ('recognized', 'cached', 'missing', 'skipped' if a newer upload of
+        the user is known, 'in_processing' if a notification is processing it or 'failed'), 'seconds' and 'error'
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    if names is None:
+        # Listed blobs come with their metadata, so no request per image is needed for the hashes
+        objects = list(bucket.list_blobs(prefix=prefix))
+    else:
+        objects = list(names)
+    writer = BatchWriter(commit_size)
+
+    def run(obj) -> dict:
+        start = time.perf_counter()
+        name = obj if isinstance(obj, str) else obj.name
+        item = {'name': name, 'status': None, 'seconds': None, 'error': None}
+        try:
+            blob = bucket.get_blob(name) if isinstance(obj, str) else obj
+            if blob is None:
+                item['status'] = 'missing'
+                return item
+            user_id, generation = Path(name).stem, int(blob.generation)
+            progress_doc_ref = db.collection(u'progress').document(user_id)
+            try:
+                if claim_object(db.transaction(), progress_doc_ref, str(generation), generation,
+                                reprocess=True) == SKIPPED:
+                    item['status'] = 'skipped'
+                    return item
+            except ObjectInProcessing as e:
+                item['status'] = 'in_processing'
+                item['error'] = str(e)
+                return item
+            # Composite objects have no md5 hash, like in notifications their crc32c is used then
+            content_hash = blob.md5_hash or blob.crc32c
+            key = cache_key(content_hash, lang) if content_hash else None
+            recognition = menu_cache.get(key) if key and use_cache else None
+            item['status'] = 'cached'
+            if recognition is None:
+                try:
+                    # The thread waits for its process, so the next download only starts with a free thread
+                    data = blob.download_as_bytes()
+                    recognition = instrumentation.replay(
+                        pool.submit(instrumentation.run_recorded, recognize_image, data, lang, name).result())
+                    del data
+                except Exception as e:
+                    release_object(progress_doc_ref, str(generation), generation, e)
+                    raise
+                if key:
+                    menu_cache.set(key, recognition)
+                item['status'] = 'recognized'
+            writer.add(user_id, recognition, str(generation), item)
+        except Exception as e:
+            logging.exception(e)
+            item['status'] = 'failed'
+            item['error'] = str(e)
+        finally:
+            item['seconds'] = time.perf_counter() - start
+        return item
+
+    # Forking a process with threads is unsafe, so the workers are spawned
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_recognition_process, initargs=(PRELOAD_LANGUAGES,)) as pool, \
+            ThreadPoolExecutor(downloads) as threads:
+        report = list(threads.map(run, objects))
+    writer.flush()
+    return report
+
+def summarize(report: List[dict]) -> dict:
+    """
+    counts the images of a batch report by status
+    """
+    summary = {}
+    for item in report:
+        summary[item['status']] = summary.get(item['status'], 0) + 1
+    return summary
+
+
+class BatchJobs:
+    """
+    batches started by the /batch endpoint, run one at a time per instance in a background thread, so the request
+    returns at once. The jobs are kept in the batch_jobs collection of the document store with their status
+    ('running', 'complete' or 'failed') and report, so any instance answers the polls and finished jobs outlive the
+    instance. A running job renews its heartbeat, a job whose instance stopped is reported as failed.
+    """
+
+    def __init__(self, processes: int = BATCH_ENDPOINT_PROCESSES, store=None,
+                 heartbeat: float = BATCH_JOB_HEARTBEAT):
+        self.processes = processes
+        self.store = store or db
+        self.heartbeat = heartbeat
+        self._running = None
+        self._lock = threading.Lock()
+
+    def start(self, bucket_name: str, names: Iterable[str] = None, prefix: str = '', lang: str = 'de',
+              use_cache: bool = True) -> Optional[str]:
+        """
+        starts a batch in the background, see recognize_batch for the parameters
+
+        Returns
+        -------
+        Optional[str]
+            id of the job or None if another batch is running on this instance
+        """
+        with self._lock:
+            if self._running is not None:
+                return None
+            job = {'id': uuid.uuid4().hex, 'status': 'running', 'seconds': None, 'summary': None, 'items': None,
+                   'error': None, 'heartbeat_at': time.time()}
+            self._job_ref(job['id']).set(job)
+            self._running = job['id']
+        threading.Thread(target=self._run, args=(job, bucket_name, names, prefix, lang, use_cache),
+                         name=f'batch-{job["id"]}', daemon=True).start()
+        return job['id']
+
+    def get(self, job_id: str) -> Optional[dict]:
+        snapshot = self._job_ref(job_id).get()
+        if not snapshot.exists:
+            return None
+        job = snapshot.to_dict()
+        if job['status'] == 'running' and job['heartbeat_at'] + 3 * self.heartbeat < time.time():
+            job.update(status='failed', error='the instance running the batch stopped')
+        elif job['status'] == 'complete':
+            # The report of large batches exceeds the size of a document, so it is stored in chunks
+            job['items'] = [item for idx in range(job.pop('item_chunks'))
+                            for item in self._items_ref(job_id, idx).get().to_dict()['items']]
+        job.pop('heartbeat_at')
+        return job
+
+    def _job_ref(self, job_id: str):
+        return self.store.collection(u'batch_jobs').document(job_id)
+
+    def _items_ref(self, job_id: str, idx: int):
+        return self.store.collection(u'batch_job_items').document(f'{job_id}-{idx}')
+
+    def _run(self, job: dict, bucket_name: str, names: Optional[Iterable[str]], prefix: str, lang: str,
+             use_cache: bool):
+        start = time.perf_counter()
+        done = threading.Event()
+
+        def beat():
+            while not done.wait(self.heartbeat):
+                self._job_ref(job['id']).set({**job, 'heartbeat_at': time.time()})
+        heartbeat = threading.Thread(target=beat, name=f'batch-{job["id"]}-heartbeat', daemon=True)
+        heartbeat.start()
+        try:
+            report = recognize_batch(bucket_name, names, prefix, lang, self.processes, 2 * self.processes,
+                                     use_cache=use_cache)
+            chunks = [report[idx:idx + BATCH_REPORT_CHUNK] for idx in range(0, len(report), BATCH_REPORT_CHUNK)]
+            for idx, items in enumerate(chunks):
+                self._items_ref(job['id'], idx).set({'items': items})
+            update = {'status': 'complete', 'summary': summarize(report), 'item_chunks': len(chunks)}
+        except Exception as e:
+            logging.exception(e)
+            update = {'status': 'failed', 'error': str(e)}
+        update['seconds'] = time.perf_counter() - start
+        # A heartbeat after the final write would report the job as running again
+        done.set()
+        heartbeat.join()
+        # The next batch may start once a poll sees this one finished
+        with self._lock:
+            self._running = None
+        self._job_ref(job['id']).set({**job, **update, 'heartbeat_at': time.time()})
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--prefix', default='', help='prefix of the images if no names are given')
+    parser.add_argument('names', nargs='*', help='names of the images, all images with the prefix if not given')
+    parser.add_argument('--lang', default='de')
+    parser.add_argument('--processes', type=int, default=BATCH_PROCESSES)
+    parser.add_argument('--downloads', type=int, default=BATCH_DOWNLOADS)
+    parser.add_argument('--commit-size', type=int, default=BATCH_COMMIT_SIZE)
+    parser.add_argument('--no-cache', action='store_true', help='recognize images even if their menu is cached')
+    parser.add_argument('--output', type=Path, help='file to write the JSON report to')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    batch_report = recognize_batch(
+        args.bucket, args.names or None, args.prefix, args.lang, args.processes, args.downloads, args.commit_size,
+        not args.no_cache)
+    output = json.dumps({
+        'seconds': time.perf_counter() - start,
+        'summary': summarize(batch_report),
+        'items': batch_report
+    }, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    print(output)
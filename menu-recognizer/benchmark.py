@@ -0,0 +1,305 @@
+"""
+benchmarks for the recognition pipeline
+
+The pipeline command runs every stage of recognizer.py over a local corpus of menu images, or over synthetic rendered
+menus if no corpus is given, and reports per stage latency percentiles, throughput and peak RSS as JSON, e.g.
+
+    python benchmark.py pipeline --corpus menus/ --workers 1 4 8 --ocr-modes adaptive accurate --output bench.json
+
+The conformance command checks that all tokenizer modes generate the same menus for the texts in fixtures/, including
+glued punctuation and OCR noise, and exits with a non-zero status otherwise. tests/test_tokenizer.py runs the same check
+for the installed modes.
+"""
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import json
+import math
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import recognizer
+
+
+SAMPLE_TEXT = '''Speiseplan
+Montag Nudeln mit Tomatensoße
+Dienstag Kartoffelsuppe mit Würstchen
+Mittwoch Reis mit Gemüse
+Donnerstag Fischstäbchen mit Kartoffelpüree
+Freitag Pfannkuchen mit Apfelmus
+'''
+
+SYNTHETIC_FOODS = (
+    'Nudeln mit Tomatensosse', 'Kartoffelsuppe', 'Reis mit Gemuese', 'Fischstaebchen', 'Pfannkuchen mit Apfelmus',
+    'Linseneintopf', 'Gemueselasagne', 'Milchreis mit Zimt', 'Spinat mit Ei', 'Hirsebratling'
+)
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+TOKENIZER_MODES = ('model', 'blank', 'regex')
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff'}
+
+
+def render_synthetic_menu(seed: int) -> bytes:
+    """
+    renders a weekly menu table with random food as png
+
+    Parameters
+    ----------
+    seed : int
+        seed of the food selection
+
+    Returns
+    -------
+    bytes
+        png encoded image
+    """
+    rng = random.Random(seed)
+    width, height = 2400, 1200
+    img = np.full((height, width), 255, dtype=np.uint8)
+    weekdays = recognizer.LANGUAGE_CODE_CONVERTER['de'].weekdays
+    col_width = (width - 200) // len(weekdays)
+    cv2.rectangle(img, (100, 100), (width - 100, height - 100), 0, 3)
+    cv2.line(img, (100, 250), (width - 100, 250), 0, 3)
+    for idx, day in enumerate(weekdays):
+        x = 100 + idx * col_width
+        cv2.line(img, (x, 100), (x, height - 100), 0, 3)
+        cv2.putText(img, day, (x + 20, 200), cv2.FONT_HERSHEY_SIMPLEX, 1.2, 0, 2)
+        for line, word in enumerate(rng.choice(SYNTHETIC_FOODS).split()):
+            cv2.putText(img, word, (x + 20, 330 + line * 60), cv2.FONT_HERSHEY_SIMPLEX, 1.2, 0, 2)
+    return cv2.imencode('.png', img)[1].tobytes()
+
+def load_corpus(corpus: Path = None, synthetic: int = 10) -> List[bytes]:
+    """
+    loads the encoded images of a corpus directory
+
+    Parameters
+    ----------
+    corpus : Path, optional
+        directory with menu images, synthetic menus are rendered if not given
+    synthetic : int, optional
+        number of synthetic menus, by default 10
+
+    Returns
+    -------
+    List[bytes]
+        encoded images
+    """
+    if corpus is None:
+        return [render_synthetic_menu(seed) for seed in range(synthetic)]
+    return [path.read_bytes() for path in sorted(corpus.iterdir()) if path.suffix.lower() in IMAGE_SUFFIXES]
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    returns the nearest-rank percentile of the values
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+def peak_rss_mib() -> float:
+    """
+    returns the peak resident set size of the process in MiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageTimer:
+    """
+    collects the durations and the peak RSS after each stage and counts events like the used OCR tiers, safe to use
+    from several threads
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.peak_rss = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def run(self, name: str, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        duration = time.perf_counter() - start
+        rss = peak_rss_mib()
+        with self._lock:
+            self.durations.setdefault(name, []).append(duration)
+            self.peak_rss[name] = max(self.peak_rss.get(name, 0), rss)
+        return result
+
+    def count(self, name: str):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                'count': len(durations),
+                'p50_ms': percentile(durations, 50) * 1000,
+                'p95_ms': percentile(durations, 95) * 1000,
+                'throughput_per_second': len(durations) / sum(durations) if sum(durations) else None,
+                'peak_rss_mib': self.peak_rss[name]
+            }
+            for name, durations in self.durations.items()
+        }
+
+def run_pipeline(data: bytes, lang: str, timer: StageTimer) -> Dict[str, str]:
+    """
+    runs all stages of the page recognition on one encoded image
+    """
+    img = timer.run('decode_image', recognizer.decode_image, data)
+    img, source, _ = timer.run('preprocess_image', recognizer.preprocess_page, img)
+    # The tiered OCR like in production, the share of pages each tier ends with is counted
+    text, tier = timer.run('extract_page_text', recognizer.extract_page_text, img, lang, source=source)
+    timer.count(tier)
+    # process_document filters itself, the filter is timed separately to see its share
+    timer.run('filter_raw_text', recognizer.filter_raw_text, text, recognizer.get_sequences_to_remove(lang))
+    words = timer.run('process_document', recognizer.process_document, text, lang)
+    return timer.run('generate_menu', recognizer.generate_menu, words, lang)
+
+def bench_pipeline(images: List[bytes], lang: str, workers: int) -> dict:
+    """
+    runs the pipeline over all images with the given number of worker threads, like gunicorn's threads
+
+    Parameters
+    ----------
+    images : List[bytes]
+        encoded images
+    lang : str
+        language code of the menus
+    workers : int
+        number of worker threads
+
+    Returns
+    -------
+    dict
+        report with wall time, throughput and per stage statistics
+    """
+    timer = StageTimer()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(lambda data: run_pipeline(data, lang, timer), images))
+    wall_seconds = time.perf_counter() - start
+    return {
+        'workers': workers,
+        'ocr_mode': recognizer.OCR_MODE,
+        'ocr_tiers': timer.counts,
+        'images': len(images),
+        'wall_seconds': wall_seconds,
+        'throughput_images_per_second': len(images) / wall_seconds,
+        'peak_rss_mib': peak_rss_mib(),
+        'stages': timer.report()
+    }
+
+def bench_process_document(text: str, lang: str, messages: int):
+    """
+    compares the per message latency of process_document with a cold spaCy load per message against the warm
+    pipeline registry
+
+    Parameters
+    ----------
+    text : str
+        document to process per message
+    lang : str
+        language code of the text
+    messages : int
+        number of simulated messages
+    """
+    import spacy
+    cold = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        nlp = spacy.load(recognizer.LANGUAGE_CODE_CONVERTER[lang].spacy)
+        nlp(recognizer.filter_raw_text(text, []))
+        cold.append(time.perf_counter() - start)
+
+    recognizer.preload_pipelines([lang])
+    warm = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        recognizer.process_document(text, lang)
+        warm.append(time.perf_counter() - start)
+
+    for name, timings in (('cold (spacy.load per message)', cold), ('warm (pipeline registry)', warm)):
+        print('{:s}: median {:.1f} ms, max {:.1f} ms'.format(
+            name, statistics.median(timings) * 1000, max(timings) * 1000))
+
+def check_tokenizer_conformance(texts: Dict[str, str], lang: str, modes=TOKENIZER_MODES) -> List[str]:
+    """
+    generates the menu of every text with each tokenizer mode and compares it to the menu of the first mode
+
+    Parameters
+    ----------
+    texts : Dict[str, str]
+        texts by name
+    lang : str
+        language code of the texts
+    modes : Iterable[str], optional
+        tokenizer modes to compare, by default TOKENIZER_MODES
+
+    Returns
+    -------
+    List[str]
+        descriptions of the differences, empty if all modes conform
+    """
+    differences = []
+    for name, text in texts.items():
+        menus = {mode: recognizer.generate_menu(recognizer.process_document(text, lang, mode), lang) for mode in modes}
+        reference_mode = modes[0]
+        for mode, menu in menus.items():
+            if menu != menus[reference_mode]:
+                differences.append('{:s}: {:s} {} != {:s} {}'.format(
+                    name, mode, menu, reference_mode, menus[reference_mode]))
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lang', default='de')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='per stage benchmark of the recognition pipeline')
+    pipeline_parser.add_argument('--corpus', type=Path, help='directory with menu images')
+    pipeline_parser.add_argument('--synthetic', type=int, default=10, help='number of synthetic menus')
+    pipeline_parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    pipeline_parser.add_argument('--ocr-modes', nargs='+', default=[recognizer.OCR_MODE],
+                                 choices=('adaptive', 'fast', 'accurate'), help='OCR modes to compare')
+    pipeline_parser.add_argument('--output', type=Path, help='file to write the JSON report to')
+
+    nlp_parser = subparsers.add_parser('nlp', help='cold against warm spaCy pipeline')
+    nlp_parser.add_argument('--messages', type=int, default=10)
+
+    conformance_parser = subparsers.add_parser('conformance', help='compare the menus of the tokenizer modes')
+    conformance_parser.add_argument('--modes', nargs='+', default=list(TOKENIZER_MODES), choices=TOKENIZER_MODES)
+
+    args = parser.parse_args()
+    if args.command == 'nlp':
+        bench_process_document(SAMPLE_TEXT, args.lang, args.messages)
+    elif args.command == 'conformance':
+        fixtures = {path.name: path.read_text(encoding='utf-8') for path in sorted(FIXTURES_DIR.glob('*.txt'))}
+        fixtures['sample'] = SAMPLE_TEXT
+        differences = check_tokenizer_conformance(fixtures, args.lang, args.modes)
+        for difference in differences:
+            print(difference)
+        print('{:d} of {:d} texts differ'.format(len({d.split(':')[0] for d in differences}), len(fixtures)))
+        sys.exit(1 if differences else 0)
+    else:
+        corpus_images = load_corpus(args.corpus, args.synthetic)
+        # Load the models up front, so the first images don't include the load time
+        recognizer.preload_pipelines([args.lang])
+        report = {
+            'pipeline_version': recognizer.PIPELINE_VERSION,
+            'runs': []
+        }
+        for ocr_mode in args.ocr_modes:
+            recognizer.OCR_MODE = ocr_mode
+            report['runs'].extend(bench_pipeline(corpus_images, args.lang, workers) for workers in args.workers)
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            args.output.write_text(output)
+        print(output)
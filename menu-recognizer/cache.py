@@ -0,0 +1,154 @@
+"""module with caches of recognized menus keyed by the content hash of the image"""
+from typing import Iterable, Optional
+from collections import OrderedDict
+import base64
+import datetime
+import threading
+import time
+
+from recognizer import OCR_MODE, PIPELINE_VERSION, RECOGNITION_MODE, TOKENIZER_MODE
+
+
+def cache_key(content_hash: str, lang: str) -> str:
+    """
+    generates the cache key of an image
+
+    Parameters
+    ----------
+    content_hash : str
+        base64 encoded md5 or crc32c hash of the image as given by cloud storage
+    lang : str
+        language code of the menu
+
+    Returns
+    -------
+    str
+        key which is also a valid firestore document id
+    """
+    # base64 may contain '/', which is not allowed in document ids
+    hex_hash = base64.b64decode(content_hash).hex()
+    # Every mode changing the recognized menu is part of the key, so instances with other modes don't share results
+    return f'{hex_hash}-{lang}-{PIPELINE_VERSION}-{RECOGNITION_MODE}-{OCR_MODE}-{TOKENIZER_MODE}'
+
+
+class MenuCache:
+    """
+    interface of menu caches
+    """
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        returns the cached menu
+
+        Parameters
+        ----------
+        key : str
+            cache key
+
+        Returns
+        -------
+        Optional[dict]
+            menu or None if there is no valid entry
+        """
+        raise NotImplementedError
+
+    def set(self, key: str, menu: dict):
+        """
+        caches a menu
+
+        Parameters
+        ----------
+        key : str
+            cache key
+        menu : dict
+            recognized menus as returned by process_image
+        """
+        raise NotImplementedError
+
+
+class LocalMenuCache(MenuCache):
+    """
+    thread safe in memory cache with LRU and TTL eviction
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, menu = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return menu
+
+    def set(self, key: str, menu: dict):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, menu)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class FirestoreMenuCache(MenuCache):
+    """
+    cache shared by all instances, stored in a firestore collection. The expiry of an entry is the timestamp
+    expires_at, so a firestore TTL policy on that field deletes the expired entries of the collection, e.g.
+
+        gcloud firestore fields ttls update expires_at --collection-group=menu_cache --enable-ttl
+
+    The policy deletes them within a day or so, expired entries which are looked up before are deleted by the lookup.
+    """
+
+    def __init__(self, db, ttl: float, collection: str = u'menu_cache'):
+        self.db = db
+        self.ttl = ttl
+        self.collection = collection
+
+    def get(self, key: str) -> Optional[dict]:
+        doc_ref = self.db.collection(self.collection).document(key)
+        doc = doc_ref.get().to_dict()
+        if doc is None:
+            return None
+        expires_at = doc['expires_at']
+        # Entries written before the expiry was a timestamp hold unix time, they are dropped like expired ones
+        if not isinstance(expires_at, datetime.datetime) or expires_at < datetime.datetime.now(datetime.timezone.utc):
+            # Another instance may have just renewed the entry, which only costs a recognition
+            doc_ref.delete()
+            return None
+        return doc['menu']
+
+    def set(self, key: str, menu: dict):
+        self.db.collection(self.collection).document(key).set({
+            'expires_at': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl),
+            'menu': menu
+        })
+
+
+class TieredMenuCache(MenuCache):
+    """
+    looks up the tiers in order and fills the faster tiers on a hit in a slower one
+    """
+
+    def __init__(self, tiers: Iterable[MenuCache]):
+        self.tiers = list(tiers)
+
+    def get(self, key: str) -> Optional[dict]:
+        for idx, tier in enumerate(self.tiers):
+            menu = tier.get(key)
+            if menu is not None:
+                for faster_tier in self.tiers[:idx]:
+                    faster_tier.set(key, menu)
+                return menu
+        return None
+
+    def set(self, key: str, menu: dict):
+        for tier in self.tiers:
+            tier.set(key, menu)
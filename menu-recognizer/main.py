@@ -1,18 +1,20 @@
 import base64
 import os
-import json
 import logging
-import datetime
-from pathlib import Path
 
-from flask import Flask, request
+from flask import Flask, request, jsonify, url_for
 
-from google.cloud import firestore
-
-from recognizer import process_image
+import instrumentation
+from recognizer import preload_pipelines
+from notifications import PRELOAD_LANGUAGES, ObjectInProcessing, decode_notification, handle_notification
+from batch import BatchJobs
 
 
 app = Flask(__name__)
+instrumentation.add_metrics_endpoint(app)
+
+preload_pipelines(PRELOAD_LANGUAGES)
+batch_jobs = BatchJobs()
 
 
 @app.route('/', methods=['POST'])
@@ -32,38 +34,21 @@ def index():
 
     if isinstance(pubsub_message, dict) and 'data' in pubsub_message:
         try:
-            data = json.loads(base64.b64decode(pubsub_message['data']).decode())
+            data = decode_notification(base64.b64decode(pubsub_message['data']))
         except Exception as e:
-            msg = 'Invalid Pub/Sub message: data property is not valid base64 encoded JSON'
+            msg = f'Invalid Cloud Storage notification: {e}'
             logging.exception(e)
             return f'Bad Request: {msg}', 400
 
-        # Validate the message is a Cloud Storage event.
-        if not data['name'] or not data['bucket']:
-            msg = 'Invalid Cloud Storage notification: expected name and bucket properties'
-            logging.error(msg)
-            return f'Bad Request: {msg}', 400
         try:
-            user_id = Path(data['name']).stem
-            db = firestore.Client()
-
-            progress_doc_ref = db.collection(u'progress').document(user_id)
-            progress_doc_ref.set({'state': 'processing'})
-
-            menu = process_image(data['bucket'], data['name'], 'de') # TODO make language configurable
-            cw = datetime.date.today().isocalendar()[1]
-
-            menu_doc_ref = db.collection(u'menus').document(user_id)
-            menu_doc_ref.set({
-                'cw': cw,
-                'menu': menu
-            })
-
-            progress_doc_ref = db.collection(u'progress').document(user_id)
-            progress_doc_ref.set({'state': 'complete'})
-
+            handle_notification(data, pubsub_message.get('messageId'))
             return ('', 204)
 
+        except ObjectInProcessing as e:
+            # Not acked, the attempt holding the lease may die without releasing it
+            logging.info('deferring %s: %s', data['name'], e)
+            return ('', 503, {'Retry-After': str(int(e.retry_after) + 1)})
+
         except Exception as e:
             logging.exception(e)
             return ('', 500)
@@ -71,6 +56,38 @@ def index():
     return ('', 500)
 
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    params = request.get_json()
+    if not isinstance(params, dict) or not params.get('bucket'):
+        msg = 'expected a JSON object with the bucket and the names or a prefix of the images'
+        logging.error(msg)
+        return f'Bad Request: {msg}', 400
+    names = params.get('names')
+    # A bare string would be iterated as names of one character each
+    if names is not None and not (isinstance(names, list) and all(isinstance(name, str) for name in names)):
+        msg = 'expected the names as a list of strings'
+        logging.error(msg)
+        return f'Bad Request: {msg}', 400
+
+    job_id = batch_jobs.start(
+        params['bucket'], names, params.get('prefix', ''), params.get('lang', 'de'),
+        use_cache=params.get('use_cache', True))
+    if job_id is None:
+        msg = 'another batch is running'
+        logging.error(msg)
+        return f'Conflict: {msg}', 409
+    return jsonify(id=job_id, status='running'), 202, {'Location': url_for('batch_status', job_id=job_id)}
+
+
+@app.route('/batch/<job_id>', methods=['GET'])
+def batch_status(job_id):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return ('', 404)
+    return jsonify(job)
+
+
 if __name__ == '__main__':
     PORT = int(os.getenv('PORT')) if os.getenv('PORT') else 8080
     app.run(host='127.0.0.1', port=PORT, debug=True)
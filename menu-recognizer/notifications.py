@@ -0,0 +1,273 @@
+"""
+handling of the Cloud Storage notifications of uploaded menus, shared by the push endpoint in main.py and the pull
+worker in worker.py
+"""
+from typing import Callable, Optional
+import datetime
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import backends
+import instrumentation
+from recognizer import process_image, assign_weeks
+from cache import cache_key, LocalMenuCache, FirestoreMenuCache, TieredMenuCache
+from speech import build_responses
+
+
+db = backends.document_store()
+
+MENU_CACHE_TTL = int(os.getenv('MENU_CACHE_TTL', 7 * 24 * 60 * 60))
+MENU_CACHE_SIZE = int(os.getenv('MENU_CACHE_SIZE', 128))
+menu_cache = TieredMenuCache([
+    LocalMenuCache(MENU_CACHE_SIZE, MENU_CACHE_TTL),
+    FirestoreMenuCache(db, MENU_CACHE_TTL)
+])
+
+# Seconds after which an object which is still in processing may be claimed again, e.g. after a crashed instance
+PROCESSING_LEASE = int(os.getenv('PROCESSING_LEASE', 10 * 60))
+
+# Comma separated list of languages whose spaCy pipelines are loaded on worker start
+PRELOAD_LANGUAGES = [lang for lang in os.getenv('PRELOAD_LANGUAGES', 'de').split(',') if lang]
+
+
+# Results of claim_object
+CLAIMED = 'claimed'
+# The object is already processed or a newer upload of the user is known, the message can be acked
+SKIPPED = 'skipped'
+# Progress states of an object version, which is never processed again
+DONE_STATES = ('complete', 'failed')
+
+
+class InvalidNotification(ValueError):
+    """
+    raised for messages which are no valid storage notification, redelivering them won't help
+    """
+
+
+class ObjectInProcessing(Exception):
+    """
+    raised for a message whose object is being processed by another attempt. The message must not be acked, because
+    the other attempt may be killed without releasing its claim, e.g. for its memory.
+
+    Parameters
+    ----------
+    retry_after : float
+        seconds until the lease of the other attempt expires
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(f'object is being processed, lease expires in {retry_after:.0f} s')
+        self.retry_after = retry_after
+
+
+@backends.transactional
+def claim_object(transaction, progress_doc_ref, object_version: str, generation: Optional[int] = None,
+                 reprocess: bool = False) -> str:
+    """
+    marks an uploaded object as in processing, unless it is already processed, being processed or older than the
+    last upload of the user. This makes redeliveries of the same Pub/Sub message idempotent.
+
+    Parameters
+    ----------
+    transaction : google.cloud.firestore.Transaction or backends.SqliteTransaction
+        transaction to run in
+    progress_doc_ref : google.cloud.firestore.DocumentReference or backends.SqliteDocumentReference
+        progress document of the user
+    object_version : str
+        generation of the cloud storage object or the message id
+    generation : Optional[int], optional
+        generation of the cloud storage object, by default None if the notification has none
+    reprocess : bool, optional
+        whether an already processed version is claimed again, like batches reprocessing the corpus do, by default
+        False
+
+    Returns
+    -------
+    str
+        CLAIMED if the object should be processed, SKIPPED if the message can be acked
+
+    Raises
+    ------
+    ObjectInProcessing
+        if another attempt holds the lease of the object
+    """
+    snapshot = progress_doc_ref.get(transaction=transaction)
+    progress = snapshot.to_dict() if snapshot.exists else None
+    if progress is not None:
+        # Generations grow with every upload to the same name, so a late redelivery of an older upload is dropped
+        if generation is not None and progress.get('generation') is not None and generation < progress['generation']:
+            return SKIPPED
+        if progress.get('version') == object_version:
+            if progress['state'] in DONE_STATES and not reprocess:
+                return SKIPPED
+            lease_expires_at = progress.get('claimed_at', 0) + PROCESSING_LEASE
+            if progress['state'] == 'processing' and lease_expires_at > time.time():
+                raise ObjectInProcessing(lease_expires_at - time.time())
+    transaction.set(progress_doc_ref, {
+        'state': 'processing',
+        'version': object_version,
+        'generation': generation,
+        'claimed_at': time.time()
+    })
+    return CLAIMED
+
+def release_object(progress_doc_ref, object_version: str, generation: Optional[int], error: Exception):
+    """
+    ends the processing of a claimed object after an error. Errors of the upload itself (ValueError, e.g.
+    InvalidUpload) mark the version as failed, so it's never recognized again. Other errors are transient, the claim is
+    released, so a retry isn't skipped until the lease expires.
+
+    Parameters
+    ----------
+    progress_doc_ref : google.cloud.firestore.DocumentReference or backends.SqliteDocumentReference
+        progress document of the user
+    object_version : str
+        version of the claimed object
+    generation : Optional[int]
+        generation of the claimed object, None if it is unknown
+    error : Exception
+        error which ended the processing
+    """
+    if isinstance(error, ValueError):
+        progress_doc_ref.set({
+            'state': 'failed',
+            'version': object_version,
+            'generation': generation,
+            'error': str(error)
+        })
+    else:
+        progress_doc_ref.set({
+            'state': 'retrying',
+            'version': object_version,
+            'generation': generation
+        })
+
+def set_menu(batch, user_id: str, recognition: dict, object_version: str, generation: Optional[int] = None):
+    """
+    adds the writes of a recognized menu and its completion state to a batch
+
+    Parameters
+    ----------
+    batch : google.cloud.firestore.WriteBatch or backends.SqliteWriteBatch
+        batch to add the writes to
+    user_id : str
+        amazon user id or id of the Kita, whose members share the menu
+    recognition : dict
+        recognized menus as returned by process_image
+    object_version : str
+        version of the processed object
+    generation : Optional[int], optional
+        generation of the processed object, by default None if it is unknown
+    """
+    weeks = assign_weeks(recognition)
+    first_week = min(weeks) if weeks else None
+    batch.set(db.collection(u'menus').document(user_id), {
+        # cw and menu hold the first week for readers without multi-week support
+        'cw': int(first_week.split('-W')[1]) if first_week else datetime.date.today().isocalendar()[1],
+        'menu': weeks[first_week] if first_week else {},
+        'weeks': weeks,
+        # Menus are read far more often than written, so the skill's responses are formatted once here
+        'responses': build_responses(weeks)
+    })
+    batch.set(db.collection(u'progress').document(user_id), {
+        'state': 'complete',
+        'version': object_version,
+        'generation': generation
+    })
+
+def decode_notification(data: bytes) -> dict:
+    """
+    decodes the data of a storage notification message
+
+    Parameters
+    ----------
+    data : bytes
+        JSON encoded notification, base64 encoded in push requests
+
+    Returns
+    -------
+    dict
+        notification with at least the bucket and the name of the object
+
+    Raises
+    ------
+    InvalidNotification
+        if the data isn't a storage notification
+    """
+    try:
+        notification = json.loads(data.decode())
+    except Exception as e:
+        raise InvalidNotification('data property is not valid JSON') from e
+    if not isinstance(notification, dict) or not notification.get('name') or not notification.get('bucket'):
+        raise InvalidNotification('expected name and bucket properties')
+    return notification
+
+def handle_notification(data: dict, message_id: str = None, recognize: Callable = process_image) -> bool:
+    """
+    recognizes the menu of an uploaded object and writes it together with the completion state
+
+    Parameters
+    ----------
+    data : dict
+        decoded storage notification
+    message_id : str, optional
+        id of the Pub/Sub message, used as version if the notification has no generation
+    recognize : Callable, optional
+        called with bucket, name and language to recognize the menus, by default process_image. The pull worker
+        passes a function running it in a process pool.
+
+    Returns
+    -------
+    bool
+        False if the object is already processed, superseded by a newer upload or can't be recognized. In all cases
+        the message is done and can be acked.
+
+    Raises
+    ------
+    ObjectInProcessing
+        if another attempt is processing the object, the message has to be delivered again later
+    Exception
+        transient errors like an unavailable storage or document store, the message has to be delivered again
+    """
+    # Uploads are named after the user or the Kita, which owns the menu
+    user_id = Path(data['name']).stem
+    generation = int(data['generation']) if data.get('generation') else None
+    object_version = str(generation or message_id)
+
+    progress_doc_ref = db.collection(u'progress').document(user_id)
+    if claim_object(db.transaction(), progress_doc_ref, object_version, generation) == SKIPPED:
+        logging.info('skipping message for %s version %s', data['name'], object_version)
+        return False
+
+    lang = 'de' # TODO make language configurable
+    # The storage notification already contains the hashes of the object, so no download is needed for a hit
+    content_hash = data.get('md5Hash') or data.get('crc32c')
+    key = cache_key(content_hash, lang) if content_hash else None
+    recognition = menu_cache.get(key) if key else None
+    if recognition is None:
+        instrumentation.count('menu_cache_misses')
+        try:
+            with instrumentation.stage('recognition'):
+                recognition = recognize(data['bucket'], data['name'], lang)
+        except Exception as e:
+            instrumentation.count('recognition_failures')
+            release_object(progress_doc_ref, object_version, generation, e)
+            if not isinstance(e, ValueError):
+                raise
+            # The upload itself is broken, so the version is done and redeliveries are skipped
+            logging.error('cannot recognize %s version %s: %s', data['name'], object_version, e)
+            return False
+        if key:
+            menu_cache.set(key, recognition)
+    else:
+        instrumentation.count('menu_cache_hits')
+        logging.info('found cached menu for %s', data['name'])
+
+    # Write the menu and the completion state atomically
+    batch = db.batch()
+    set_menu(batch, user_id, recognition, object_version, generation)
+    batch.commit()
+    return True
@@ -1,104 +1,1594 @@
 """module with recognition function"""
-from typing import Iterable, Dict
-from collections import namedtuple
-import tempfile
+from typing import Iterable, Iterator, Dict, List, Optional, Sequence, Tuple, Union
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache, partial
+from itertools import repeat
 from pathlib import Path
+import contextlib
+import datetime
+import json
 import logging
+import multiprocessing
+import os
+import re
+import shlex
+import string
+import threading
+import time
 
 import cv2
+import numpy as np
 import pytesseract
-import spacy
 
-from google.cloud import storage
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
+import backends
+import instrumentation
+from menus import week_key
 
-LanguageCode = namedtuple('LanguageCode', ('iso', 'pytesseract', 'spacy'))
 
+LanguageCode = namedtuple(
+    'LanguageCode', ('iso', 'pytesseract', 'spacy', 'weekdays', 'date_pattern', 'weekday_date_gap', 'range_separator'))
+Word = namedtuple('Word', ('text',))
+PreprocessingConfig = namedtuple('PreprocessingConfig', ('dpi', 'page_width', 'binarize', 'deskew', 'crop_to_table'))
+# line identifies the text line of the word, box is x, y, width and height in pixels
+OcrWord = namedtuple('OcrWord', ('text', 'confidence', 'line', 'box'))
+# oem None is the default engine of the traineddata, an empty whitelist allows all characters
+OcrTier = namedtuple('OcrTier', ('name', 'dpi', 'oem', 'psm', 'whitelist'))
+# Scanned PDF page with the resolution it was actually rendered at, which is lower than requested for large pages
+RenderedPage = namedtuple('RenderedPage', ('img', 'dpi'))
+# Grayscale image of a page before binarization and the 3x3 affine transform of its pixels to the preprocessed image
+PageSource = namedtuple('PageSource', ('img', 'transform'))
+# Text line of a page, the box is given as x1, y1, x2, y2 in pixels of the preprocessed image
+OcrLine = namedtuple('OcrLine', ('words', 'box', 'tier'))
 
+
+# weekdays are the days with a menu from monday on, date_pattern matches dates with the groups day, month and year.
+# Digits around a date belong to a code like the allergens '1.4.7.', so they don't match. weekday_date_gap matches the
+# text between a weekday and its date, e.g. 'Montag, den 16.03.', range_separator the text between the dates of a range.
 LANGUAGE_CODE_CONVERTER = {
-    'de': LanguageCode('de', 'deu', 'de_core_news_sm')
+    'de': LanguageCode(
+        'de',
+        'deu',
+        'de_core_news_sm',
+        ('Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag'),
+        r'(?<![\d.])(?P<day>[0-3]?\d)\.\s?(?P<month>[01]?\d)\.(?:(?P<year>(?:\d{2}){1,2})(?!\d)|(?![\d.]))',
+        r'[^\w\n]{0,3}(?:den\s+)?',
+        r'\s*(?:-|–|bis)\s*'
+    )
+}
+# Dates further away from the upload are no menu dates, e.g. misread codes
+MAX_DATE_WEEKS = int(os.getenv('MAX_DATE_WEEKS', 8))
+
+# Increase whenever the recognition output changes, so cached results of older versions aren't used anymore
+PIPELINE_VERSION = 7
+
+# Directory with a <language code>.json file per language listing the boilerplate sequences to remove
+FILTER_CONFIG_DIR = Path(os.getenv('FILTER_CONFIG_DIR', Path(__file__).parent / 'filters'))
+
+# Characters tesseract commonly confuses, each character of a sequence to remove also matches its confusions
+OCR_CONFUSIONS = {
+    'g': 'gq',
+    'q': 'gq',
+    'l': 'lI1',
+    'I': 'lI1',
+    '1': 'lI1',
+    'O': 'O0',
+    '0': 'O0',
+    'B': 'B8',
+    '8': 'B8',
+    'S': 'S5',
+    '5': 'S5'
+}
+
+# 'page' OCRs the whole page at once, 'grid' OCRs the cells of the menu table in parallel
+RECOGNITION_MODE = os.getenv('RECOGNITION_MODE', 'page')
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', os.cpu_count() or 1))
+# Every tesseract handle holds a loaded model of about 20-40 MB, threads share this many handles per process
+TESSERACT_HANDLES = int(os.getenv('TESSERACT_HANDLES', 2))
+
+# 'model' tokenizes with the full spaCy model, 'blank' only with the spaCy tokenizer of the language and 'regex'
+# without spaCy at all. All modes yield the same words for menus.
+TOKENIZER_MODE = os.getenv('TOKENIZER_MODE', 'model')
+
+# Prefixes, suffixes and infixes the German spaCy tokenizer splits off, used by the regex tokenizer to find the same
+# words. Abbreviations like 'ca.' are kept as one token, they are listed per language in FILTER_CONFIG_DIR.
+# The character classes are spaCy's, reduced to the characters of Latin script and the symbols OCR produces.
+TOKEN_PUNCT = r'…,:;!?¿¡()\[\]{}<>_#*&～·'
+TOKEN_QUOTES = r'\'"”“`‘´’‚,„»«'
+TOKEN_CURRENCY = r'$£€¥'
+TOKEN_ICONS = r'¦©®°™'
+TOKEN_UNITS = '|'.join(re.escape(unit) for unit in (
+    'km km² km³ m m² m³ dm dm² dm³ cm cm² cm³ mm mm² mm³ ha µm nm yd in ft kg g mg µg t lb oz m/s km/h kmh mph '
+    'hPa Pa mbar mb MB kb KB gb GB tb TB T G M K %').split())
+TOKEN_PREFIX = re.compile(
+    rf'^(?:``|[§%=—–{TOKEN_PUNCT}{TOKEN_QUOTES}{TOKEN_CURRENCY}{TOKEN_ICONS}]|\+(?!\d)|\.\.+)')
+TOKEN_SUFFIX = re.compile(
+    rf"(?:''|[/{TOKEN_PUNCT}{TOKEN_QUOTES}{TOKEN_ICONS}]|\.\.+|(?<=\d)\+|(?<=°[FfCcKk])\.|(?<=\d)[{TOKEN_CURRENCY}]"
+    rf'|(?<=\d)(?:{TOKEN_UNITS})|(?<=[a-zß-öø-ÿ%²\-+|?:{TOKEN_PUNCT}{TOKEN_QUOTES}])\.|(?<=[A-ZÀ-ÖØ-Þ]{{2}})\.)$')
+# Like spaCy, web addresses of the kita aren't split, e.g. 'www.kita.de/speiseplan'
+TOKEN_URL = re.compile(r'^(?:[\w+.-]{2,}://)?(?:[^\W_][\w-]*\.)+[a-zß-öø-ÿ]{2,63}(?::\d{2,5})?(?:[/?#]\S*)?$')
+# Infixes are split between letters, like 'Obst(Banane)' or 'Tee!Saft', as OCR output often lacks the spaces
+TOKEN_INFIX = re.compile(
+    rf'\.\.+|…|[{TOKEN_ICONS}]|(?<=[a-zß-öø-ÿ])\.(?=[A-ZÀ-ÖØ-Þ])|(?<=[^\W\d_])[,!?:<>=](?=[^\W\d_])'
+    r'|(?<=[^\W_])/(?=[^\W_])|(?<=[^\W\d_])[()\[\]"”“`‘´’‚,„»«](?=[^\W\d_])|(?<=[^\W\d_])--(?=[^\W\d_])|(?<=\d)-(?=\d)')
+
+# generate_menu only reads token.text and token.is_alpha, so these components are never needed
+UNUSED_SPACY_COMPONENTS = ('parser', 'ner', 'lemmatizer')
+
+# Photos with a longer side than this are downscaled before OCR, phone cameras easily deliver 4000px and more
+MAX_IMAGE_SIDE = int(os.getenv('MAX_IMAGE_SIDE', 3000))
+
+# Menus are usually printed on landscape A4 paper, dpi is the target resolution of that page width in inches
+DEFAULT_PREPROCESSING = PreprocessingConfig(
+    dpi=int(os.getenv('PREPROCESSING_DPI', 250)),
+    page_width=11.69,
+    binarize=True,
+    deskew=True,
+    crop_to_table=True
+)
+
+# PDF pages with less embedded characters than this are treated as scans and OCRed
+MIN_PDF_PAGE_TEXT = int(os.getenv('MIN_PDF_PAGE_TEXT', 50))
+# Pages rendered from a PDF already have the target resolution, so they aren't resized again
+PDF_PAGE_PREPROCESSING = DEFAULT_PREPROCESSING._replace(dpi=0)
+
+# 'adaptive' OCRs pages with the fast tier and escalates low confidence lines and pages with missing days to the
+# accurate tier, 'fast' and 'accurate' only use the one tier
+OCR_MODE = os.getenv('OCR_MODE', 'adaptive')
+# Letters, umlauts and accents of dishes like Crêpes, digits and the punctuation of menus. Quotes are left out,
+# tesseract likes to mistake specks for them.
+MENU_CHARACTERS = string.ascii_letters + string.digits + 'ÄÖÜäöüßÉéèêàâçôî' + '.,:;-–/()&+!?%€'
+# The fast tier runs the LSTM engine only on a downscaled page with the German word list of the traineddata, the
+# accurate tier is the full engine at a higher resolution than the preprocessing
+FAST_OCR_TIER = OcrTier('fast', int(os.getenv('FAST_OCR_DPI', 150)), 1, 3, MENU_CHARACTERS)
+ACCURATE_OCR_TIER = OcrTier('accurate', int(os.getenv('ACCURATE_OCR_DPI', 300)), None, 3, '')
+# Escalated lines are OCRed one by one as single text line
+LINE_OCR_TIER = ACCURATE_OCR_TIER._replace(name='line', psm=7)
+# Lines with a lower mean word confidence (0-100) are escalated, if more than the ratio of lines is, the whole page
+MIN_LINE_CONFIDENCE = float(os.getenv('MIN_LINE_CONFIDENCE', 70))
+MAX_ESCALATED_LINE_RATIO = float(os.getenv('MAX_ESCALATED_LINE_RATIO', 0.3))
+# Lines of days missing after the first pass are escalated below this confidence, their header may be misread
+MIN_DAY_LINE_CONFIDENCE = float(os.getenv('MIN_DAY_LINE_CONFIDENCE', 90))
+
+
+
+class InvalidUpload(ValueError):
+    """
+    raised for uploads which can't be recognized, like a corrupt image, an unreadable PDF or an empty text. Recognizing
+    them again won't help.
+    """
+
+
+_nlp_pipelines = {}
+_nlp_lock = threading.Lock()
+
+
+def get_nlp(lang: str, mode: str = None):
+    """
+    returns the spaCy pipeline for a language, loading it once per process
+
+    Parameters
+    ----------
+    lang : str
+        language code
+    mode : str, optional
+        'model' for the full model or 'blank' for the tokenizer only, by default TOKENIZER_MODE
+
+    Returns
+    -------
+    spacy.language.Language
+        loaded pipeline without the unused components
+    """
+    mode = mode or TOKENIZER_MODE
+    key = (lang, mode)
+    nlp = _nlp_pipelines.get(key)
+    if nlp is None:
+        with _nlp_lock:
+            # Another thread may have loaded the model while we were waiting
+            nlp = _nlp_pipelines.get(key)
+            if nlp is None:
+                # spaCy is imported lazily, so the regex mode doesn't pay for its import
+                import spacy
+                logging.info('loading spaCy pipeline for %s in mode %s', lang, mode)
+                if mode == 'blank':
+                    nlp = spacy.blank(LANGUAGE_CODE_CONVERTER[lang].iso)
+                else:
+                    nlp = spacy.load(LANGUAGE_CODE_CONVERTER[lang].spacy, disable=UNUSED_SPACY_COMPONENTS)
+                _nlp_pipelines[key] = nlp
+    return nlp
+
+
+def preload_pipelines(langs: Iterable[str]):
+    """
+    loads the spaCy pipelines of the given languages, e.g. on worker start
+
+    Parameters
+    ----------
+    langs : Iterable[str]
+        language codes to load
+    """
+    if TOKENIZER_MODE == 'regex':
+        return
+    for lang in langs:
+        get_nlp(lang)
+
+
+class OcrBackend:
+    """
+    interface for OCR engines turning a grayscale image into text
+    """
+
+    name = None
+
+    def image_to_string(self, img, lang: str) -> str:
+        """
+        extracts the text from an image
+
+        Parameters
+        ----------
+        img : numpy.ndarray
+            grayscale image
+        lang : str
+            language code of the text
+
+        Returns
+        -------
+        str
+            extracted text
+        """
+        raise NotImplementedError
+
+    def image_to_words(self, img, lang: str, tier: OcrTier) -> List[OcrWord]:
+        """
+        extracts the words of an image with their confidences
+
+        Parameters
+        ----------
+        img : numpy.ndarray
+            grayscale image
+        lang : str
+            language code of the text
+        tier : OcrTier
+            engine, page segmentation and character whitelist to use, the resolution is up to the caller
+
+        Returns
+        -------
+        List[OcrWord]
+            words in reading order
+        """
+        raise NotImplementedError
+
+
+class PytesseractBackend(OcrBackend):
+    """
+    runs the tesseract binary as subprocess per image
+    """
+
+    name = 'pytesseract'
+
+    def image_to_string(self, img, lang: str) -> str:
+        return pytesseract.image_to_string(img, lang=LANGUAGE_CODE_CONVERTER[lang].pytesseract)
+
+    def image_to_words(self, img, lang: str, tier: OcrTier) -> List[OcrWord]:
+        config = f'--psm {tier.psm}'
+        if tier.oem is not None:
+            config += f' --oem {tier.oem}'
+        if tier.whitelist:
+            config += ' -c tessedit_char_whitelist=' + shlex.quote(tier.whitelist)
+        data = pytesseract.image_to_data(img, lang=LANGUAGE_CODE_CONVERTER[lang].pytesseract, config=config,
+                                         output_type=pytesseract.Output.DICT)
+        words = []
+        for idx, text in enumerate(data['text']):
+            if not text.strip():
+                continue
+            line = (data['block_num'][idx], data['par_num'][idx], data['line_num'][idx])
+            box = (data['left'][idx], data['top'][idx], data['width'][idx], data['height'][idx])
+            words.append(OcrWord(text.strip(), float(data['conf'][idx]), line, box))
+        return words
+
+
+class TesserocrBackend(OcrBackend):
+    """
+    keeps a bounded pool of long-lived tesseract API handles, so the traineddata is only read once per handle. Every
+    handle holds a loaded model of its language and engine, so threads wait for a free handle instead of loading
+    one model each.
+
+    Parameters
+    ----------
+    max_handles : int, optional
+        maximum number of handles of the process, by default TESSERACT_HANDLES
+    """
+
+    name = 'tesserocr'
+
+    def __init__(self, max_handles: int = None):
+        self.max_handles = max_handles or TESSERACT_HANDLES
+        # Idle handles with their language and engine, the least recently used first
+        self._idle = []
+        self._n_handles = 0
+        self._condition = threading.Condition()
+
+    def _acquire(self, key: tuple):
+        with self._condition:
+            while True:
+                for idx, (idle_key, api) in enumerate(self._idle):
+                    if idle_key == key:
+                        del self._idle[idx]
+                        return api
+                if self._n_handles < self.max_handles:
+                    self._n_handles += 1
+                    break
+                if self._idle:
+                    # Replace the least recently used handle of another language or engine
+                    _, api = self._idle.pop(0)
+                    api.End()
+                    self._n_handles -= 1
+                    continue
+                self._condition.wait()
+
+        # Loading the model takes a while, so it is done outside of the lock
+        lang, oem = key
+        try:
+            kwargs = {'oem': oem} if oem is not None else {}
+            return tesserocr.PyTessBaseAPI(lang=LANGUAGE_CODE_CONVERTER[lang].pytesseract, **kwargs)
+        except Exception:
+            with self._condition:
+                self._n_handles -= 1
+                self._condition.notify()
+            raise
+
+    @contextlib.contextmanager
+    def _api(self, lang: str, oem: Optional[int] = None):
+        # The engine is chosen when the handle is created, so handles are kept per language and engine
+        key = (lang, oem)
+        api = self._acquire(key)
+        try:
+            yield api
+        finally:
+            with self._condition:
+                self._idle.append((key, api))
+                self._condition.notify()
+
+    def image_to_string(self, img, lang: str) -> str:
+        with self._api(lang) as api:
+            height, width = img.shape[:2]
+            # Pass the grayscale buffer directly, one byte per pixel
+            api.SetImageBytes(img.tobytes(), width, height, 1, width)
+            text = api.GetUTF8Text()
+            api.Clear()
+            return text
+
+    def image_to_words(self, img, lang: str, tier: OcrTier) -> List[OcrWord]:
+        with self._api(lang, tier.oem) as api:
+            height, width = img.shape[:2]
+            api.SetImageBytes(img.tobytes(), width, height, 1, width)
+            api.SetPageSegMode(tier.psm)
+            api.SetVariable('tessedit_char_whitelist', tier.whitelist)
+            try:
+                api.Recognize()
+                words = []
+                line = -1
+                for word in tesserocr.iterate_level(api.GetIterator(), tesserocr.RIL.WORD):
+                    if word.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                        line += 1
+                    text = (word.GetUTF8Text(tesserocr.RIL.WORD) or '').strip()
+                    if not text:
+                        continue
+                    x1, y1, x2, y2 = word.BoundingBox(tesserocr.RIL.WORD)
+                    box = (x1, y1, x2 - x1, y2 - y1)
+                    words.append(OcrWord(text, word.Confidence(tesserocr.RIL.WORD), line, box))
+                return words
+            finally:
+                # image_to_string shares the handles and expects the defaults
+                api.SetPageSegMode(tesserocr.PSM.AUTO)
+                api.SetVariable('tessedit_char_whitelist', '')
+                api.Clear()
+
+
+OCR_BACKENDS = {
+    PytesseractBackend.name: PytesseractBackend,
+    TesserocrBackend.name: TesserocrBackend
 }
 
+_ocr_backend = None
+_ocr_backend_lock = threading.Lock()
+
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+
+def get_ocr_backend() -> OcrBackend:
+    """
+    returns the configured OCR backend. The backend can be chosen with the OCR_BACKEND environment variable, by
+    default tesserocr is used if installed and pytesseract otherwise.
+
+    Returns
+    -------
+    OcrBackend
+        OCR backend shared by all threads
+    """
+    global _ocr_backend
+    if _ocr_backend is None:
+        with _ocr_backend_lock:
+            if _ocr_backend is None:
+                default = TesserocrBackend.name if tesserocr is not None else PytesseractBackend.name
+                name = os.getenv('OCR_BACKEND', default)
+                if name == TesserocrBackend.name and tesserocr is None:
+                    logging.warning('tesserocr is not installed, falling back to pytesseract')
+                    name = PytesseractBackend.name
+                _ocr_backend = OCR_BACKENDS[name]()
+    return _ocr_backend
+
+
+@lru_cache(maxsize=None)
+def get_language_config(lang: str) -> dict:
+    """
+    loads the filter config of a language from FILTER_CONFIG_DIR
+
+    Parameters
+    ----------
+    lang : str
+        language code
+
+    Returns
+    -------
+    dict
+        config, empty if there is no config for the language
+    """
+    config_path = FILTER_CONFIG_DIR / '{:s}.json'.format(lang)
+    if not config_path.exists():
+        logging.warning('no filter config for language %s', lang)
+        return {}
+    with config_path.open(encoding='utf-8') as config_file:
+        return json.load(config_file)
+
+def get_sequences_to_remove(lang: str) -> Tuple[str, ...]:
+    """
+    returns the boilerplate sequences of a language
+
+    Parameters
+    ----------
+    lang : str
+        language code
+
+    Returns
+    -------
+    Tuple[str, ...]
+        sequences to remove
+    """
+    return tuple(get_language_config(lang).get('sequences_to_remove', ()))
+
+@lru_cache(maxsize=None)
+def get_abbreviations(lang: str) -> frozenset:
+    """
+    returns the abbreviations of a language, which the tokenizer keeps as one token
+
+    Parameters
+    ----------
+    lang : str
+        language code
+
+    Returns
+    -------
+    frozenset
+        abbreviations including their period
+    """
+    return frozenset(get_language_config(lang).get('abbreviations', ()))
+
+@lru_cache(maxsize=None)
+def get_closure_pattern(lang: str) -> Optional[re.Pattern]:
+    """
+    compiles the closure markers of a language, like 'geschlossen' or 'Feiertag', which stand for a day without food
+
+    Parameters
+    ----------
+    lang : str
+        language code
+
+    Returns
+    -------
+    Optional[re.Pattern]
+        pattern fully matching texts of markers only ignoring case, None if the language has no markers
+    """
+    markers = get_language_config(lang).get('closure_markers', ())
+    if not markers:
+        return None
+    marker = '(?:{})'.format('|'.join(re.escape(marker) for marker in markers))
+    return re.compile(r'\W*{0}(?:\W+{0})*\W*'.format(marker), re.IGNORECASE)
+
+def _fuzzy_pattern(seq: str) -> str:
+    parts = []
+    for char in seq:
+        if char.isspace():
+            parts.append(r'\s+')
+        elif char in OCR_CONFUSIONS:
+            parts.append('[' + re.escape(OCR_CONFUSIONS[char]) + ']')
+        else:
+            parts.append(re.escape(char))
+    return ''.join(parts)
+
+@lru_cache(maxsize=32)
+def compile_text_filter(sequences_to_remove: Tuple[str, ...], fuzzy: bool = True):
+    """
+    compiles the sequences into a single regular expression, which only matches whole words
+
+    Parameters
+    ----------
+    sequences_to_remove : Tuple[str, ...]
+        sequences to remove
+    fuzzy : bool, optional
+        whether characters also match their OCR_CONFUSIONS, by default True
+
+    Returns
+    -------
+    Optional[re.Pattern]
+        compiled expression or None if there is nothing to remove
+    """
+    # Longer sequences first, so they win over sequences they contain
+    unique = sorted(set(sequences_to_remove), key=len, reverse=True)
+    if not unique:
+        return None
+    to_pattern = _fuzzy_pattern if fuzzy else re.escape
+    return re.compile(r'(?<!\w)(?:' + '|'.join(to_pattern(seq) for seq in unique) + r')(?!\w)')
+
+def filter_raw_text(text: str, sequences_to_remove: Iterable[str]) -> str:
+    """
+    Removes all occurences from a text which are present in the sequences_to_remove list.
+    The sequences are compiled once into a single expression, so the text is filtered in one pass. Only whole words
+    are removed and typical OCR confusions like g/q are tolerated.
+
+    Parameters
+    ----------
+    text : str
+        test to filter
+    sequences_to_remove : Iterable[str]
+        sequences to remove
+
+    Returns
+    -------
+    str
+        filtered text
+    """
+    text_filter = compile_text_filter(tuple(sequences_to_remove))
+    if text_filter is None:
+        return text
+    return text_filter.sub('', text)
+
+@instrumentation.timed('decode_image')
+def decode_image(data: bytes, max_side: int = MAX_IMAGE_SIDE):
+    """
+    decodes an encoded image directly to grayscale and downscales very large images
+
+    Parameters
+    ----------
+    data : bytes
+        encoded image, e.g. the content of a jpeg file
+    max_side : int, optional
+        maximum length of the longer image side, by default MAX_IMAGE_SIDE
+
+    Returns
+    -------
+    numpy.ndarray
+        grayscale image
+
+    Raises
+    ------
+    InvalidUpload
+        if the data cannot be decoded as image
+    """
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise InvalidUpload('cannot decode image')
+    height, width = img.shape
+    scale = max_side / max(height, width)
+    if scale < 1:
+        logging.debug('downscaling image from %dx%d by %.2f', width, height, scale)
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
+def resize_to_dpi(img, dpi: int, page_width: float):
+    """
+    scales an image of a whole page, so that the page width matches the given resolution
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        grayscale image
+    dpi : int
+        target resolution in dots per inch
+    page_width : float
+        width of the photographed page in inches
+
+    Returns
+    -------
+    numpy.ndarray
+        scaled image
+    """
+    scale = dpi * page_width / img.shape[1]
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=interpolation)
+
+def binarize(img):
+    """
+    converts a grayscale image to black text on white background, adaptive thresholding copes with the uneven
+    lighting of phone photos
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        grayscale image
+
+    Returns
+    -------
+    numpy.ndarray
+        binary image
+    """
+    return cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+
+def skew_rotation(img) -> Optional[np.ndarray]:
+    """
+    finds the rotation which makes the text lines of the image horizontal
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        binary image with dark text on white background
+
+    Returns
+    -------
+    Optional[numpy.ndarray]
+        2x3 rotation matrix, None if the image isn't skewed
+    """
+    coords = cv2.findNonZero(cv2.bitwise_not(img))
+    if coords is None:
+        return None
+    angle = cv2.minAreaRect(coords)[-1]
+    # The angle range of minAreaRect differs between OpenCV versions, normalize to [-45, 45]
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    if abs(angle) < 0.1:
+        return None
+    height, width = img.shape[:2]
+    return cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+
+def deskew(img):
+    """
+    rotates the image, so that the text lines are horizontal
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        binary image with dark text on white background
+
+    Returns
+    -------
+    numpy.ndarray
+        rotated image
+    """
+    rotation = skew_rotation(img)
+    if rotation is None:
+        return img
+    height, width = img.shape[:2]
+    return cv2.warpAffine(img, rotation, (width, height), flags=cv2.INTER_LINEAR, borderValue=255)
+
+def find_table_lines(img):
+    """
+    detects the horizontal and vertical lines of a table
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        binary image with dark text on white background
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        masks with the horizontal and the vertical lines
+    """
+    inverted = cv2.bitwise_not(img)
+    height, width = img.shape[:2]
+    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 30, 1), 1))
+    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(height // 30, 1)))
+    horizontal = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, horizontal_kernel)
+    vertical = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, vertical_kernel)
+    return horizontal, vertical
+
+def find_table_box(img, min_area_ratio: float = 0.2) -> Optional[Tuple[int, int, int, int]]:
+    """
+    finds the bounding box of the menu table
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        binary image with dark text on white background
+    min_area_ratio : float, optional
+        minimal share of the image the table has to cover, by default 0.2
+
+    Returns
+    -------
+    Optional[Tuple[int, int, int, int]]
+        x, y, width and height of the table, None if no table is found
+    """
+    horizontal, vertical = find_table_lines(img)
+    contours, _ = cv2.findContours(cv2.bitwise_or(horizontal, vertical), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    x, y, width, height = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    if width * height < min_area_ratio * img.shape[0] * img.shape[1]:
+        return None
+    return x, y, width, height
+
+def crop_to_table(img, min_area_ratio: float = 0.2):
+    """
+    crops the image to the bounding box of the menu table, the image is returned unchanged if no table is found
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        binary image with dark text on white background
+    min_area_ratio : float, optional
+        minimal share of the image the table has to cover, by default 0.2
+
+    Returns
+    -------
+    numpy.ndarray
+        cropped image
+    """
+    box = find_table_box(img, min_area_ratio)
+    if box is None:
+        return img
+    x, y, width, height = box
+    return img[y:y + height, x:x + width]
+
+def _line_positions(profile) -> List[int]:
+    """
+    returns the centers of the lines in a projection profile of a line mask
+    """
+    indices = np.flatnonzero(profile >= profile.max() / 2) if profile.any() else np.array([], dtype=int)
+    if indices.size == 0:
+        return []
+    groups = np.split(indices, np.flatnonzero(np.diff(indices) > 1) + 1)
+    return [int(group.mean()) for group in groups]
+
+def find_grid_cells(img, margin: int = 3) -> List[List[Tuple[int, int, int, int]]]:
+    """
+    detects the cells of the menu table
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        binary image with dark text on white background
+    margin : int, optional
+        pixels to cut off at each cell border, so the grid lines aren't recognized as text, by default 3
+
+    Returns
+    -------
+    List[List[Tuple[int, int, int, int]]]
+        rows of cells given as x, y, width and height, empty if no grid was found
+    """
+    horizontal, vertical = find_table_lines(img)
+    rows = _line_positions(np.count_nonzero(horizontal, axis=1))
+    cols = _line_positions(np.count_nonzero(vertical, axis=0))
+    if len(rows) < 2 or len(cols) < 2:
+        return []
+    return [
+        [(x0 + margin, y0 + margin, x1 - x0 - 2 * margin, y1 - y0 - 2 * margin) for x0, x1 in zip(cols, cols[1:])]
+        for y0, y1 in zip(rows, rows[1:])
+    ]
+
+def _affine(matrix) -> np.ndarray:
+    """
+    returns a 2x3 affine matrix as 3x3 matrix, so transforms are chained by multiplication
+    """
+    return np.vstack([matrix, [0, 0, 1]])
+
+def _resize_stage(img, config: PreprocessingConfig):
+    scale = config.dpi * config.page_width / img.shape[1]
+    return resize_to_dpi(img, config.dpi, config.page_width), _affine([[scale, 0, 0], [0, scale, 0]])
+
+def _deskew_stage(img):
+    rotation = skew_rotation(img)
+    if rotation is None:
+        return img, None
+    height, width = img.shape[:2]
+    return cv2.warpAffine(img, rotation, (width, height), flags=cv2.INTER_LINEAR, borderValue=255), _affine(rotation)
+
+def _crop_stage(img):
+    box = find_table_box(img)
+    if box is None:
+        return img, None
+    x, y, width, height = box
+    return img[y:y + height, x:x + width], _affine([[1, 0, -x], [0, 1, -y]])
+
+@instrumentation.timed('preprocess_image')
+def preprocess_page(img, config: PreprocessingConfig = DEFAULT_PREPROCESSING) \
+        -> Tuple[np.ndarray, PageSource, Dict[str, float]]:
+    """
+    prepares a photo for OCR like preprocess_image and keeps the grayscale image with the transform of the resize,
+    deskew and crop stages, so regions of the page can be rendered at a higher resolution later, see render_region
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        grayscale image
+    config : PreprocessingConfig, optional
+        enabled stages, by default DEFAULT_PREPROCESSING
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, PageSource, Dict[str, float]]
+        preprocessed image, the grayscale image it was preprocessed from and the duration of each stage in seconds
+    """
+    stages = []
+    if config.dpi:
+        stages.append(('resize', lambda i: _resize_stage(i, config)))
+    # Deskewing and table detection rely on a binary image
+    if config.binarize or config.deskew or config.crop_to_table:
+        stages.append(('binarize', lambda i: (binarize(i), None)))
+    if config.deskew:
+        stages.append(('deskew', _deskew_stage))
+    if config.crop_to_table:
+        stages.append(('crop_to_table', _crop_stage))
+
+    source = img
+    transform = np.eye(3)
+    timings = {}
+    for name, stage in stages:
+        start = time.perf_counter()
+        img, stage_transform = stage(img)
+        if stage_transform is not None:
+            transform = stage_transform @ transform
+        timings[name] = time.perf_counter() - start
+    logging.debug('preprocessing timings %s', timings)
+    return img, PageSource(source, transform), timings
+
+def preprocess_image(img, config: PreprocessingConfig = DEFAULT_PREPROCESSING):
+    """
+    prepares a photo for OCR, the stages which are enabled in the config are run in order resize, binarize, deskew
+    and crop to table
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        grayscale image
+    config : PreprocessingConfig, optional
+        enabled stages, by default DEFAULT_PREPROCESSING
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, Dict[str, float]]
+        preprocessed image and the duration of each stage in seconds
+    """
+    img, _, timings = preprocess_page(img, config)
+    return img, timings
+
+@instrumentation.timed('extract_text')
+def extract_text(img, lang: str) -> str:
+    """
+    extracts the text from an image
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        grayscale image
+    lang : str
+        language code of the text
+
+    Returns
+    -------
+    str
+        extracted text
+    """
+    text = get_ocr_backend().image_to_string(img, lang)
+    instrumentation.count('ocr_characters', len(text))
+    logging.debug('extracted text %s', text)
+    return text
+
+def scale_image(img, scale: float):
+    """
+    scales an image, scales close to 1 return the image itself
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        grayscale image
+    scale : float
+        scale factor
+
+    Returns
+    -------
+    numpy.ndarray
+        scaled image
+    """
+    if abs(scale - 1) < 0.01:
+        return img
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=interpolation)
+
+def extract_words(img, lang: str, tier: OcrTier, dpi: float = DEFAULT_PREPROCESSING.dpi) -> List[OcrWord]:
+    """
+    extracts the words of an image with one OCR tier, the image is scaled to the resolution of the tier
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        preprocessed grayscale image
+    lang : str
+        language code of the text
+    tier : OcrTier
+        OCR tier
+    dpi : float, optional
+        resolution of the image, by default DEFAULT_PREPROCESSING.dpi
+
+    Returns
+    -------
+    List[OcrWord]
+        words in reading order, their boxes refer to the scaled image
+    """
+    with instrumentation.stage(f'ocr_{tier.name}'):
+        words = get_ocr_backend().image_to_words(scale_image(img, tier.dpi / dpi), lang, tier)
+    instrumentation.count(f'ocr_{tier.name}_passes')
+    instrumentation.count('ocr_characters', sum(len(word.text) for word in words))
+    return words
+
+def group_lines(words: Iterable[OcrWord]) -> Dict[tuple, List[OcrWord]]:
+    """
+    groups words by their text line
+
+    Parameters
+    ----------
+    words : Iterable[OcrWord]
+        words in reading order
+
+    Returns
+    -------
+    Dict[tuple, List[OcrWord]]
+        words by line in reading order
+    """
+    lines = OrderedDict()
+    for word in words:
+        lines.setdefault(word.line, []).append(word)
+    return lines
+
+def lines_to_text(lines: Iterable[List[OcrWord]]) -> str:
+    return '\n'.join(' '.join(word.text for word in line) for line in lines)
+
+def mean_confidence(words: List[OcrWord]) -> float:
+    return sum(word.confidence for word in words) / len(words) if words else 0.0
+
+def render_region(img, source: Optional[PageSource], box: Tuple[float, float, float, float], scale: float):
+    """
+    renders a region of the preprocessed image at a higher resolution for the accurate tiers. It is resampled once
+    from the grayscale image at its native resolution and binarized after, so the higher resolution adds the detail of
+    the photo or the rendered PDF page instead of interpolating binarized pixels.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        preprocessed image
+    source : Optional[PageSource]
+        grayscale image the preprocessed one was made of, the preprocessed image is scaled if None
+    box : Tuple[float, float, float, float]
+        x1, y1, x2, y2 of the region in pixels of the preprocessed image
+    scale : float
+        scale of the rendered region relative to the preprocessed image
+
+    Returns
+    -------
+    numpy.ndarray
+        binary image of the region
+    """
+    x1, y1, x2, y2 = box
+    if source is None:
+        return scale_image(img[int(y1):int(np.ceil(y2)), int(x1):int(np.ceil(x2))], scale)
+    size = (max(int(round((x2 - x1) * scale)), 1), max(int(round((y2 - y1) * scale)), 1))
+    transform = _affine([[scale, 0, -x1 * scale], [0, scale, -y1 * scale]]) @ source.transform
+    # Warps don't support INTER_AREA, reductions of the native resolution are interpolated linearly
+    magnification = np.sqrt(abs(np.linalg.det(transform[:2, :2])))
+    interpolation = cv2.INTER_CUBIC if magnification > 1 else cv2.INTER_LINEAR
+    region = cv2.warpAffine(source.img, transform[:2], size, flags=interpolation, borderValue=255)
+    return binarize(region)
+
+def ocr_lines(img, lang: str, tier: OcrTier, dpi: float = DEFAULT_PREPROCESSING.dpi,
+              source: PageSource = None) -> List[OcrLine]:
+    """
+    extracts the text lines of a page with one OCR tier, tiers with a higher resolution than the preprocessed image
+    OCR the page rendered from its source
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        preprocessed grayscale image of the page
+    lang : str
+        language code of the text
+    tier : OcrTier
+        OCR tier
+    dpi : float, optional
+        resolution of the image, by default DEFAULT_PREPROCESSING.dpi
+    source : PageSource, optional
+        grayscale image the page was preprocessed from, by default None
+
+    Returns
+    -------
+    List[OcrLine]
+        lines in reading order
+    """
+    if source is not None and tier.dpi > dpi:
+        page = render_region(img, source, (0, 0, img.shape[1], img.shape[0]), tier.dpi / dpi)
+        words = extract_words(page, lang, tier, tier.dpi)
+    else:
+        words = extract_words(img, lang, tier, dpi)
+    # Boxes of the words refer to the image at the resolution of the tier
+    scale = dpi / tier.dpi
+    return [
+        OcrLine(line, (min(word.box[0] for word in line) * scale, min(word.box[1] for word in line) * scale,
+                       max(word.box[0] + word.box[2] for word in line) * scale,
+                       max(word.box[1] + word.box[3] for word in line) * scale), tier.name)
+        for line in group_lines(words).values()
+    ]
+
+def escalate_lines(img, lang: str, lines: List[OcrLine], indices: Iterable[int],
+                   dpi: float = DEFAULT_PREPROCESSING.dpi, source: PageSource = None) -> List[OcrLine]:
+    """
+    OCRs some lines again one by one with the line tier, each line is rendered at the resolution of the tier from the
+    source of the page. Lines are only replaced if the line tier is more confident.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        preprocessed grayscale image of the page
+    lang : str
+        language code of the text
+    lines : List[OcrLine]
+        lines of the page
+    indices : Iterable[int]
+        indices of the lines to escalate
+    dpi : float, optional
+        resolution of the image, by default DEFAULT_PREPROCESSING.dpi
+    source : PageSource, optional
+        grayscale image the page was preprocessed from, by default None
+
+    Returns
+    -------
+    List[OcrLine]
+        lines with the escalated ones replaced
+    """
+    lines = list(lines)
+    height, width = img.shape[:2]
+    margin = 0.05 * dpi
+    for idx in indices:
+        line = lines[idx]
+        x1, y1, x2, y2 = line.box
+        box = (max(x1 - margin, 0), max(y1 - margin, 0), min(x2 + margin, width), min(y2 + margin, height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            continue
+        crop = render_region(img, source, box, LINE_OCR_TIER.dpi / dpi)
+        words = extract_words(crop, lang, LINE_OCR_TIER, LINE_OCR_TIER.dpi)
+        if mean_confidence(words) > mean_confidence(line.words):
+            lines[idx] = OcrLine(words, line.box, LINE_OCR_TIER.name)
+    return lines
+
+def extract_page_lines(img, lang: str, dpi: float = DEFAULT_PREPROCESSING.dpi,
+                       source: PageSource = None) -> List[OcrLine]:
+    """
+    extracts the text lines of a page with the OCR tiers of OCR_MODE. In adaptive mode the page is OCRed with the fast
+    tier first and only lines with a mean confidence below MIN_LINE_CONFIDENCE are OCRed again with the line tier, or
+    the whole page with the accurate tier if more than MAX_ESCALATED_LINE_RATIO of the lines are.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        preprocessed grayscale image of the page
+    lang : str
+        language code of the text
+    dpi : float, optional
+        resolution of the image, by default DEFAULT_PREPROCESSING.dpi
+    source : PageSource, optional
+        grayscale image the page was preprocessed from, the accurate tiers render their regions from it, by default
+        None to scale the preprocessed image
+
+    Returns
+    -------
+    List[OcrLine]
+        lines in reading order with the tier each was read with
+    """
+    if OCR_MODE == 'accurate':
+        return ocr_lines(img, lang, ACCURATE_OCR_TIER, dpi, source)
+    lines = ocr_lines(img, lang, FAST_OCR_TIER, dpi)
+    if OCR_MODE == 'fast':
+        return lines
+
+    low_confidence = [idx for idx, line in enumerate(lines) if mean_confidence(line.words) < MIN_LINE_CONFIDENCE]
+    if not low_confidence:
+        instrumentation.count('ocr_fast_pages')
+        return lines
+    if len(low_confidence) > MAX_ESCALATED_LINE_RATIO * len(lines):
+        logging.info('escalating page with %d of %d low confidence lines', len(low_confidence), len(lines))
+        instrumentation.count('ocr_escalated_pages')
+        return ocr_lines(img, lang, ACCURATE_OCR_TIER, dpi, source)
+    logging.info('escalating %d of %d low confidence lines', len(low_confidence), len(lines))
+    instrumentation.count('ocr_escalated_lines', len(low_confidence))
+    return escalate_lines(img, lang, lines, low_confidence, dpi, source)
 
-def filter_raw_text(text: str, sequences_to_remove: Iterable[str]) -> str:
+def page_tier(lines: List[OcrLine]) -> str:
     """
-    Removes all occurences from a text which are present in the sequences_to_remove list.
-    This is an easy first step filtering, which is pretty weak, but makes usage of NLP later easier.
+    returns the name of the most accurate tier used for the whole page or some lines of it
+    """
+    tiers = {line.tier for line in lines}
+    for tier in (ACCURATE_OCR_TIER, LINE_OCR_TIER):
+        if tier.name in tiers:
+            return tier.name
+    return ACCURATE_OCR_TIER.name if OCR_MODE == 'accurate' else FAST_OCR_TIER.name
+
+def extract_page_text(img, lang: str, dpi: float = DEFAULT_PREPROCESSING.dpi,
+                      source: PageSource = None) -> Tuple[str, str]:
+    """
+    extracts the text of a page with the OCR tiers of OCR_MODE, see extract_page_lines
 
     Parameters
     ----------
-    text : str
-        test to filter
-    sequences_to_remove : Iterable[str]
-        sequences to remove
+    img : numpy.ndarray
+        preprocessed grayscale image of the page
+    lang : str
+        language code of the text
+    dpi : float, optional
+        resolution of the image, by default DEFAULT_PREPROCESSING.dpi
+    source : PageSource, optional
+        grayscale image the page was preprocessed from, by default None
 
     Returns
     -------
-    str
-        filtered text
+    Tuple[str, str]
+        extracted text and the name of the most accurate tier used for the whole page or some lines of it
     """
-    cleaned_text = text
-    for seq in sequences_to_remove:
-        cleaned_text = cleaned_text.replace(seq, '')
-    return cleaned_text
+    lines = extract_page_lines(img, lang, dpi, source)
+    return lines_to_text(line.words for line in lines), page_tier(lines)
 
-def extract_text(img_path: Path, lang: str) -> str:
+def count_missing_days(recognition: dict, lang: str) -> int:
     """
-    extracts the text from an image
+    counts the weekdays without food in a recognition, a recognition without any week misses all days of a week
 
     Parameters
     ----------
-    img_path : Path
-        path to the image file
+    recognition : dict
+        result of recognize_text
+    lang : str
+        language code of the menu
 
     Returns
     -------
-    str
-        extracted text
+    int
+        number of weekdays without food
     """
-    img = cv2.imread(str(img_path))
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    text = pytesseract.image_to_string(img, lang=LANGUAGE_CODE_CONVERTER[lang].pytesseract)
-    logging.debug('extracted text %s', text)
-    return text
+    if not recognition['weeks']:
+        return len(LANGUAGE_CODE_CONVERTER[lang].weekdays)
+    return sum(1 for week in recognition['weeks'] for food in week.values() if not food)
+
+def line_days(lines: List[OcrLine], lang: str) -> List[Optional[str]]:
+    """
+    assigns each line to the weekday whose header precedes it. Lines before the first header and after lines with
+    several weekdays, like the header row of a table, belong to no particular day.
+
+    Parameters
+    ----------
+    lines : List[OcrLine]
+        lines in reading order
+    lang : str
+        language code of the text
+
+    Returns
+    -------
+    List[Optional[str]]
+        weekday of each line, None if unknown
+    """
+    weekdays = set(LANGUAGE_CODE_CONVERTER[lang].weekdays)
+    days = []
+    day = None
+    for line in lines:
+        headers = [word.text.strip(':,.') for word in line.words if word.text.strip(':,.') in weekdays]
+        if headers:
+            day = headers[0] if len(headers) == 1 else None
+        days.append(day)
+    return days
+
+def escalate_missing_days(img, lang: str, lines: List[OcrLine], recognition: dict,
+                          dpi: float = DEFAULT_PREPROCESSING.dpi, source: PageSource = None) -> dict:
+    """
+    OCRs the lines of days missing in a recognition again with the line tier, if the fast tier read them with less
+    than MIN_DAY_LINE_CONFIDENCE. A day may miss because its header wasn't read, so the lines of the day before it and
+    of no particular day are escalated too. Days whose text is a closure marker are closed rather than misread, their
+    lines are skipped.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        preprocessed grayscale image of the page
+    lang : str
+        language code of the menu
+    lines : List[OcrLine]
+        lines the recognition was made of
+    recognition : dict
+        result of recognize_text for the lines
+    dpi : float, optional
+        resolution of the image, by default DEFAULT_PREPROCESSING.dpi
+    source : PageSource, optional
+        grayscale image the page was preprocessed from, by default None
+
+    Returns
+    -------
+    dict
+        recognition of the escalated lines if it misses less days, the given recognition otherwise
+    """
+    missing_days = count_missing_days(recognition, lang)
+    weekdays = LANGUAGE_CODE_CONVERTER[lang].weekdays
+    closure = get_closure_pattern(lang)
+    weeks = recognition['weeks'] or [{day: '' for day in weekdays}]
+    empty = {day for week in weeks for day, food in week.items() if not food}
+    closed = {day for week in weeks for day, food in week.items() if closure and closure.fullmatch(food)}
+    suspects = {None} | {weekdays[idx - 1] for idx, day in enumerate(weekdays) if day in empty and idx} | empty
+    indices = [
+        idx for idx, (line, day) in enumerate(zip(lines, line_days(lines, lang)))
+        if day in suspects - closed and line.tier == FAST_OCR_TIER.name
+        and mean_confidence(line.words) < MIN_DAY_LINE_CONFIDENCE
+    ]
+    if not indices:
+        return recognition
+    logging.info('%d days missing, escalating %d of %d lines', missing_days, len(indices), len(lines))
+    instrumentation.count('ocr_escalated_day_lines', len(indices))
+    lines = escalate_lines(img, lang, lines, indices, dpi, source)
+    escalated = recognize_text(lines_to_text(line.words for line in lines), lang)
+    return escalated if count_missing_days(escalated, lang) < missing_days else recognition
 
-def generate_menu(words: Iterable) -> Dict[str, str]:
+def segment_weeks(words: Iterable, lang: str, dated: Sequence[bool] = None) -> List[Dict[str, str]]:
     """
-    generates a dictionary with the menu
+    splits the words at the weekdays into the menus of consecutive weeks. A weekday which doesn't follow the previous
+    one starts the next week if it is dated or the previous week is complete, so plans covering several weeks are
+    parsed in one pass. Otherwise it is mentioned in the food, e.g. in a note, and kept as text.
 
     Parameters
     ----------
     words : Iterable
         list of word
+    lang : str
+        language code of the words
+    dated : Sequence[bool], optional
+        whether each weekday of the words is next to a date, see dated_weekdays, by default none is
+
+    Returns
+    -------
+    List[Dict[str, str]]
+        dictionaries with weekdays as keys and the food as values per week
+    """
+    weekdays = LANGUAGE_CODE_CONVERTER[lang].weekdays
+    day_indices = {day: idx for idx, day in enumerate(weekdays)}
+    texts = [word.text for word in words]
+    # Positions of the weekdays, everything before the first one is skipped
+    positions = [(pos, day_indices[text]) for pos, text in enumerate(texts) if text in day_indices]
+    if dated is None or len(dated) != len(positions):
+        if dated is not None:
+            logging.debug('%d dated weekdays given for %d weekdays, ignoring them', len(dated), len(positions))
+        dated = [False] * len(positions)
+
+    # Weekdays heading a day as position, index of the day and whether they start a week
+    headers = []
+    week_days = set()
+    for (pos, day_idx), is_dated in zip(positions, dated):
+        new_week = not headers or day_idx <= headers[-1][1]
+        if new_week and headers and not is_dated and len(week_days) < len(weekdays):
+            continue
+        if new_week:
+            week_days = set()
+        week_days.add(day_idx)
+        headers.append((pos, day_idx, new_week))
+
+    weeks = []
+    for idx, (pos, day_idx, new_week) in enumerate(headers):
+        if new_week:
+            weeks.append({day: [] for day in weekdays})
+        end = headers[idx + 1][0] if idx + 1 < len(headers) else len(texts)
+        weeks[-1][weekdays[day_idx]].append(' '.join(texts[pos + 1:end]))
+    return [{day: ' '.join(part for part in parts if part) for day, parts in week.items()} for week in weeks]
+
+def generate_menu(words: Iterable, lang: str = 'de') -> Dict[str, str]:
+    """
+    generates a dictionary with the menu of the first week
+
+    Parameters
+    ----------
+    words : Iterable
+        list of word
+    lang : str, optional
+        language code of the words, by default 'de'
 
     Returns
     -------
     Dict[str, str]
         dictionary with weekdays as keys and the food as values
     """
-    # Split by weekdays
-    # TODO make language agnostic
-    plan = {
-        'Montag': '',
-        'Dienstag': '',
-        'Mittwoch': '',
-        'Donnerstag': '',
-        'Freitag': ''
+    weeks = segment_weeks(words, lang)
+    if not weeks:
+        return {day: '' for day in LANGUAGE_CODE_CONVERTER[lang].weekdays}
+    return weeks[0]
+
+@lru_cache(maxsize=None)
+def compile_date_context(lang: str) -> Tuple[re.Pattern, re.Pattern, re.Pattern, re.Pattern, re.Pattern]:
+    """
+    compiles the patterns finding the dates of a menu
+
+    Parameters
+    ----------
+    lang : str
+        language code
+
+    Returns
+    -------
+    Tuple[re.Pattern, re.Pattern, re.Pattern, re.Pattern, re.Pattern]
+        patterns of a weekday as whole word, a date, a date following a weekday, a line starting with a date and a
+        weekday and a date following a range separator
+    """
+    code = LANGUAGE_CODE_CONVERTER[lang]
+    weekday = r'(?<![^\W\d_])(?:{:s})(?![^\W\d_])'.format('|'.join(code.weekdays))
+    return (
+        re.compile(weekday),
+        re.compile(code.date_pattern),
+        re.compile(code.weekday_date_gap + code.date_pattern),
+        # Dates before a weekday only head a day at the start of a line, otherwise they may be a code of the food
+        re.compile(r'^[^\S\n]*' + code.date_pattern + r'[^\w\n]{0,3}' + weekday, re.MULTILINE),
+        re.compile(code.range_separator + code.date_pattern)
+    )
+
+def dated_weekdays(text: str, lang: str) -> List[bool]:
+    """
+    finds the weekdays next to a date, e.g. 'Montag, 16.03.' or '16.03. Montag'
+
+    Parameters
+    ----------
+    text : str
+        recognized text
+    lang : str
+        language code of the text
+
+    Returns
+    -------
+    List[bool]
+        whether each weekday of the text is next to a date
+    """
+    weekday, _, weekday_date, date_weekday, _ = compile_date_context(lang)
+    # Weekdays preceded by a date are found by their end
+    preceded = {match.end() for match in date_weekday.finditer(text)}
+    return [
+        weekday_date.match(text, match.end()) is not None or match.end() in preceded
+        for match in weekday.finditer(text)
+    ]
+
+def find_menu_dates(text: str, lang: str) -> List[re.Match]:
+    """
+    finds the dates of a menu, which are those in the header before the first weekday, next to a weekday and in a
+    range like 'vom 16.03. bis 20.03.'. Other dates are usually codes, e.g. of allergens.
+
+    Parameters
+    ----------
+    text : str
+        recognized text
+    lang : str
+        language code of the text
+
+    Returns
+    -------
+    List[re.Match]
+        matches of the date pattern with the groups day, month and year in text order
+    """
+    weekday, date, weekday_date, date_weekday, range_date = compile_date_context(lang)
+    weekdays = list(weekday.finditer(text))
+    header_end = weekdays[0].start() if weekdays else len(text)
+    matches = list(date.finditer(text))
+    # Dates are accepted by their position in the text
+    accepted = {match.start() for match in matches if match.start() < header_end}
+    accepted.update(match.start('day') for match in date_weekday.finditer(text))
+    for match in weekdays:
+        dated = weekday_date.match(text, match.end())
+        if dated is not None:
+            accepted.add(dated.start('day'))
+    for match in matches:
+        second = range_date.match(text, match.end())
+        if second is not None:
+            accepted.update((match.start(), second.start('day')))
+    return [match for match in matches if match.start() in accepted]
+
+def find_start_date(text: str, lang: str, today: datetime.date = None) -> Optional[datetime.date]:
+    """
+    finds the monday of the week of the first menu date in the text, see find_menu_dates. Dates without year get the
+    first year given in the text, otherwise they are assumed to be the closest to today. Dates more than
+    MAX_DATE_WEEKS away from today are skipped.
+
+    Parameters
+    ----------
+    text : str
+        recognized text
+    lang : str
+        language code of the text
+    today : datetime.date, optional
+        reference date, by default today, which is the upload date of menus recognized on upload
+
+    Returns
+    -------
+    Optional[datetime.date]
+        monday of the first week or None if the text contains no valid date
+    """
+    today = today or datetime.date.today()
+    max_distance = datetime.timedelta(weeks=MAX_DATE_WEEKS)
+    matches = find_menu_dates(text, lang)
+    # Ranges often only give the year at the end, e.g. '16.03. - 20.03.2020'
+    explicit_years = [match.group('year') for match in matches if match.group('year')]
+    for match in matches:
+        day, month = int(match.group('day')), int(match.group('month'))
+        year = match.group('year') or (explicit_years[0] if explicit_years else None)
+        if year is not None:
+            years = [int(year) + 2000 if len(year) == 2 else int(year)]
+        else:
+            years = [today.year - 1, today.year, today.year + 1]
+        candidates = []
+        for candidate_year in years:
+            try:
+                candidate = datetime.date(candidate_year, month, day)
+            except ValueError:
+                continue
+            if abs(candidate - today) <= max_distance:
+                candidates.append(candidate)
+        if candidates:
+            date = min(candidates, key=lambda candidate: abs(candidate - today))
+            return date - datetime.timedelta(days=date.weekday())
+    return None
+
+def recognize_text(text: str, lang: str) -> dict:
+    """
+    recognizes the menus of all weeks in a text
+
+    Parameters
+    ----------
+    text : str
+        recognized text
+    lang : str
+        language code of the text
+
+    Returns
+    -------
+    dict
+        'weeks' with the menus of consecutive weeks and 'start' with the iso formatted monday of the first week, which
+        is None if the text contains no date
+    """
+    start = find_start_date(text, lang)
+    return {
+        'start': start.isoformat() if start else None,
+        'weeks': segment_weeks(process_document(text, lang), lang, dated_weekdays(text, lang))
     }
-    cur_day = ''
-    for word in words:
-        if word.text in plan:
-            cur_day = word.text
+
+def assign_weeks(recognition: dict, today: datetime.date = None) -> Dict[str, Dict[str, str]]:
+    """
+    keys the recognized menus by iso year and week, menus without date start with the current week
+
+    Parameters
+    ----------
+    recognition : dict
+        result of recognize_text
+    today : datetime.date, optional
+        reference date for menus without date, by default today
+
+    Returns
+    -------
+    Dict[str, Dict[str, str]]
+        menus by week key, e.g. '2020-W12'
+    """
+    if recognition['start'] is not None:
+        start = datetime.date.fromisoformat(recognition['start'])
+    else:
+        today = today or datetime.date.today()
+        start = today - datetime.timedelta(days=today.weekday())
+    return {
+        week_key(start + datetime.timedelta(weeks=idx)): menu for idx, menu in enumerate(recognition['weeks'])
+    }
+
+def menu_from_grid(grid: List[List[str]], lang: str) -> Optional[Dict[str, str]]:
+    """
+    generates the menu from the texts of the table cells. Cells starting with a weekday are headers, the food of a day
+    are the other cells in the header's column, or in its row if all headers are in one column.
+
+    Parameters
+    ----------
+    grid : List[List[str]]
+        rows of cell texts
+    lang : str
+        language code of the text
+
+    Returns
+    -------
+    Optional[Dict[str, str]]
+        dictionary with weekdays as keys and the food as values, None if no weekday header was found
+    """
+    weekdays = LANGUAGE_CODE_CONVERTER[lang].weekdays
+    headers = {}
+    for row_idx, row in enumerate(grid):
+        for col_idx, text in enumerate(row):
+            words = text.split()
+            day = words[0].strip(':,.') if words else None
+            if day in weekdays and day not in headers:
+                headers[day] = (row_idx, col_idx, ' '.join(words[1:]))
+    if not headers:
+        return None
+
+    days_in_columns = len({row_idx for row_idx, _, _ in headers.values()}) == 1
+    plan = {day: '' for day in weekdays}
+    for day, (row_idx, col_idx, rest) in headers.items():
+        if days_in_columns:
+            cells = [row[col_idx] for idx, row in enumerate(grid) if idx != row_idx]
+        else:
+            cells = [text for idx, text in enumerate(grid[row_idx]) if idx != col_idx]
+        words = process_document(' '.join([rest] + cells), lang)
+        plan[day] = ' '.join(word.text for word in words)
+    return plan
+
+def _split_chunk(chunk: str, abbreviations: frozenset) -> List[str]:
+    # Strip prefixes and suffixes until an abbreviation or the core of the chunk remains, then split its infixes.
+    # Suffixes are kept, units like the 'kg' of '50kg' are words.
+    suffixes = []
+    while chunk:
+        if chunk in abbreviations:
+            return suffixes[::-1]
+        match = TOKEN_PREFIX.search(chunk)
+        if match:
+            chunk = chunk[match.end():]
             continue
-        # Skip all before Montag
-        if cur_day == '':
+        match = TOKEN_SUFFIX.search(chunk)
+        if match:
+            chunk = chunk[:match.start()]
+            suffixes.append(match.group())
             continue
-        plan[cur_day] += word.text + ' '
+        break
+    if TOKEN_URL.match(chunk):
+        return suffixes[::-1]
+    pieces = TOKEN_INFIX.split(chunk)
+    # Like spaCy, an abbreviation after an infix keeps its period, e.g. 'Reis,ca.'
+    if suffixes and pieces[-1] + suffixes[-1] in abbreviations:
+        pieces.pop()
+        suffixes.pop()
+    return pieces + suffixes[::-1]
 
-    plan = {day: val.strip() for day, val in plan.items()}
-    return plan
+def regex_tokenize(text: str, lang: str) -> List[Word]:
+    """
+    splits a text into words like the spaCy tokenizer and keeps only the alphabetic ones
+
+    Parameters
+    ----------
+    text : str
+        text to tokenize
+    lang : str
+        language code of the text
+
+    Returns
+    -------
+    List[Word]
+        alphabetic words with more than one character
+    """
+    abbreviations = get_abbreviations(lang)
+    return [
+        Word(piece)
+        for chunk in text.split()
+        for piece in _split_chunk(chunk, abbreviations)
+        if piece.isalpha() and len(piece) > 1
+    ]
 
-def process_document(text: str, lang: str) -> Iterable:
+@instrumentation.timed('process_document')
+def process_document(text: str, lang: str, mode: str = None) -> Iterable:
     """
     processes given text as document and returns a list of word in the order they have been recognized
 
@@ -108,6 +1598,8 @@ def process_document(text: str, lang: str) -> Iterable:
         document as text
     lang : str
         language code of the text
+    mode : str, optional
+        tokenizer mode 'model', 'blank' or 'regex', by default TOKENIZER_MODE
 
     Returns
     -------
@@ -115,41 +1607,305 @@ def process_document(text: str, lang: str) -> Iterable:
         list of words
     """
     # Naive text filtering
-    # TODO get from anywhere
-    seqs_to_remove = [
-        'Kennzeichnung der Allergene',
-        'Einen frischen Obstteller gibt es jeden Taq / Nachtisch',
-        'Einen frischen Obstteller gibt es jeden Tag / Nachtisch',
-        'individuell',
-        'Kennzeichnung der Allergene',
-        'Vesper',
-        'GL'
-    ]
-    cleaned_text = filter_raw_text(text, seqs_to_remove)
+    cleaned_text = filter_raw_text(text, get_sequences_to_remove(lang))
 
-    nlp = spacy.load(LANGUAGE_CODE_CONVERTER[lang].spacy)
-    doc = nlp(cleaned_text)
-    tokens = [token for token in doc]
-    words = [token for token in tokens if token.is_alpha and len(token) > 1] # Remove abbreations
+    mode = mode or TOKENIZER_MODE
+    if mode == 'regex':
+        words = regex_tokenize(cleaned_text, lang)
+    else:
+        nlp = get_nlp(lang, mode)
+        doc = nlp(cleaned_text)
+        tokens = [token for token in doc]
+        words = [token for token in tokens if token.is_alpha and len(token) > 1] # Remove abbreations
     logging.debug('Found words: %s', words)
     return words
 
-def process_image(bucket_name: str, file_name: str, lang: str):
+def get_storage_client():
+    """
+    returns the storage client shared by all threads of the process
+
+    Returns
+    -------
+    google.cloud.storage.Client or backends.LocalStorageClient
+        storage client of the configured backend
+    """
+    global _storage_client
+    if _storage_client is None:
+        with _storage_client_lock:
+            if _storage_client is None:
+                _storage_client = backends.storage_client()
+    return _storage_client
+
+def get_ocr_pool() -> ProcessPoolExecutor:
+    """
+    returns the process pool for cell OCR shared by all threads of the process, its size is bounded by OCR_WORKERS
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        process pool
+    """
+    global _ocr_pool
+    if _ocr_pool is None:
+        with _ocr_pool_lock:
+            if _ocr_pool is None:
+                # Forking a multithreaded server process is unsafe, so the workers are spawned
+                _ocr_pool = ProcessPoolExecutor(OCR_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _ocr_pool
+
+def init_recognition_process(langs: Iterable[str]):
+    """
+    initializes a process of a pool running process_image, like the one of the pull worker. The pool already spreads
+    the images over the cores, so the cells are OCRed in the process itself instead of another nested pool.
+
+    Parameters
+    ----------
+    langs : Iterable[str]
+        language codes whose pipelines are loaded
+    """
+    global OCR_WORKERS
+    OCR_WORKERS = 1
+    preload_pipelines(langs)
+
+def recognize_grid(img, lang: str) -> Optional[dict]:
+    """
+    recognizes the menu by OCRing the cells of the menu table in parallel
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        preprocessed binary image
+    lang : str
+        language code of the menu
+
+    Returns
+    -------
+    Optional[dict]
+        recognized week like the result of recognize_text, None if no table grid was found
+    """
+    cells = find_grid_cells(img)
+    if not cells:
+        return None
+    crops = [img[y:y + height, x:x + width] for row in cells for x, y, width, height in row]
+    if OCR_WORKERS > 1:
+        recorded = get_ocr_pool().map(partial(instrumentation.run_recorded, extract_text), crops, repeat(lang))
+        texts = [instrumentation.replay(result) for result in recorded]
+    else:
+        texts = [extract_text(crop, lang) for crop in crops]
+    n_cols = len(cells[0])
+    grid = [texts[idx:idx + n_cols] for idx in range(0, len(texts), n_cols)]
+    menu = menu_from_grid(grid, lang)
+    if menu is None:
+        return None
+    start = find_start_date('\n'.join(texts), lang)
+    return {
+        'start': start.isoformat() if start else None,
+        'weeks': [menu]
+    }
+
+def process_image(bucket_name: str, file_name: str, lang: str) -> dict:
+    """
+    recognizes the menu of an image stored in cloud storage
+
+    Parameters
+    ----------
+    bucket_name : str
+        name of the bucket
+    file_name : str
+        name of the image blob
+    lang : str
+        language code of the menu
+
+    Returns
+    -------
+    dict
+        'weeks' with the menus of consecutive weeks and 'start' with the iso formatted monday of the first week, see
+        recognize_text
+    """
+    bucket = get_storage_client().bucket(bucket_name)
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    
-    # Download file
+    # Download into memory, the image is decoded straight from the buffer
     blob = bucket.blob(file_name)
-    with tempfile.TemporaryDirectory() as tmp_dir_name:
-        tmp_dir = Path(tmp_dir_name)
-        file_path = Path(file_name)
-        dest_name = tmp_dir / file_path.name
-        blob.download_to_filename(dest_name)
-        # OCR
-        text = extract_text(dest_name, lang)
     # blob.delete() # Delete image because it isn't needed anymore
+    with instrumentation.stage('download'):
+        data = blob.download_as_bytes()
+    return recognize_image(data, lang, file_name)
+
+def detect_format(data: bytes, file_name: str = '') -> str:
+    """
+    detects the format of an uploaded menu
+
+    Parameters
+    ----------
+    data : bytes
+        content of the upload
+    file_name : str, optional
+        name of the upload, plain text has no magic bytes and is detected by its extension
+
+    Returns
+    -------
+    str
+        'pdf', 'text' or 'image'
+    """
+    if data[:5] == b'%PDF-':
+        return 'pdf'
+    if file_name.lower().endswith('.txt'):
+        return 'text'
+    return 'image'
+
+def render_pdf_pages(data: bytes, dpi: int = DEFAULT_PREPROCESSING.dpi, max_side: int = MAX_IMAGE_SIDE,
+                     min_text: int = MIN_PDF_PAGE_TEXT) -> Iterator[Union[str, RenderedPage]]:
+    """
+    yields the pages of a PDF one at a time, either as embedded text or, for scanned pages, as grayscale image with
+    its resolution. Pages are only rendered when they are requested, so a document is never rasterized as a whole.
+
+    Parameters
+    ----------
+    data : bytes
+        content of the PDF
+    dpi : int, optional
+        resolution scanned pages are rendered at, by default DEFAULT_PREPROCESSING.dpi
+    max_side : int, optional
+        maximum length of the longer side of a rendered page, by default MAX_IMAGE_SIDE
+    min_text : int, optional
+        minimum number of embedded non whitespace characters of a text page, by default MIN_PDF_PAGE_TEXT
+
+    Yields
+    ------
+    Union[str, RenderedPage]
+        text or grayscale image of the page
+
+    Raises
+    ------
+    InvalidUpload
+        if the data cannot be opened as PDF
+    """
+    # PyMuPDF is only needed for PDF uploads
+    import fitz
+
+    try:
+        doc = fitz.open(stream=data, filetype='pdf')
+    except RuntimeError as e:
+        raise InvalidUpload(f'cannot open pdf: {e}') from e
+    with doc:
+        for page in doc:
+            text = page.getText()
+            if len(''.join(text.split())) >= min_text:
+                yield text
+                continue
+            zoom = min(dpi / 72, max_side / max(page.rect.width, page.rect.height))
+            pix = page.getPixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+            # Copied, so the pixmap is freed together with the page
+            img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width].copy()
+            del pix
+            yield RenderedPage(img, zoom * 72)
+
+def ocr_page(page: RenderedPage, lang: str) -> str:
+    """
+    preprocesses and OCRs a page rendered from a PDF at the resolution it was rendered at
+
+    Parameters
+    ----------
+    page : RenderedPage
+        grayscale image of the page and its resolution
+    lang : str
+        language code of the page
+
+    Returns
+    -------
+    str
+        extracted text
+    """
+    img, source, _ = preprocess_page(page.img, PDF_PAGE_PREPROCESSING)
+    return extract_page_text(img, lang, page.dpi, source)[0]
+
+@instrumentation.timed('extract_pdf_text')
+def extract_pdf_text(data: bytes, lang: str) -> str:
+    """
+    extracts the text of all pages of a PDF, embedded text is taken as is and scanned pages are OCRed in parallel.
+    Rendering is bounded by the OCR workers, at most OCR_WORKERS rendered pages are held in memory at once.
+
+    Parameters
+    ----------
+    data : bytes
+        content of the PDF
+    lang : str
+        language code of the document
+
+    Returns
+    -------
+    str
+        text of the pages in page order
+    """
+    texts = []
+    pending = {}
+    n_ocr = 0
+    for idx, page in enumerate(render_pdf_pages(data)):
+        if isinstance(page, str):
+            texts.append(page)
+            continue
+        n_ocr += 1
+        if OCR_WORKERS <= 1:
+            texts.append(ocr_page(page, lang))
+            continue
+        texts.append(None)
+        while len(pending) >= OCR_WORKERS:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                texts[pending.pop(future)] = instrumentation.replay(future.result())
+        pending[get_ocr_pool().submit(instrumentation.run_recorded, ocr_page, page, lang)] = idx
+        # Released before the next page is rendered
+        del page
+    for future, idx in pending.items():
+        texts[idx] = instrumentation.replay(future.result())
+    logging.info('extracted %d pdf pages, %d of them by OCR', len(texts), n_ocr)
+    return '\n'.join(texts)
+
+def recognize_image(data: bytes, lang: str, file_name: str = '') -> dict:
+    """
+    recognizes the menu of an upload, which is an encoded image, a PDF or plain text
+
+    Parameters
+    ----------
+    data : bytes
+        content of the upload
+    lang : str
+        language code of the menu
+    file_name : str, optional
+        name of the upload for the format detection and the log
+
+    Returns
+    -------
+    dict
+        recognized menus like the result of process_image
+
+    Raises
+    ------
+    InvalidUpload
+        if the upload is corrupt or has no text
+    """
+    upload_format = detect_format(data, file_name)
+    if upload_format == 'pdf':
+        return recognize_text(extract_pdf_text(data, lang), lang)
+    if upload_format == 'text':
+        text = data.decode('utf-8', errors='replace')
+        if not text.strip():
+            raise InvalidUpload('empty text')
+        return recognize_text(text, lang)
+
+    img = decode_image(data)
+    img, source, timings = preprocess_page(img)
+    logging.info('preprocessed %s in %s', file_name, timings)
+
+    if RECOGNITION_MODE == 'grid':
+        recognition = recognize_grid(img, lang)
+        if recognition is not None:
+            return recognition
+        logging.info('no menu table found in %s, falling back to page recognition', file_name)
 
-    words = process_document(text, lang)    
-    menu = generate_menu(words)
-    return menu
\ No newline at end of file
+    # OCR
+    lines = extract_page_lines(img, lang, source=source)
+    recognition = recognize_text(lines_to_text(line.words for line in lines), lang)
+    if OCR_MODE == 'adaptive' and count_missing_days(recognition, lang):
+        recognition = escalate_missing_days(img, lang, lines, recognition, source=source)
+    return recognition
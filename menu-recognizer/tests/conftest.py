@@ -0,0 +1,40 @@
+"""
+setup of the recognizer tests, which run against the local storage and the sqlite document store backend
+
+    cd menu-recognizer && python -m pytest tests
+"""
+from pathlib import Path
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+# In the container the shared modules are copied next to the service
+sys.path[:0] = [str(SERVICE_DIR), str(SERVICE_DIR.parent / 'common')]
+
+# The backends read their configuration on import, so it is set before any test module imports them
+_data_dir = Path(tempfile.mkdtemp(prefix='kita-menu-recognizer-tests-'))
+os.environ.update({
+    'STORAGE_BACKEND': 'local',
+    'LOCAL_STORAGE_DIR': str(_data_dir / 'storage'),
+    'DOCUMENT_STORE_BACKEND': 'sqlite',
+    'SQLITE_PATH': str(_data_dir / 'documents.sqlite3'),
+    # Neither the spacy model nor the tesseract languages are needed to import the service
+    'TOKENIZER_MODE': 'regex',
+    'PRELOAD_LANGUAGES': ''
+})
+
+
+@pytest.fixture
+def app():
+    import main
+    main.app.config['TESTING'] = True
+    return main.app
+
+@pytest.fixture
+def client(app):
+    with app.test_client() as client:
+        yield client
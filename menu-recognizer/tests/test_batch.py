@@ -0,0 +1,161 @@
+import threading
+import time
+
+import pytest
+
+import backends
+import batch
+import main
+import notifications
+from cache import cache_key
+from recognizer import get_storage_client
+
+
+MENU = {'start': None, 'weeks': [{'Montag': 'Nudeln'}]}
+
+
+@pytest.fixture
+def batch_jobs(monkeypatch):
+    jobs = batch.BatchJobs(processes=1)
+    monkeypatch.setattr(main, 'batch_jobs', jobs)
+    return jobs
+
+@pytest.fixture
+def blocked_batch(monkeypatch):
+    # The recognition is replaced, the endpoint only has to start and report the batch
+    calls = []
+    release = threading.Event()
+
+    def recognize_batch(bucket_name, names, prefix, lang, processes, downloads, use_cache=True):
+        calls.append((bucket_name, names, prefix, lang, processes, downloads, use_cache))
+        if not release.wait(10):
+            raise TimeoutError('the batch has not been released')
+        if bucket_name == 'broken':
+            raise ValueError('no such bucket')
+        return [{'name': name, 'status': 'cached', 'seconds': 0.0, 'error': None} for name in names]
+
+    monkeypatch.setattr(batch, 'recognize_batch', recognize_batch)
+    return calls, release
+
+def upload(name: str) -> backends.LocalBlob:
+    blob = get_storage_client().bucket('menus').blob(name)
+    blob.upload_from_string(b'Montag Nudeln')
+    blob.reload()
+    return blob
+
+def progress(user_id: str) -> dict:
+    return notifications.db.collection(u'progress').document(user_id).get().to_dict()
+
+def wait_for(client, location: str) -> dict:
+    for _ in range(100):
+        job = client.get(location).get_json()
+        if job['status'] != 'running':
+            return job
+        threading.Event().wait(0.05)
+    raise AssertionError('the batch is still running')
+
+
+def test_batch_runs_in_the_background(client, batch_jobs, blocked_batch):
+    calls, release = blocked_batch
+    response = client.post('/batch', json={'bucket': 'b', 'names': ['a.png', 'b.png'], 'use_cache': False})
+    assert response.status_code == 202
+    location = response.headers['Location']
+    assert client.get(location).get_json()['status'] == 'running'
+
+    release.set()
+    job = wait_for(client, location)
+    assert job['status'] == 'complete'
+    assert job['summary'] == {'cached': 2}
+    assert [item['name'] for item in job['items']] == ['a.png', 'b.png']
+    assert calls == [('b', ['a.png', 'b.png'], '', 'de', 1, 2, False)]
+
+def test_concurrent_batch_is_rejected(client, batch_jobs, blocked_batch):
+    calls, release = blocked_batch
+    first = client.post('/batch', json={'bucket': 'b', 'names': ['a.png']})
+    assert first.status_code == 202
+    assert client.post('/batch', json={'bucket': 'b', 'prefix': 'menus/'}).status_code == 409
+
+    release.set()
+    wait_for(client, first.headers['Location'])
+    second = client.post('/batch', json={'bucket': 'b', 'names': ['c.png']})
+    assert second.status_code == 202
+    wait_for(client, second.headers['Location'])
+    assert len(calls) == 2
+
+def test_failed_batch_is_reported(client, batch_jobs, blocked_batch):
+    calls, release = blocked_batch
+    release.set()
+    job = wait_for(client, client.post('/batch', json={'bucket': 'broken', 'names': []}).headers['Location'])
+    assert job['status'] == 'failed'
+    assert job['error'] == 'no such bucket'
+
+def test_invalid_batch_requests(client, batch_jobs):
+    assert client.post('/batch', json={'names': []}).status_code == 400
+    assert client.get('/batch/unknown').status_code == 404
+
+def test_batch_status_is_answered_by_other_instances(client, batch_jobs, blocked_batch, monkeypatch):
+    calls, release = blocked_batch
+    location = client.post('/batch', json={'bucket': 'b', 'names': ['a.png']}).headers['Location']
+    release.set()
+    wait_for(client, location)
+    # A poll reaching another instance, or the same one after it was recycled
+    monkeypatch.setattr(main, 'batch_jobs', batch.BatchJobs(processes=1))
+    job = client.get(location).get_json()
+    assert job['status'] == 'complete'
+    assert job['items'] == [{'name': 'a.png', 'status': 'cached', 'seconds': 0.0, 'error': None}]
+
+def test_batch_of_a_stopped_instance_is_failed(client, batch_jobs):
+    # The instance was stopped while the batch ran, so its heartbeat is three missed beats ago
+    batch_jobs._job_ref('stopped').set({'id': 'stopped', 'status': 'running', 'seconds': None, 'summary': None,
+                                        'items': None, 'error': None, 'heartbeat_at': time.time() - 3 * 60 - 1})
+    job = client.get('/batch/stopped').get_json()
+    assert job['status'] == 'failed'
+    assert job['error'] == 'the instance running the batch stopped'
+
+def test_batch_names_must_be_a_list_of_strings(client, batch_jobs, blocked_batch):
+    calls, _ = blocked_batch
+    assert client.post('/batch', json={'bucket': 'b', 'names': 'a.png'}).status_code == 400
+    assert client.post('/batch', json={'bucket': 'b', 'names': ['a.png', 1]}).status_code == 400
+    assert calls == []
+
+def test_batch_skips_objects_of_a_newer_upload():
+    blob = upload('newer.txt')
+    # A notification has finished a newer upload of the user
+    notifications.db.collection(u'progress').document('newer').set(
+        {'state': 'complete', 'version': 'newest', 'generation': int(blob.generation) + 1})
+    report = batch.recognize_batch('menus', ['newer.txt'], processes=1)
+    assert [item['status'] for item in report] == ['skipped']
+    assert progress('newer')['version'] == 'newest'
+
+def test_batch_doesnt_overwrite_a_claim_taken_over_meanwhile():
+    blob = upload('taken.txt')
+    version = str(blob.generation)
+    ref = notifications.db.collection(u'progress').document('taken')
+    notifications.claim_object(notifications.db.transaction(), ref, version, int(version), reprocess=True)
+    # A notification of a newer upload claims the object before the batch commits
+    newer = str(int(version) + 1)
+    assert notifications.claim_object(notifications.db.transaction(), ref, newer, int(newer)) == notifications.CLAIMED
+    item = {'name': 'taken.txt', 'status': 'cached', 'seconds': None, 'error': None}
+    batch.BatchWriter(1).add('taken', MENU, version, item)
+    assert item['status'] == 'skipped'
+    assert (progress('taken')['state'], progress('taken')['version']) == ('processing', newer)
+
+def test_batch_reprocesses_processed_objects_from_the_cache_by_crc32c(monkeypatch):
+    blob = upload('composite.txt')
+    notifications.db.collection(u'progress').document('composite').set(
+        {'state': 'complete', 'version': str(blob.generation), 'generation': int(blob.generation)})
+    # Composite objects have no md5 hash
+    get_blob = backends.LocalBucket.get_blob
+
+    def get_composite_blob(self, name):
+        composite = get_blob(self, name)
+        composite.md5_hash = None
+        return composite
+    monkeypatch.setattr(backends.LocalBucket, 'get_blob', get_composite_blob)
+    notifications.menu_cache.set(cache_key(blob.crc32c, 'de'), MENU)
+
+    report = batch.recognize_batch('menus', ['composite.txt'], processes=1)
+    assert [item['status'] for item in report] == ['cached']
+    assert progress('composite')['state'] == 'complete'
+    menu = notifications.db.collection(u'menus').document('composite').get().to_dict()
+    assert menu['menu'] == {'Montag': 'Nudeln'}
@@ -0,0 +1,28 @@
+import datetime
+
+import backends
+from cache import FirestoreMenuCache
+
+
+MENU = {'weeks': [{'Montag': 'Nudeln'}]}
+
+
+def test_expiry_is_a_timestamp_for_the_ttl_policy(request):
+    db = backends.document_store()
+    FirestoreMenuCache(db, ttl=60).set(request.node.name, MENU)
+    expires_at = db.collection(u'menu_cache').document(request.node.name).get().to_dict()['expires_at']
+    assert isinstance(expires_at, datetime.datetime)
+    assert expires_at > datetime.datetime.now(datetime.timezone.utc)
+    assert FirestoreMenuCache(db, ttl=60).get(request.node.name) == MENU
+
+def test_expired_entries_are_deleted_on_lookup(request):
+    db = backends.document_store()
+    cache = FirestoreMenuCache(db, ttl=-1)
+    cache.set(request.node.name, MENU)
+    assert cache.get(request.node.name) is None
+    assert not db.collection(u'menu_cache').document(request.node.name).get().exists
+
+def test_entries_with_a_unix_expiry_are_dropped(request):
+    db = backends.document_store()
+    db.collection(u'menu_cache').document(request.node.name).set({'expires_at': 4102444800.0, 'menu': MENU})
+    assert FirestoreMenuCache(db, ttl=60).get(request.node.name) is None
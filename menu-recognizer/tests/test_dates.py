@@ -0,0 +1,63 @@
+import datetime
+
+import pytest
+
+from recognizer import Word, dated_weekdays, find_start_date, segment_weeks
+
+
+TODAY = datetime.date(2020, 3, 18)
+
+
+def words(text: str) -> list:
+    return [Word(text) for text in text.split()]
+
+
+@pytest.mark.parametrize('text, today, start', [
+    ('SPEISEPLAN vom 16.03. bis 20.03.\nMontag Nudeln', TODAY, datetime.date(2020, 3, 16)),
+    ('Speiseplan 16.03. - 20.03.2020\nMontag Nudeln', TODAY, datetime.date(2020, 3, 16)),
+    ('Montag, den 24.03. Nudeln\nDienstag Reis', TODAY, datetime.date(2020, 3, 23)),
+    ('Montag Nudeln\n25.03. Dienstag Reis', TODAY, datetime.date(2020, 3, 23)),
+    ('Montag Nudeln vom 30.03. bis 03.04.', TODAY, datetime.date(2020, 3, 30)),
+    # Dates without year near the turn of the year belong to the closest year
+    ('Speiseplan 30.12.', datetime.date(2020, 1, 2), datetime.date(2019, 12, 30)),
+])
+def test_menu_dates(text, today, start):
+    assert find_start_date(text, 'de', today) == start
+
+@pytest.mark.parametrize('text', [
+    'Allergene 1.4.7.',
+    'Montag Nudeln (1.3.)\nDienstag Reis',
+    'Montag Nudeln 1.3. Dienstag Reis',
+    'Montag Nudeln\nDienstag Reis\nZusatzstoffe: 2.4., 3.5.',
+    # Too far from the upload, e.g. the plan of another year
+    'Speiseplan vom 16.03. bis 20.03.2018\nMontag Nudeln',
+    'Speiseplan 14.09.',
+])
+def test_codes_are_no_menu_dates(text):
+    assert find_start_date(text, 'de', TODAY) is None
+
+def test_dated_weekdays():
+    text = 'Montag, 16.03. Nudeln (1.3.) Dienstag Reis\n17.03. Mittwoch Suppe'
+    assert dated_weekdays(text, 'de') == [True, False, True]
+
+
+def test_weekday_in_note_doesnt_split():
+    week = 'Montag Nudeln Dienstag Reis Mittwoch Suppe Donnerstag Fisch Freitag Obst'
+    text = week.replace('Fisch', 'Fisch Montag geschlossen')
+    weeks = segment_weeks(words(text), 'de')
+    assert len(weeks) == 1
+    assert weeks[0]['Donnerstag'] == 'Fisch Montag geschlossen'
+    assert weeks[0]['Freitag'] == 'Obst'
+
+def test_complete_week_splits():
+    text = 'Montag A Dienstag B Mittwoch C Donnerstag D Freitag E Montag F Dienstag G'
+    weeks = segment_weeks(words(text), 'de')
+    assert [week['Montag'] for week in weeks] == ['A', 'F']
+    assert weeks[1]['Mittwoch'] == ''
+
+def test_dated_weekday_splits_incomplete_week():
+    text = 'Dienstag B Mittwoch C Montag F Dienstag G'
+    assert len(segment_weeks(words(text), 'de')) == 1
+    weeks = segment_weeks(words(text), 'de', [False, False, True, False])
+    assert [week['Dienstag'] for week in weeks] == ['B', 'G']
+    assert weeks[1]['Montag'] == 'F'
@@ -0,0 +1,47 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import pytest
+
+import instrumentation
+import recognizer
+
+
+MENU = 'Montag Nudeln mit Tomatensoße\nDienstag Reis mit Gemüse\n'.encode()
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    # Spawned processes read METRICS_ENABLED on import, this process has imported the module already
+    monkeypatch.setenv('METRICS_ENABLED', '1')
+    monkeypatch.setattr(instrumentation, 'METRICS_ENABLED', True)
+
+    def sample(name: str, labels: dict = None) -> float:
+        return instrumentation.registry().get_sample_value(f'kita_menu_{name}', labels or {}) or 0
+    return sample
+
+
+def test_metrics_are_collected_in_process(metrics):
+    hits, stages = metrics('test_hits_total'), metrics('stage_seconds_count', {'stage': 'test'})
+    instrumentation.count('test_hits', 2)
+    with instrumentation.stage('test'):
+        pass
+    assert metrics('test_hits_total') == hits + 2
+    assert metrics('stage_seconds_count', {'stage': 'test'}) == stages + 1
+
+def test_metrics_of_pool_processes_are_replayed(metrics):
+    stages = metrics('stage_seconds_count', {'stage': 'process_document'})
+    # Like the pull worker and the batches, recognition runs in a spawned process
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        recorded = pool.submit(instrumentation.run_recorded, recognizer.recognize_image, MENU, 'de', 'menu.txt')
+        recognition = instrumentation.replay(recorded.result())
+    assert recognition['weeks'][0]['Montag'] == 'Nudeln mit Tomatensoße'
+    assert metrics('stage_seconds_count', {'stage': 'process_document'}) == stages + 1
+
+def test_recording_doesnt_touch_the_registry(metrics):
+    hits = metrics('test_hits_total')
+    result, recorded = instrumentation.run_recorded(instrumentation.count, 'test_hits')
+    assert recorded == [('count', 'test_hits', 1)]
+    assert metrics('test_hits_total') == hits
+    instrumentation.replay((result, recorded))
+    assert metrics('test_hits_total') == hits + 1
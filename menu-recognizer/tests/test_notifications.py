@@ -0,0 +1,64 @@
+import base64
+import json
+import uuid
+
+import pytest
+
+import backends
+import notifications
+import recognizer
+
+
+@pytest.fixture
+def recognitions(monkeypatch):
+    # Counts the recognitions of the uploads, which are read from the local storage
+    calls = []
+    recognize_image = recognizer.recognize_image
+
+    def counting_recognize_image(data, lang, file_name=''):
+        calls.append(file_name)
+        return recognize_image(data, lang, file_name)
+    monkeypatch.setattr(recognizer, 'recognize_image', counting_recognize_image)
+    return calls
+
+def upload(name: str, data: bytes, generation: int = 1) -> dict:
+    recognizer.get_storage_client().bucket('menus').blob(name).upload_from_string(data)
+    return {'bucket': 'menus', 'name': name, 'generation': str(generation)}
+
+def push(client, notification: dict):
+    data = base64.b64encode(json.dumps(notification).encode()).decode()
+    return client.post('/', json={'message': {'data': data, 'messageId': str(uuid.uuid4())}})
+
+def progress(user_id: str) -> dict:
+    return notifications.db.collection(u'progress').document(user_id).get().to_dict()
+
+
+@pytest.mark.parametrize('name, data', [
+    ('corrupt-image.jpg', b'\xff\xd8 no jpeg'),
+    ('corrupt-pdf.pdf', b'%PDF-1.4 no pdf'),
+    ('empty-text.txt', b' \n'),
+])
+def test_broken_uploads_are_acked_once(client, recognitions, name, data):
+    if name.endswith('.pdf'):
+        pytest.importorskip('fitz')
+    notification = upload(name, data)
+    assert push(client, notification).status_code == 204
+    assert progress(name.split('.')[0])['state'] == 'failed'
+    # A redelivery of the same generation isn't recognized again
+    assert push(client, notification).status_code == 204
+    assert recognitions == [name]
+
+def test_transient_failures_are_redelivered(client, recognitions, monkeypatch):
+    notification = upload('flaky.txt', 'Montag Nudeln\nDienstag Reis'.encode())
+    download = backends.LocalBlob.download_as_bytes
+
+    def unavailable(self, *args, **kwargs):
+        raise ConnectionError('storage unavailable')
+    monkeypatch.setattr(backends.LocalBlob, 'download_as_bytes', unavailable)
+    assert push(client, notification).status_code == 500
+    assert progress('flaky')['state'] == 'retrying'
+
+    monkeypatch.setattr(backends.LocalBlob, 'download_as_bytes', download)
+    assert push(client, notification).status_code == 204
+    assert progress('flaky')['state'] == 'complete'
+    assert recognitions == ['flaky.txt']
@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+import pytest
+
+import recognizer
+from recognizer import OcrLine, OcrWord, PageSource
+
+
+class ScriptedBackend(recognizer.OcrBackend):
+    # Reads the text given per tier, whatever the image shows
+
+    def __init__(self, words_by_tier: dict):
+        self.words_by_tier = words_by_tier
+        self.calls = []
+
+    def image_to_words(self, img, lang, tier):
+        self.calls.append((tier.name, img.shape))
+        return self.words_by_tier[tier.name]
+
+
+def line(text: str, confidence: float, idx: int) -> OcrLine:
+    words = [OcrWord(word, confidence, (1, 1, idx), (10 * pos, 20 * idx, 8, 10))
+             for pos, word in enumerate(text.split())]
+    return OcrLine(words, (0, 20 * idx, 100, 20 * idx + 10), recognizer.FAST_OCR_TIER.name)
+
+def photo_page():
+    # Photo of a table with text, rotated by a few degrees
+    photo = np.full((1200, 1700), 230, np.uint8)
+    cv2.rectangle(photo, (150, 150), (1550, 1050), 30, 4)
+    for row in range(4):
+        cv2.putText(photo, f'Montag Nudeln {row}', (200, 300 + 200 * row), cv2.FONT_HERSHEY_SIMPLEX, 2, 40, 4)
+    rotation = cv2.getRotationMatrix2D((850, 600), 3, 1.0)
+    return cv2.warpAffine(photo, rotation, (1700, 1200), borderValue=230)
+
+
+def test_regions_are_rendered_from_the_grayscale_source():
+    gray = np.random.default_rng(0).integers(0, 256, (100, 100), dtype=np.uint8)
+    # The preprocessed image has half the resolution of the photo
+    source = PageSource(gray, np.diag([0.5, 0.5, 1]))
+    region = recognizer.render_region(np.zeros((50, 50), np.uint8), source, (10, 10, 30, 20), 2)
+    np.testing.assert_array_equal(region, recognizer.binarize(gray[20:40, 20:60]))
+
+def test_preprocessing_transform_maps_the_source_onto_the_page():
+    img, source, _ = recognizer.preprocess_page(photo_page())
+    rendered = recognizer.render_region(img, source, (0, 0, img.shape[1], img.shape[0]), 1)
+    assert rendered.shape == img.shape
+    assert np.mean(rendered == img) > 0.97
+
+def test_missing_days_escalate_only_their_uncertain_lines(monkeypatch):
+    lines = [
+        line('Montag Nudeln', 95, 0),
+        # The header of Tuesday is misread, so it is part of Monday
+        line('Dienstaq Reis', 60, 1),
+        line('Mittwoch', 95, 2),
+        # Wednesday is closed, its uncertain text is no reason to escalate
+        line('geschlossen', 40, 3),
+        # Thursday has no food
+        line('Donnerstag', 95, 4),
+        line('Freitag Fisch', 80, 5),
+    ]
+    backend = ScriptedBackend({'line': [OcrWord('Dienstag', 96, (1, 1, 1), (0, 0, 10, 10)),
+                                        OcrWord('Reis', 96, (1, 1, 1), (12, 0, 10, 10))]})
+    monkeypatch.setattr(recognizer, 'get_ocr_backend', lambda: backend)
+    recognition = recognizer.recognize_text(recognizer.lines_to_text(line.words for line in lines), 'de')
+    assert recognizer.count_missing_days(recognition, 'de') == 2
+
+    img = np.full((200, 200), 255, np.uint8)
+    escalated = recognizer.escalate_missing_days(img, 'de', lines, recognition, source=PageSource(img, np.eye(3)))
+    # Only the line of Tuesday's header is OCRed again, at the resolution of the line tier
+    margin = 0.05 * recognizer.DEFAULT_PREPROCESSING.dpi
+    scale = recognizer.LINE_OCR_TIER.dpi / recognizer.DEFAULT_PREPROCESSING.dpi
+    assert backend.calls == [('line', (round((10 + 2 * margin) * scale), round((100 + margin) * scale)))]
+    assert escalated['weeks'][0]['Dienstag'] == 'Reis'
+    assert escalated['weeks'][0]['Mittwoch'] == 'geschlossen'
+
+@pytest.mark.parametrize('text, closed', [
+    ('geschlossen', True),
+    ('Feiertag - Kita geschlossen', False),
+    ('Feiertag, geschlossen', True),
+    ('Nudeln', False),
+])
+def test_closure_markers(text, closed):
+    assert bool(recognizer.get_closure_pattern('de').fullmatch(text)) == closed
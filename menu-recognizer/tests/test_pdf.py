@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+import sys
+
+import numpy as np
+import pytest
+
+import recognizer
+
+
+class FakePage:
+    # Scanned page without embedded text in the size of the given points, like PyMuPDF renders it
+
+    def __init__(self, width: float, height: float):
+        self.rect = SimpleNamespace(width=width, height=height)
+
+    def getText(self):
+        return ''
+
+    def getPixmap(self, matrix, colorspace, alpha):
+        width, height = round(self.rect.width * matrix.zoom), round(self.rect.height * matrix.zoom)
+        return SimpleNamespace(samples=bytes(width * height), width=width, height=height, stride=width)
+
+class FakeDocument(list):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def fitz(monkeypatch):
+    # The lock pins a PyMuPDF with the camelCase API, so the document is faked to not depend on the installed one
+    pages = FakeDocument()
+    module = SimpleNamespace(
+        open=lambda stream, filetype: pages,
+        Matrix=lambda zoom_x, zoom_y: SimpleNamespace(zoom=zoom_x),
+        csGRAY='gray'
+    )
+    monkeypatch.setitem(sys.modules, 'fitz', module)
+    return pages
+
+
+@pytest.mark.parametrize('size, dpi', [
+    # A4 fits at the requested resolution
+    ((595, 842), 250),
+    # A0 is clamped to max_side, so it is rendered at a lower resolution
+    ((2384, 3370), 3000 / 3370 * 72),
+])
+def test_rendered_pages_have_their_actual_resolution(fitz, size, dpi):
+    fitz.append(FakePage(*size))
+    page, = recognizer.render_pdf_pages(b'%PDF-', dpi=250, max_side=3000)
+    assert page.dpi == pytest.approx(dpi)
+    assert max(page.img.shape) <= 3000
+
+def test_pages_are_ocred_at_their_rendered_resolution(monkeypatch):
+    resolutions = []
+    monkeypatch.setattr(recognizer, 'preprocess_page', lambda img, config: (img, None, {}))
+    monkeypatch.setattr(recognizer, 'extract_page_text',
+                        lambda img, lang, dpi, source: resolutions.append(dpi) or ('', ''))
+    recognizer.ocr_page(recognizer.RenderedPage(np.zeros((10, 10), np.uint8), 63.4), 'de')
+    assert resolutions == [63.4]
@@ -0,0 +1,49 @@
+import importlib.util
+
+import pytest
+
+from benchmark import FIXTURES_DIR, SAMPLE_TEXT, check_tokenizer_conformance
+from recognizer import LANGUAGE_CODE_CONVERTER, process_document
+
+
+FIXTURES = {path.name: path.read_text(encoding='utf-8') for path in sorted(FIXTURES_DIR.glob('*.txt'))}
+FIXTURES['sample'] = SAMPLE_TEXT
+
+
+def spacy_modes(lang: str) -> list:
+    # The spaCy modes are only compared where spaCy, respectively its model, is installed
+    modes = []
+    if importlib.util.find_spec('spacy'):
+        modes.append('blank')
+        if importlib.util.find_spec(LANGUAGE_CODE_CONVERTER[lang].spacy):
+            modes.append('model')
+    return modes
+
+def words(text: str, mode: str) -> list:
+    return [word.text for word in process_document(text, 'de', mode)]
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('Obst(Banane)', ['Obst', 'Banane']),
+    ('Tee!Saft?', ['Tee', 'Saft']),
+    ('Reis,Gemüse', ['Reis', 'Gemüse']),
+    ('„Kräuterdip“Rohkost', ['Kräuterdip', 'Rohkost']),
+    ('Kartoffeln/Quark', ['Kartoffeln', 'Quark']),
+    ('Hirse--Bratling', ['Hirse', 'Bratling']),
+    ('Grießbrei.Kirschen', ['Grießbrei', 'Kirschen']),
+    # Like spaCy, pipes stay glued to the words
+    ('°Nudeln° {Reis} #Suppe_ |Milch|', ['Nudeln', 'Reis', 'Suppe']),
+    ('Brot ca. 50kg', ['Brot', 'kg']),
+    ('www.kita-sonne.de/speiseplan', []),
+])
+def test_regex_splits_glued_punctuation(text, expected):
+    assert words(text, 'regex') == expected
+
+@pytest.mark.parametrize('name', sorted(FIXTURES))
+@pytest.mark.parametrize('mode', spacy_modes('de') or [pytest.param('blank', marks=pytest.mark.skip('no spaCy'))])
+def test_regex_words_conform_to_spacy(name, mode):
+    assert words(FIXTURES[name], 'regex') == words(FIXTURES[name], mode)
+
+@pytest.mark.skipif(not spacy_modes('de'), reason='no spaCy')
+def test_tokenizer_modes_generate_the_same_menus():
+    assert check_tokenizer_conformance(FIXTURES, 'de', ['regex'] + spacy_modes('de')) == []
@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import instrumentation
+import worker
+from notifications import ObjectInProcessing
+
+
+NOTIFICATION = json.dumps({'bucket': 'menus', 'name': 'menu.jpg'}).encode()
+
+
+class RecordingSource(worker.QueueSource):
+    # QueueSource remembering the ack deadline extensions
+
+    def __init__(self):
+        super().__init__()
+        self.deadlines = []
+
+    async def modify_ack_deadline(self, ack_ids, seconds):
+        self.deadlines.append((list(ack_ids), seconds))
+        await super().modify_ack_deadline(ack_ids, seconds)
+
+
+@pytest.fixture(autouse=True)
+def fast_worker(monkeypatch):
+    # The handler is replaced in the tests, so no process is ever used
+    monkeypatch.setattr(worker.Worker, '_create_pool', lambda self: ThreadPoolExecutor(1))
+    # The worker only sees the stop after the running pull
+    monkeypatch.setattr(worker, 'PULL_TIMEOUT', 0.05)
+
+def handle_with(monkeypatch, handler):
+    monkeypatch.setattr(worker, 'handle_notification', lambda data, message_id, recognize: handler(message_id))
+
+async def run_worker(source_worker: worker.Worker, until, timeout: float = 5):
+    # Runs the worker until the condition on it holds, then stops it and waits for the messages in flight
+    stop = asyncio.Event()
+    run = asyncio.get_running_loop().create_task(source_worker.run(stop))
+    deadline = time.monotonic() + timeout
+    while not until(source_worker):
+        assert time.monotonic() < deadline, source_worker.metrics
+        await asyncio.sleep(0.01)
+    stop.set()
+    await run
+
+
+def test_processed_messages_are_acked(monkeypatch):
+    handle_with(monkeypatch, lambda message_id: True)
+
+    async def test():
+        source = worker.QueueSource()
+        for _ in range(3):
+            await source.publish(NOTIFICATION)
+        await source.publish(b'no notification')
+        await run_worker(worker.Worker(source, max_in_flight=2), lambda w: w.metrics['acked'] == 4)
+        assert source.queue.empty() and not source._unacked
+
+    asyncio.run(test())
+
+def test_failed_messages_are_redelivered_after_a_delay(monkeypatch):
+    attempts = []
+
+    def handler(message_id):
+        attempts.append(message_id)
+        if len(attempts) == 1:
+            raise RuntimeError('store unavailable')
+        return True
+    handle_with(monkeypatch, handler)
+
+    async def test():
+        source = RecordingSource()
+        message_id = await source.publish(NOTIFICATION)
+        w = worker.Worker(source)
+        await run_worker(w, lambda w: w.metrics['retried'] == 1)
+        # Not nacked, which would redeliver at once, but left leased for the retry delay
+        assert source.deadlines == [([message_id], worker.RETRY_DELAY)]
+        assert source.queue.empty() and list(source._unacked) == [message_id]
+        # The delay passes
+        source._cancel_deadline(message_id)
+        source._redeliver(message_id)
+        await run_worker(w, lambda w: w.metrics['acked'] == 1)
+        assert attempts == [message_id, message_id]
+        assert w.metrics['failed'] == 1
+
+    asyncio.run(test())
+
+@pytest.mark.parametrize('delivery_attempt, delay', [
+    # Unknown without a dead letter topic
+    (0, 10),
+    (1, 10),
+    (2, 20),
+    (4, 80),
+    (100, worker.MAX_ACK_DEADLINE),
+])
+def test_retry_delay_doubles_with_every_attempt(monkeypatch, delivery_attempt, delay):
+    monkeypatch.setattr(worker, 'RETRY_DELAY', 10)
+    assert worker.retry_delay(delivery_attempt) == delay
+
+def test_redeliveries_count_as_delivery_attempts():
+    async def test():
+        source = worker.QueueSource()
+        await source.publish(NOTIFICATION)
+        message, = await source.pull(1, timeout=1)
+        assert message.delivery_attempt == 1
+        await source.nack([message.ack_id])
+        message, = await source.pull(1, timeout=1)
+        assert message.delivery_attempt == 2
+
+    asyncio.run(test())
+
+def test_deferred_messages_stay_leased_by_the_other_attempt(monkeypatch):
+    def handler(message_id):
+        raise ObjectInProcessing(30)
+    handle_with(monkeypatch, handler)
+
+    async def test():
+        source = RecordingSource()
+        await source.publish(NOTIFICATION)
+        await run_worker(worker.Worker(source), lambda w: w.metrics['deferred'] == 1)
+        # Neither acked nor nacked, the message stays leased until the other attempt's lease expired
+        assert source.deadlines == [(['0'], 30)]
+        assert source.queue.empty() and list(source._unacked) == ['0']
+        source._cancel_deadline('0')
+
+    asyncio.run(test())
+
+def test_pulling_stops_at_max_in_flight(monkeypatch):
+    release = threading.Event()
+    handle_with(monkeypatch, lambda message_id: release.wait(5))
+
+    async def test():
+        source = worker.QueueSource()
+        for _ in range(5):
+            await source.publish(NOTIFICATION)
+        w = worker.Worker(source, max_in_flight=2)
+        stop = asyncio.Event()
+        run = asyncio.get_running_loop().create_task(w.run(stop, metrics_interval=0.01))
+        while w.metrics['in_flight'] < 2:
+            await asyncio.sleep(0.01)
+        # Some time for the worker to pull more, which it must not
+        await asyncio.sleep(0.1)
+        assert w.metrics['received'] == 2 and source.queue.qsize() == 3
+        assert w.metrics['queue_depth'] == 3
+        release.set()
+        while w.metrics['acked'] < 5:
+            await asyncio.sleep(0.01)
+        stop.set()
+        await run
+        assert w.metrics['received'] == 5
+
+    asyncio.run(test())
+
+def test_ack_deadlines_are_extended_while_in_flight(monkeypatch):
+    handle_with(monkeypatch, lambda message_id: time.sleep(0.5))
+
+    async def test():
+        source = RecordingSource()
+        await source.publish(NOTIFICATION)
+        # The deadline is renewed after half of it, so it never passes while the message is processed
+        w = worker.Worker(source, ack_deadline=0.2)
+        await run_worker(w, lambda w: w.metrics['acked'] == 1)
+        assert len(source.deadlines) >= 2
+        assert all(deadline == (['0'], 0.2) for deadline in source.deadlines)
+        assert w.metrics['received'] == 1 and source.queue.empty()
+
+    asyncio.run(test())
+
+def test_metrics_are_exported(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'METRICS_ENABLED', True)
+    handle_with(monkeypatch, lambda message_id: True)
+
+    def sample(name: str) -> float:
+        return instrumentation.registry().get_sample_value(f'kita_menu_worker_{name}') or 0
+
+    async def test():
+        source = worker.QueueSource()
+        acked = sample('acked_total')
+        for _ in range(2):
+            await source.publish(NOTIFICATION)
+        await run_worker(worker.Worker(source), lambda w: w.metrics['acked'] == 2)
+        assert sample('acked_total') == acked + 2
+        assert sample('in_flight') == 0
+
+    asyncio.run(test())
@@ -0,0 +1,406 @@
+"""
+pull worker for the storage notifications, an alternative to the push endpoint in main.py
+
+The push endpoint holds a gunicorn thread for the whole recognition and every burst of uploads is pushed at once. The
+worker instead pulls at most as many messages as it has free slots (MAX_IN_FLIGHT), waits for I/O with asyncio and
+runs the CPU bound recognition in a process pool sized to the cores, so throughput scales with the cores instead of
+being bound by the GIL. The ack deadline of messages in flight is extended until they are done, e.g.
+
+    python worker.py --subscription projects/<project>/subscriptions/menu-recognizer --max-in-flight 8
+
+Messages whose processing failed are neither acked nor nacked right away. Their ack deadline is set to a delay, which
+doubles with every delivery attempt from RETRY_DELAY up to 600 s, so a failing store isn't hammered by redeliveries.
+The attempts are counted by Pub/Sub if the subscription has a dead letter topic, which also ends the retries of a
+message after its max delivery attempts, see the README for setting them up.
+
+The subscription is pulled from the Pub/Sub emulator if PUBSUB_EMULATOR_HOST is set. QueueSource provides the same
+interface with an in-process queue. The queue depth metric of a subscription is its num_undelivered_messages in Cloud
+Monitoring, which isn't available for the emulator. With METRICS_ENABLED=1 the metrics are served for Prometheus on
+METRICS_PORT as kita_menu_worker_<metric> gauges and counters.
+"""
+from typing import Dict, List, Optional
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import asyncio
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import instrumentation
+from recognizer import init_recognition_process, process_image
+from notifications import (
+    PRELOAD_LANGUAGES, InvalidNotification, ObjectInProcessing, decode_notification, handle_notification)
+
+
+PUBSUB_SUBSCRIPTION = os.getenv('PUBSUB_SUBSCRIPTION')
+# Maximum number of messages which are pulled but not yet acked
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', 2 * (os.cpu_count() or 1)))
+RECOGNITION_PROCESSES = int(os.getenv('RECOGNITION_PROCESSES', os.cpu_count() or 1))
+# Seconds the ack deadline of messages in flight is extended by, it is renewed after half of it
+ACK_DEADLINE = int(os.getenv('ACK_DEADLINE', 60))
+PULL_TIMEOUT = float(os.getenv('PULL_TIMEOUT', 10))
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 60))
+# Seconds the first redelivery of a failed message is delayed by, doubled with every further delivery attempt
+RETRY_DELAY = int(os.getenv('RETRY_DELAY', 10))
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9090))
+# Seconds back the queue depth is looked up, Cloud Monitoring samples it every minute and lags behind by a few
+QUEUE_DEPTH_WINDOW = int(os.getenv('QUEUE_DEPTH_WINDOW', 300))
+# Bounds of the ack deadline in seconds Pub/Sub accepts
+MIN_ACK_DEADLINE = 10
+MAX_ACK_DEADLINE = 600
+
+# delivery_attempt counts from 1, Pub/Sub only counts for subscriptions with a dead letter topic and sends 0 otherwise
+Message = namedtuple('Message', ['ack_id', 'message_id', 'data', 'delivery_attempt'])
+
+
+class QueueSource:
+    """
+    in-process message source, e.g. to run the worker without Pub/Sub. Nacked messages are queued again, like
+    messages whose ack deadline has been set and passed, and their delivery attempts are counted. Must be created in
+    the event loop of the worker.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self._ids = itertools.count()
+        self._unacked: Dict[str, Message] = {}
+        self._deadlines: Dict[str, asyncio.TimerHandle] = {}
+
+    async def publish(self, data: bytes) -> str:
+        message_id = str(next(self._ids))
+        await self.queue.put(Message(message_id, message_id, data, 1))
+        return message_id
+
+    async def pull(self, max_messages: int, timeout: float) -> List[Message]:
+        try:
+            messages = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(messages) < max_messages and not self.queue.empty():
+            messages.append(self.queue.get_nowait())
+        for message in messages:
+            self._unacked[message.ack_id] = message
+        return messages
+
+    async def ack(self, ack_ids: List[str]):
+        for ack_id in ack_ids:
+            self._cancel_deadline(ack_id)
+            self._unacked.pop(ack_id, None)
+
+    async def nack(self, ack_ids: List[str]):
+        for ack_id in ack_ids:
+            self._redeliver(ack_id)
+
+    async def modify_ack_deadline(self, ack_ids: List[str], seconds: int):
+        loop = asyncio.get_running_loop()
+        for ack_id in ack_ids:
+            if ack_id in self._unacked:
+                self._cancel_deadline(ack_id)
+                self._deadlines[ack_id] = loop.call_later(seconds, self._redeliver, ack_id)
+
+    def _cancel_deadline(self, ack_id: str):
+        handle = self._deadlines.pop(ack_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _redeliver(self, ack_id: str):
+        self._cancel_deadline(ack_id)
+        message = self._unacked.pop(ack_id, None)
+        if message is not None:
+            self.queue.put_nowait(message._replace(delivery_attempt=message.delivery_attempt + 1))
+
+    async def depth(self) -> Optional[int]:
+        return self.queue.qsize()
+
+
+class PubSubSource:
+    """
+    message source pulling a Pub/Sub subscription, the blocking client calls are run in the default executor
+    """
+
+    def __init__(self, subscription: str):
+        from google.cloud import pubsub_v1
+        self.subscription = subscription
+        self.client = pubsub_v1.SubscriberClient()
+        self._monitoring = None
+
+    async def _call(self, method, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(method, subscription=self.subscription, **kwargs))
+
+    async def pull(self, max_messages: int, timeout: float) -> List[Message]:
+        from google.api_core import exceptions
+        try:
+            response = await self._call(self.client.pull, max_messages=max_messages, timeout=timeout)
+        except exceptions.DeadlineExceeded:
+            return []
+        return [
+            Message(received.ack_id, received.message.message_id, received.message.data, received.delivery_attempt)
+            for received in response.received_messages
+        ]
+
+    async def ack(self, ack_ids: List[str]):
+        await self._call(self.client.acknowledge, ack_ids=ack_ids)
+
+    async def nack(self, ack_ids: List[str]):
+        await self.modify_ack_deadline(ack_ids, 0)
+
+    async def modify_ack_deadline(self, ack_ids: List[str], seconds: int):
+        await self._call(self.client.modify_ack_deadline, ack_ids=ack_ids, ack_deadline_seconds=seconds)
+
+    async def depth(self) -> Optional[int]:
+        if os.getenv('PUBSUB_EMULATOR_HOST'):
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._undelivered_messages)
+        except Exception as e:
+            # The metric is only logged, so the worker keeps running without it
+            logging.warning('reading the queue depth of %s failed: %s', self.subscription, e)
+            return None
+
+    def _undelivered_messages(self) -> Optional[int]:
+        # The backlog of a subscription is only available from Cloud Monitoring
+        from google.cloud import monitoring_v3
+        if self._monitoring is None:
+            self._monitoring = monitoring_v3.MetricServiceClient()
+        # The subscription is projects/<project>/subscriptions/<subscription id>
+        project, subscription_id = self.subscription.split('/')[1::2]
+        now = int(time.time())
+        interval = monitoring_v3.types.TimeInterval()
+        interval.end_time.seconds = now
+        interval.start_time.seconds = now - QUEUE_DEPTH_WINDOW
+        series = self._monitoring.list_time_series(
+            self._monitoring.project_path(project),
+            'metric.type = "pubsub.googleapis.com/subscription/num_undelivered_messages" AND '
+            'resource.labels.subscription_id = "{:s}"'.format(subscription_id),
+            interval,
+            monitoring_v3.enums.ListTimeSeriesRequest.TimeSeriesView.FULL)
+        for time_series in series:
+            # The points are sorted newest first
+            if time_series.points:
+                return time_series.points[0].value.int64_value
+        return None
+
+
+def retry_delay(delivery_attempt: int) -> int:
+    """
+    returns the seconds a failed message is redelivered after, RETRY_DELAY doubled with every further attempt
+
+    Parameters
+    ----------
+    delivery_attempt : int
+        delivery attempt of the message, 0 if unknown
+
+    Returns
+    -------
+    int
+        delay within the bounds of the ack deadline
+    """
+    delay = RETRY_DELAY * 2 ** min(max(delivery_attempt - 1, 0), 16)
+    return int(min(max(delay, MIN_ACK_DEADLINE), MAX_ACK_DEADLINE))
+
+
+class Worker:
+    """
+    processes the storage notifications of a message source with bounded concurrency
+
+    Parameters
+    ----------
+    source : QueueSource or PubSubSource
+        source of the messages
+    max_in_flight : int, optional
+        maximum number of messages pulled but not yet acked, by default MAX_IN_FLIGHT
+    processes : int, optional
+        size of the recognition process pool, by default RECOGNITION_PROCESSES
+    ack_deadline : int, optional
+        seconds the ack deadline of messages in flight is extended by, by default ACK_DEADLINE
+    """
+
+    def __init__(self, source, max_in_flight: int = MAX_IN_FLIGHT, processes: int = RECOGNITION_PROCESSES,
+                 ack_deadline: int = ACK_DEADLINE):
+        self.source = source
+        self.max_in_flight = max_in_flight
+        self.processes = processes
+        self.ack_deadline = ack_deadline
+        self.metrics = {
+            'in_flight': 0,
+            'queue_depth': None,
+            'received': 0,
+            'acked': 0,
+            'retried': 0,
+            'failed': 0,
+            'invalid': 0,
+            'deferred': 0
+        }
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._slot_freed = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._threads = None
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        # Forking a process with threads is unsafe, so the workers are spawned
+        return ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_recognition_process, initargs=(PRELOAD_LANGUAGES,))
+
+    def _recognize(self, bucket_name: str, file_name: str, lang: str) -> dict:
+        # Called from a thread of self._threads, which waits for the process
+        pool = self._pool
+        try:
+            return instrumentation.replay(
+                pool.submit(instrumentation.run_recorded, process_image, bucket_name, file_name, lang).result())
+        except BrokenProcessPool:
+            # A crashed process, e.g. killed for its memory, breaks the whole pool
+            with self._pool_lock:
+                if self._pool is pool:
+                    logging.error('replacing broken recognition process pool')
+                    self._pool = self._create_pool()
+            raise
+
+    async def _process(self, message: Message):
+        try:
+            data = decode_notification(message.data)
+        except InvalidNotification as e:
+            # Redelivering won't make the message valid
+            logging.error('dropping message %s: %s', message.message_id, e)
+            self._count('invalid')
+            await self.source.ack([message.ack_id])
+            self._count('acked')
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            # The document store clients block, so the handler runs in a thread and only the recognition in a process
+            await loop.run_in_executor(
+                self._threads, functools.partial(handle_notification, data, message.message_id, self._recognize))
+        except ObjectInProcessing as e:
+            # Neither acked nor nacked right away, the message is redelivered once the lease of the other attempt
+            # has expired, in case that attempt died without releasing it
+            logging.info('deferring message %s: %s', message.message_id, e)
+            self._count('deferred')
+            delay = int(min(max(e.retry_after, MIN_ACK_DEADLINE), MAX_ACK_DEADLINE))
+            await self.source.modify_ack_deadline([message.ack_id], delay)
+        except Exception as e:
+            logging.exception(e)
+            self._count('failed')
+            # A nack would redeliver at once, while the cause like an unavailable store most likely persists
+            delay = retry_delay(message.delivery_attempt)
+            logging.info('retrying message %s of attempt %d in %d s', message.message_id, message.delivery_attempt,
+                         delay)
+            await self.source.modify_ack_deadline([message.ack_id], delay)
+            self._count('retried')
+        else:
+            await self.source.ack([message.ack_id])
+            self._count('acked')
+
+    def _count(self, name: str, amount: int = 1):
+        self.metrics[name] += amount
+        instrumentation.count(f'worker_{name}', amount)
+
+    def _set(self, name: str, value: Optional[int]):
+        self.metrics[name] = value
+        if value is not None:
+            instrumentation.gauge(f'worker_{name}', value)
+
+    def _on_done(self, ack_id: str, task: asyncio.Task):
+        del self._tasks[ack_id]
+        self._set('in_flight', len(self._tasks))
+        self._slot_freed.set()
+
+    async def _extend_ack_deadlines(self):
+        while True:
+            await asyncio.sleep(self.ack_deadline / 2)
+            if self._tasks:
+                try:
+                    await self.source.modify_ack_deadline(list(self._tasks), self.ack_deadline)
+                except Exception as e:
+                    logging.exception(e)
+
+    async def _log_metrics(self, interval: float):
+        while True:
+            self._set('queue_depth', await self.source.depth())
+            logging.info('worker metrics: %s', self.metrics)
+            await asyncio.sleep(interval)
+
+    async def run(self, stop: asyncio.Event, metrics_interval: float = METRICS_INTERVAL):
+        """
+        pulls and processes messages until stop is set, then waits for the messages in flight
+
+        Parameters
+        ----------
+        stop : asyncio.Event
+            event to stop pulling
+        metrics_interval : float, optional
+            seconds between two logs of the metrics, by default METRICS_INTERVAL
+        """
+        loop = asyncio.get_running_loop()
+        self._slot_freed = asyncio.Event()
+        self._pool = self._create_pool()
+        self._threads = ThreadPoolExecutor(self.max_in_flight)
+        background = [
+            loop.create_task(self._extend_ack_deadlines()),
+            loop.create_task(self._log_metrics(metrics_interval))
+        ]
+        try:
+            while not stop.is_set():
+                free_slots = self.max_in_flight - len(self._tasks)
+                if free_slots <= 0:
+                    # Backpressure, nothing is pulled until a message is done
+                    self._slot_freed.clear()
+                    _, pending = await asyncio.wait(
+                        [loop.create_task(self._slot_freed.wait()), loop.create_task(stop.wait())],
+                        return_when=asyncio.FIRST_COMPLETED)
+                    for task in pending:
+                        task.cancel()
+                    continue
+                try:
+                    messages = await self.source.pull(free_slots, PULL_TIMEOUT)
+                except Exception as e:
+                    logging.exception(e)
+                    await asyncio.sleep(1)
+                    continue
+                self._count('received', len(messages))
+                for message in messages:
+                    task = loop.create_task(self._process(message))
+                    self._tasks[message.ack_id] = task
+                    task.add_done_callback(functools.partial(self._on_done, message.ack_id))
+                self._set('in_flight', len(self._tasks))
+
+            if self._tasks:
+                await asyncio.wait(list(self._tasks.values()))
+        finally:
+            for task in background:
+                task.cancel()
+            self._threads.shutdown()
+            self._pool.shutdown()
+
+
+def main(subscription: str, max_in_flight: int, processes: int, ack_deadline: int):
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    instrumentation.start_metrics_server(METRICS_PORT)
+    worker = Worker(PubSubSource(subscription), max_in_flight, processes, ack_deadline)
+    loop.run_until_complete(worker.run(stop))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscription', default=PUBSUB_SUBSCRIPTION, required=PUBSUB_SUBSCRIPTION is None,
+                        help='full path of the subscription, by default PUBSUB_SUBSCRIPTION')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument('--processes', type=int, default=RECOGNITION_PROCESSES)
+    parser.add_argument('--ack-deadline', type=int, default=ACK_DEADLINE)
+    args = parser.parse_args()
+    main(args.subscription, args.max_in_flight, args.processes, args.ack_deadline)
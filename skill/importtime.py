@@ -0,0 +1,101 @@
+"""
+cold start check of the skill
+
+Imports the skill in a fresh interpreter with python -X importtime, like a new instance does before it can answer the
+first request, prints the slowest imports and exits with a non-zero status if the total import time exceeds the
+budget, e.g.
+
+    python importtime.py --budget-ms 1500
+
+The clients are created lazily for the check (CLIENT_STARTUP=lazy), so only the imports on the path to the first
+request are measured. tests/test_importtime.py checks the same budget.
+"""
+from typing import List
+from collections import namedtuple
+from pathlib import Path
+import argparse
+import os
+import subprocess
+import sys
+
+
+# Total import time in milliseconds the skill has to stay below
+IMPORT_TIME_BUDGET_MS = float(os.getenv('IMPORT_TIME_BUDGET_MS', 1500))
+
+SKILL_DIR = Path(__file__).resolve().parent
+COMMON_DIR = SKILL_DIR.parent / 'common'
+
+ImportTime = namedtuple('ImportTime', ['module', 'depth', 'self_us', 'cumulative_us'])
+
+
+def measure_imports(module: str = 'main') -> List[ImportTime]:
+    """
+    imports a module in a new interpreter and parses the import times
+
+    Parameters
+    ----------
+    module : str, optional
+        module to import, by default 'main'
+
+    Returns
+    -------
+    List[ImportTime]
+        import times of all imported modules in the order python reports them
+    """
+    env = dict(os.environ)
+    env.setdefault('ALEXA_SKILL_ID', 'importtime-check')
+    env['CLIENT_STARTUP'] = 'lazy'
+    if COMMON_DIR.exists():
+        # In the container the shared modules are copied next to the skill
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(COMMON_DIR), env.get('PYTHONPATH')]))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=SKILL_DIR, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'importing {module} failed:\n{result.stderr}')
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append(ImportTime(name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+def total_import_ms(import_times: List[ImportTime]) -> float:
+    """
+    sums the import time of the top level imports, which include their nested imports
+
+    Parameters
+    ----------
+    import_times : List[ImportTime]
+        import times returned by measure_imports
+
+    Returns
+    -------
+    float
+        total import time in milliseconds
+    """
+    return sum(entry.cumulative_us for entry in import_times if entry.depth == 0) / 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='main')
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_TIME_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to print')
+    args = parser.parse_args()
+
+    import_times = measure_imports(args.module)
+    total_ms = total_import_ms(import_times)
+    print('slowest top level imports:')
+    top_level = sorted((entry for entry in import_times if entry.depth == 0), key=lambda entry: -entry.cumulative_us)
+    for entry in top_level[:args.top]:
+        print('{:10.1f} ms  {:s}'.format(entry.cumulative_us / 1000, entry.module))
+    print('slowest modules by self time:')
+    for entry in sorted(import_times, key=lambda entry: -entry.self_us)[:args.top]:
+        print('{:10.1f} ms  {:s}'.format(entry.self_us / 1000, entry.module))
+    print('total import time {:.1f} ms, budget {:.1f} ms'.format(total_ms, args.budget_ms))
+    sys.exit(1 if total_ms > args.budget_ms else 0)
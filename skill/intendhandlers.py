@@ -1,5 +1,11 @@
+from typing import Optional
 import datetime
+import hashlib
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 
 import requests
 
@@ -9,11 +15,108 @@ from ask_sdk_model import Response
 from ask_sdk_model.ui import SimpleCard, LinkAccountCard
 from ask_sdk_core.handler_input import HandlerInput
 
-from google.cloud import firestore
+import backends
+import instrumentation
+from kitas import MembershipIndex
+from menucache import MenuDocumentCache
+from speech import WEEKDAYS, USER_NOT_FOUND_FOR_DAY, USER_NOT_FOUND_FOR_WEEK, get_response
+
+
+MENU_CACHE_SIZE = int(os.getenv('MENU_CACHE_SIZE', 256))
+MENU_CACHE_TTL = int(os.getenv('MENU_CACHE_TTL', 10 * 60))
+# Every listener holds a watch stream, so only the documents of this many owners are kept up to date by one
+MENU_CACHE_WATCHED = int(os.getenv('MENU_CACHE_WATCHED', 32))
+# Memberships changed by the webapp are picked up after the TTL
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 1024))
+MEMBERSHIP_CACHE_TTL = int(os.getenv('MEMBERSHIP_CACHE_TTL', 10 * 60))
+
+AMAZON_PROFILE_URL = os.getenv('AMAZON_PROFILE_URL', 'https://api.amazon.com/user/profile')
+# Connect and read timeout in seconds, Alexa gives up after 8 seconds
+AMAZON_PROFILE_TIMEOUT = (1.0, 2.0)
+# Amazon access tokens are valid for one hour at most, so a user id isn't resolved from its token for much longer
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 60 * 60))
+PROFILE_CACHE_SIZE = 1024
+
+# Keep-alive connections to the profile API are reused across requests
+http_session = requests.Session()
+
+_profile_cache = OrderedDict()
+_profile_lock = threading.Lock()
+_menu_cache = None
+_memberships = None
+_clients_lock = threading.Lock()
+
+
+def _create_clients():
+    # The document store client is only created on first use, so importing the handlers stays fast on a cold start
+    global _menu_cache, _memberships
+    with _clients_lock:
+        if _menu_cache is None:
+            db = backends.document_store()
+            _memberships = MembershipIndex(db, max_size=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_CACHE_TTL)
+            _menu_cache = MenuDocumentCache(
+                db, max_size=MENU_CACHE_SIZE, ttl=MENU_CACHE_TTL, max_watched=MENU_CACHE_WATCHED)
+
+def get_menu_cache() -> MenuDocumentCache:
+    """
+    returns the menu document cache shared by all threads
+
+    Returns
+    -------
+    MenuDocumentCache
+        cache of the menu documents
+    """
+    if _menu_cache is None:
+        _create_clients()
+    return _menu_cache
+
+def get_memberships() -> MembershipIndex:
+    """
+    returns the index of the Kita memberships shared by all threads
+
+    Returns
+    -------
+    MembershipIndex
+        cached memberships
+    """
+    if _memberships is None:
+        _create_clients()
+    return _memberships
+
+def get_menu_doc(user_id: str) -> Optional[dict]:
+    """
+    returns the menu document of a user, which is the one of the Kita if the user is member of one
 
+    Parameters
+    ----------
+    user_id : str
+        amazon user id
 
-db = firestore.Client()
+    Returns
+    -------
+    Optional[dict]
+        menu document or None if there is none
+    """
+    return get_menu_cache().get(get_memberships().menu_owner(user_id))
 
+def warm_up():
+    """
+    creates and connects the clients in a background thread, so they are usually ready before the first request
+    without delaying the start of the server
+
+    Returns
+    -------
+    threading.Thread
+        started thread
+    """
+    def run():
+        try:
+            backends.warm_up_document_store(get_menu_cache().db)
+        except Exception as e:
+            logging.exception(e)
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
 
 def get_amazon_user_id(handler_input):
     """
@@ -34,9 +137,35 @@ def get_amazon_user_id(handler_input):
     if account_linking_token is None:
         return None
 
-    r = requests.get('https://api.amazon.com/user/profile', params={'access_token': account_linking_token})
+    # Only a hash of the token is kept in memory, a token is linked to one user for its whole lifetime
+    token_hash = hashlib.sha256(account_linking_token.encode()).hexdigest()
+    with _profile_lock:
+        entry = _profile_cache.get(token_hash)
+        if entry is not None and entry[0] >= time.time():
+            _profile_cache.move_to_end(token_hash)
+            instrumentation.count('profile_cache_hits')
+            return entry[1]
+    instrumentation.count('profile_cache_misses')
+
+    start = time.perf_counter()
+    r = http_session.get(AMAZON_PROFILE_URL, params={'access_token': account_linking_token},
+                         timeout=AMAZON_PROFILE_TIMEOUT)
+    duration = time.perf_counter() - start
+    instrumentation.observe('amazon_profile_request', duration)
+    if r.status_code == 401:
+        # The token expired or has been revoked, so it must not resolve from an entry stored meanwhile either
+        with _profile_lock:
+            _profile_cache.pop(token_hash, None)
+    r.raise_for_status()
     response = r.json()
     user_id = response['user_id']
+    logging.debug('amazon profile lookup took %.3f s', duration)
+
+    with _profile_lock:
+        _profile_cache[token_hash] = (time.time() + PROFILE_CACHE_TTL, user_id)
+        _profile_cache.move_to_end(token_hash)
+        while len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
     return user_id
 
 def generate_account_linking_card(handler_input):
@@ -70,45 +199,38 @@ class FoodForOneDayIntentHandler(AbstractRequestHandler):
 
         day = request_util.get_slot_value(handler_input, 'day')
 
-        weekdays = ('Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag', 'Samstag', 'Sonntag')
-        if day not in weekdays:
+        today = datetime.date.today()
+        if day in WEEKDAYS:
+            # Named weekdays refer to the current week
+            date = today + datetime.timedelta(days=WEEKDAYS.index(day) - today.weekday())
+        else:
             if day is None or day.lower() == 'heute':
-                day = 'heute'
-                weekday_idx = datetime.datetime.today().weekday()
+                day_offset = 0
             elif day.lower() == 'morgen':
-                weekday_idx = datetime.datetime.today().weekday() + 1
+                day_offset = 1
             elif day.lower() == 'übermorgen':
-                weekday_idx = datetime.datetime.today().weekday() + 2
+                day_offset = 2
             elif day.lower() == 'gestern':
-                weekday_idx = datetime.datetime.today().weekday() - 1
+                day_offset = -1
             elif day.lower() == 'vorgestern':
-                weekday_idx = datetime.datetime.today().weekday() - 2
-            
-            day = weekdays[weekday_idx % len(weekdays)]
+                day_offset = -2
+
+            # Relative days may be in the previous or the next week
+            date = today + datetime.timedelta(days=day_offset)
+            day = WEEKDAYS[date.weekday()]
 
         user_id = get_amazon_user_id(handler_input)
         if user_id is None:
             # We got account linking request
             return generate_account_linking_card(handler_input)
 
-        menu_doc_ref = db.collection(u'menus').document(user_id)
-        cur_week = datetime.datetime.now().isocalendar()[1]
-        menu_doc = menu_doc_ref.get().to_dict()
+        menu_doc = get_menu_doc(user_id)
         if menu_doc is None:
             logging.warn('Cannot find user with id %s', user_id)
-            card_title = 'Kita Speiseplan Fehler'
-            speech_text = 'Der angegebener Benutzer wurde leider nicht gefunden.'
-        elif cur_week != menu_doc['cw']:
-            card_title = 'Kein Speiseplan für diese Woche vorhanden'
-            speech_text = 'Leider ist für diese Woche noch kein Speiseplan vorhanden. Lade einen neuen hoch, um ihn '+\
-                'dir Ansagen lassen zu können.'
-        elif day == 'Samstag' or day == 'Sonntag':
-            card_title = 'Wochenede'
-            speech_text = 'Für das Wochenende gibt es keinen Speiseplan.'
+            card_title, speech_text = USER_NOT_FOUND_FOR_DAY
         else:
-            food = menu_doc['menu'][day]
-            card_title = f'Das Essen für heute ist {food}'
-            speech_text = f'{day} gibt es: {food}.'
+            # The responses are precomputed when the menu is written
+            card_title, speech_text = get_response(menu_doc, date, day)
 
         handler_input.response_builder.speak(speech_text).set_card(
             SimpleCard(card_title, speech_text)).set_should_end_session(
@@ -126,22 +248,12 @@ class FoodForWeekIntentHandler(AbstractRequestHandler):
             # We got account linking request
             return generate_account_linking_card(handler_input)
 
-        menu_doc_ref = db.collection(u'menus').document(user_id)
-        cur_week = datetime.datetime.now().isocalendar()[1]
-        menu_doc = menu_doc_ref.get().to_dict()
+        menu_doc = get_menu_doc(user_id)
         if menu_doc is None:
             logging.warn('Cannot find user with id %s', user_id)
-            card_title = 'Kita Speiseplan Fehler'
-            speech_text = 'Der angegebener Benutzer wurde leider nicht gefunden. Loggen Sie sich bitte initial auf '+\
-                'der Website ein.'
-        elif cur_week != menu_doc['cw']:
-            card_title = 'Kein Speiseplan für diese Woche vorhanden'
-            speech_text = 'Leider ist für diese Woche noch kein Speiseplan vorhanden. Lades Sie einen neuen hoch, '+\
-                'um ihn dir Ansagen lassen zu können.'
+            card_title, speech_text = USER_NOT_FOUND_FOR_WEEK
         else:
-            card_title = 'Das Essen für diese Woche'
-            parts = ['Am {:s} gibt es {:s}'.format(day, food) for day, food in menu_doc['menu'].items()]
-            speech_text = '\n'.join(parts)
+            card_title, speech_text = get_response(menu_doc, datetime.date.today())
 
         handler_input.response_builder.speak(speech_text).set_card(
             SimpleCard(card_title, speech_text)).set_should_end_session(
@@ -0,0 +1,597 @@
+"""
+load test of the skill
+
+Starts the skill with gunicorn for every worker and thread configuration and replays Alexa request envelopes of the
+LaunchRequest, FoodForOneDay with every relative day and FoodForWeek with increasing concurrency. Every step reports
+throughput and latency percentiles, the saturation point is the concurrency with the highest throughput before it
+stops growing. The Amazon profile API is replaced by a local stub answering after a fixed latency and the menus are
+read from a seeded sqlite document store, so no network is needed. The envelopes are signed with a certificate created
+for the run and the skill is started by create_app with a verifier trusting it, so the signature and the timestamp of
+every request are verified like in production, e.g.
+
+    python loadtest.py --configs 1x8,2x4 --output loadtest.json
+    python loadtest.py --configs 1x8 --baseline loadtest.json
+
+Exits with a non-zero status if the p99 latency at the SLO concurrency exceeds the budget, or if the saturation
+throughput or the p99 latency of a configuration regressed against the baseline by more than the tolerance, unless
+--report-only is given.
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+import argparse
+import base64
+import datetime
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+from ask_sdk_webservice_support import verifier_constants
+from ask_sdk_webservice_support.verifier import RequestVerifier
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+
+
+# p99 latency in milliseconds the skill has to stay below at the SLO concurrency
+LOAD_TEST_P99_BUDGET_MS = float(os.getenv('LOAD_TEST_P99_BUDGET_MS', 300))
+# Relative regression of throughput or p99 latency against the baseline, which fails the test
+LOAD_TEST_TOLERANCE = float(os.getenv('LOAD_TEST_TOLERANCE', 0.2))
+# The throughput is saturated once doubling the concurrency gains less than this
+SATURATION_GAIN = 0.1
+
+SKILL_DIR = Path(__file__).resolve().parent
+COMMON_DIR = SKILL_DIR.parent / 'common'
+SKILL_ID = 'amzn1.ask.skill.loadtest'
+TOKEN_PREFIX = 'loadtest-token-'
+# Passes the url validation of the verifier, the certificate itself is read from the file of the run
+CERT_CHAIN_URL = 'https://s3.amazonaws.com/echo.api/loadtest.pem'
+
+# Weight, request type or intent and day slot, mostly single days like the real traffic
+REQUEST_MIX = (
+    (10, 'LaunchRequest', None),
+    (20, 'FoodForOneDay', None),
+    (20, 'FoodForOneDay', 'heute'),
+    (20, 'FoodForOneDay', 'morgen'),
+    (5, 'FoodForOneDay', 'übermorgen'),
+    (5, 'FoodForOneDay', 'gestern'),
+    (5, 'FoodForOneDay', 'vorgestern'),
+    (15, 'FoodForWeek', None)
+)
+
+StepResult = namedtuple('StepResult', ['concurrency', 'requests', 'errors', 'throughput', 'p50_ms', 'p99_ms'])
+# Request type or intent, day slot and access token of a request
+RequestSpec = namedtuple('RequestSpec', ['request_type', 'day', 'token'])
+
+
+class LoadTestRequestVerifier(RequestVerifier):
+    """
+    signature verifier trusting the certificate of the load test instead of Alexa's certificate chain. The url, the
+    validity and the domain of the certificate and the signature of every request are verified like Alexa's.
+    """
+
+    def __init__(self, cert_path: str):
+        super().__init__()
+        self._cert_chain = Path(cert_path).read_bytes()
+
+    def _load_cert_chain(self, cert_url):
+        return self._cert_chain
+
+    def _validate_cert_chain(self, cert_chain):
+        # The certificate is self-signed, so it has no chain to a trusted root
+        pass
+
+
+def create_app(cert_path: str):
+    """
+    returns the app of the skill verifying requests signed with the certificate of the load test, gunicorn starts it
+    with loadtest:create_app('<cert path>')
+
+    Parameters
+    ----------
+    cert_path : str
+        path of the PEM encoded certificate
+
+    Returns
+    -------
+    flask.Flask
+        app of the skill
+    """
+    from flask_ask_sdk.skill_adapter import SkillAdapter, VERIFY_SIGNATURE_APP_CONFIG
+    import main
+
+    # The signature verifier of Alexa's certificates is replaced, the timestamps are verified as usual
+    main.app.config[VERIFY_SIGNATURE_APP_CONFIG] = False
+    main.skill_adapter = SkillAdapter(skill=main.sb.create(), skill_id=main.SKILL_ID,
+                                      verifiers=[LoadTestRequestVerifier(cert_path)], app=main.app)
+    return main.app
+
+def create_certificate(cert_path: Path):
+    """
+    creates a self-signed certificate for the domain of Alexa's signing certificate, valid for a day
+
+    Parameters
+    ----------
+    cert_path : Path
+        file to write the PEM encoded certificate to
+
+    Returns
+    -------
+    cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey
+        key to sign the requests with
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, verifier_constants.CERT_CHAIN_DOMAIN)])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(hours=1)).not_valid_after(now + datetime.timedelta(days=1)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(verifier_constants.CERT_CHAIN_DOMAIN)]), False) \
+        .sign(key, hashes.SHA256(), default_backend())
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    return key
+
+def signed_request(spec: RequestSpec, key) -> Tuple[bytes, Dict[str, str]]:
+    """
+    builds and signs the envelope of a request, right before it is sent, so its timestamp is current
+
+    Parameters
+    ----------
+    spec : RequestSpec
+        request to build
+    key : cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey
+        key of the certificate
+
+    Returns
+    -------
+    Tuple[bytes, Dict[str, str]]
+        envelope as JSON and the headers of the request
+    """
+    body = json.dumps(build_envelope(*spec)).encode()
+    signature = key.sign(body, padding.PKCS1v15(), hashes.SHA1())
+    return body, {
+        'Content-Type': 'application/json',
+        verifier_constants.SIGNATURE_CERT_CHAIN_URL_HEADER: CERT_CHAIN_URL,
+        verifier_constants.SIGNATURE_HEADER: base64.b64encode(signature).decode()
+    }
+
+
+def build_envelope(request_type: str, day: Optional[str], token: str) -> dict:
+    """
+    builds the request envelope Alexa sends for an intent of a user with linked account
+
+    Parameters
+    ----------
+    request_type : str
+        'LaunchRequest' or the name of an intent
+    day : Optional[str]
+        value of the day slot of FoodForOneDay, None for a request without slot
+    token : str
+        account linking access token of the user
+
+    Returns
+    -------
+    dict
+        request envelope
+    """
+    request = {
+        'type': 'LaunchRequest',
+        'requestId': 'amzn1.echo-api.request.' + str(uuid.uuid4()),
+        'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'locale': 'de-DE'
+    }
+    if request_type != 'LaunchRequest':
+        slots = {'day': {'name': 'day', 'value': day, 'confirmationStatus': 'NONE'}} if day is not None else {}
+        request['type'] = 'IntentRequest'
+        request['intent'] = {'name': request_type, 'confirmationStatus': 'NONE', 'slots': slots}
+    user = {'userId': 'amzn1.ask.account.' + token, 'accessToken': token}
+    application = {'applicationId': SKILL_ID}
+    return {
+        'version': '1.0',
+        'session': {
+            'new': True,
+            'sessionId': 'amzn1.echo-api.session.' + str(uuid.uuid4()),
+            'application': application,
+            'user': user
+        },
+        'context': {
+            'System': {
+                'application': application,
+                'user': user,
+                'device': {'deviceId': 'amzn1.ask.device.loadtest', 'supportedInterfaces': {}},
+                'apiEndpoint': 'https://api.eu.amazonalexa.com'
+            }
+        },
+        'request': request
+    }
+
+def build_requests(n: int, users: int, seed: int = 0) -> List[RequestSpec]:
+    """
+    draws requests of random users according to REQUEST_MIX
+
+    Parameters
+    ----------
+    n : int
+        number of envelopes
+    users : int
+        number of distinct users
+    seed : int, optional
+        seed of the random generator, by default 0
+
+    Returns
+    -------
+    List[RequestSpec]
+        requests, their envelopes are built when they are sent
+    """
+    rng = random.Random(seed)
+    weights = [weight for weight, _, _ in REQUEST_MIX]
+    specs = []
+    for _ in range(n):
+        _, request_type, day = rng.choices(REQUEST_MIX, weights)[0]
+        specs.append(RequestSpec(request_type, day, TOKEN_PREFIX + str(rng.randrange(users))))
+    return specs
+
+def seed_documents(sqlite_path: Path, users: int):
+    """
+    writes a menu document with precomputed responses for every user of the load test
+
+    Parameters
+    ----------
+    sqlite_path : Path
+        path of the sqlite document store
+    users : int
+        number of users
+    """
+    import backends
+    from menus import week_key
+    from speech import build_responses
+
+    today = datetime.date.today()
+    menu = {'Montag': 'Nudeln', 'Dienstag': 'Reis', 'Mittwoch': 'Suppe', 'Donnerstag': 'Fisch', 'Freitag': 'Pizza'}
+    weeks = {week_key(today): menu}
+    doc = {'cw': today.isocalendar()[1], 'menu': menu, 'weeks': weeks, 'responses': build_responses(weeks)}
+    db = backends.SqliteDocumentStore(sqlite_path)
+    batch = db.batch()
+    for idx in range(users):
+        batch.set(db.collection(u'menus').document('loadtest-user-' + str(idx)), doc)
+    batch.commit()
+
+def serve_profile_stub(port: int, latency: float):
+    """
+    serves a stub of the Amazon profile API, which maps the access tokens of the load test to user ids
+
+    Parameters
+    ----------
+    port : int
+        port to listen on
+    latency : float
+        delay of every response in seconds
+    """
+    class ProfileHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            token = parse_qs(urlparse(self.path).query).get('access_token', [''])[0]
+            time.sleep(latency)
+            body = json.dumps({'user_id': token.replace(TOKEN_PREFIX, 'loadtest-user-')}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingHTTPServer(('127.0.0.1', port), ProfileHandler).serve_forever()
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_skill(workers: int, threads: int, port: int, env: Dict[str, str], cert_path: Path, key,
+                timeout: float = 60) -> subprocess.Popen:
+    """
+    starts the skill with gunicorn and waits until it answers
+
+    Parameters
+    ----------
+    workers : int
+        number of gunicorn worker processes
+    threads : int
+        number of threads per worker
+    port : int
+        port to listen on
+    env : Dict[str, str]
+        environment of the skill
+    cert_path : Path
+        certificate of the load test
+    key : cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey
+        key of the certificate
+    timeout : float, optional
+        seconds to wait for the first answer, by default 60
+
+    Returns
+    -------
+    subprocess.Popen
+        gunicorn process
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+         '--threads', str(threads), '--timeout', '0', 'loadtest:create_app({!r})'.format(str(cert_path))],
+        cwd=SKILL_DIR, env=env)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'the skill exited with status {process.returncode}')
+        body, headers = signed_request(RequestSpec('LaunchRequest', None, TOKEN_PREFIX + '0'), key)
+        try:
+            if requests.post(f'http://127.0.0.1:{port}/', data=body, headers=headers, timeout=1).status_code == 200:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'the skill did not answer within {timeout} s')
+
+def percentile(latencies: List[float], q: float) -> float:
+    if not latencies:
+        return math.nan
+    return latencies[min(len(latencies) - 1, math.ceil(q * len(latencies)) - 1)]
+
+def run_step(url: str, specs: List[RequestSpec], key, concurrency: int, duration: float) -> StepResult:
+    """
+    sends requests from concurrent clients, each one waits for the answer before sending the next request
+
+    Parameters
+    ----------
+    url : str
+        url of the skill
+    specs : List[RequestSpec]
+        requests sent round robin
+    key : cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey
+        key of the certificate the requests are signed with
+    concurrency : int
+        number of clients
+    duration : float
+        duration of the step in seconds
+
+    Returns
+    -------
+    StepResult
+        throughput in requests per second and latency percentiles of the successful requests
+    """
+    sequence = itertools.cycle(specs)
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+
+    def client():
+        client_latencies = []
+        client_errors = 0
+        with requests.Session() as session:
+            while time.perf_counter() < deadline:
+                # Signed outside of the measured latency
+                body, headers = signed_request(next(sequence), key)
+                start = time.perf_counter()
+                try:
+                    ok = session.post(url, data=body, headers=headers, timeout=10).status_code == 200
+                except requests.RequestException:
+                    ok = False
+                if ok:
+                    client_latencies.append(time.perf_counter() - start)
+                else:
+                    client_errors += 1
+        latencies.extend(client_latencies)
+        errors.append(client_errors)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return StepResult(concurrency, len(latencies), sum(errors), len(latencies) / elapsed,
+                      percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+
+def saturation_point(steps: List[StepResult]) -> StepResult:
+    """
+    returns the step from which on more concurrency doesn't increase the throughput significantly anymore
+
+    Parameters
+    ----------
+    steps : List[StepResult]
+        steps with increasing concurrency
+
+    Returns
+    -------
+    StepResult
+        saturated step, the last one if the throughput kept growing
+    """
+    for step, next_step in zip(steps, steps[1:]):
+        if next_step.throughput < step.throughput * (1 + SATURATION_GAIN):
+            return step
+    return steps[-1]
+
+def load_test(workers: int, threads: int, concurrencies: List[int], duration: float, specs: List[RequestSpec],
+              env: Dict[str, str], cert_path: Path, key, p99_budget_ms: float) -> dict:
+    """
+    runs the steps of one gunicorn configuration
+
+    Parameters
+    ----------
+    workers : int
+        number of gunicorn worker processes
+    threads : int
+        number of threads per worker
+    concurrencies : List[int]
+        increasing numbers of concurrent clients
+    duration : float
+        duration of every step in seconds
+    specs : List[RequestSpec]
+        requests to send
+    env : Dict[str, str]
+        environment of the skill
+    cert_path : Path
+        certificate of the load test
+    key : cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey
+        key of the certificate
+    p99_budget_ms : float
+        latency budget, steps stop once the p99 latency exceeds it fourfold
+
+    Returns
+    -------
+    dict
+        'steps' with the results of every step and the 'saturation' step
+    """
+    port = free_port()
+    process = start_skill(workers, threads, port, env, cert_path, key)
+    try:
+        url = f'http://127.0.0.1:{port}/'
+        # Fills the caches of the clients and connections, like on an instance which is already serving
+        run_step(url, specs, key, max(concurrencies), min(duration, 2))
+        steps = []
+        for concurrency in concurrencies:
+            step = run_step(url, specs, key, concurrency, duration)
+            print('{:d}x{:d} concurrency {:4d}: {:8.1f} req/s  p50 {:7.1f} ms  p99 {:7.1f} ms  {:d} errors'.format(
+                workers, threads, concurrency, step.throughput, step.p50_ms, step.p99_ms, step.errors))
+            steps.append(step)
+            if step.p99_ms > 4 * p99_budget_ms:
+                break
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'steps': [step._asdict() for step in steps],
+        'saturation': saturation_point(steps)._asdict()
+    }
+
+def check_slo(results: Dict[str, dict], slo_concurrency: int, p99_budget_ms: float,
+              baseline: Optional[Dict[str, dict]] = None, tolerance: float = LOAD_TEST_TOLERANCE) -> List[str]:
+    """
+    checks the results against the latency budget and the baseline
+
+    Parameters
+    ----------
+    results : Dict[str, dict]
+        results of load_test by configuration, e.g. '1x8'
+    slo_concurrency : int
+        concurrency the latency budget applies to
+    p99_budget_ms : float
+        p99 latency budget in milliseconds
+    baseline : Optional[Dict[str, dict]], optional
+        results of an earlier run, by default None
+    tolerance : float, optional
+        relative regression which is accepted, by default LOAD_TEST_TOLERANCE
+
+    Returns
+    -------
+    List[str]
+        violations, empty if the checks passed
+    """
+    violations = []
+    for config, result in results.items():
+        slo_step = next((step for step in result['steps'] if step['concurrency'] == slo_concurrency), None)
+        if slo_step is None:
+            violations.append(f'{config}: no step with concurrency {slo_concurrency}')
+        elif slo_step['errors'] or not slo_step['p99_ms'] <= p99_budget_ms:
+            violations.append('{:s}: p99 {:.1f} ms with {:d} errors at concurrency {:d}, budget {:.1f} ms'.format(
+                config, slo_step['p99_ms'], slo_step['errors'], slo_concurrency, p99_budget_ms))
+
+        previous = (baseline or {}).get(config)
+        if previous is None:
+            continue
+        throughput, previous_throughput = result['saturation']['throughput'], previous['saturation']['throughput']
+        if throughput < previous_throughput * (1 - tolerance):
+            violations.append('{:s}: saturation throughput {:.1f} req/s, baseline {:.1f} req/s'.format(
+                config, throughput, previous_throughput))
+        previous_step = next((step for step in previous['steps'] if step['concurrency'] == slo_concurrency), None)
+        if slo_step is not None and previous_step is not None \
+                and slo_step['p99_ms'] > previous_step['p99_ms'] * (1 + tolerance):
+            violations.append('{:s}: p99 {:.1f} ms at concurrency {:d}, baseline {:.1f} ms'.format(
+                config, slo_step['p99_ms'], slo_concurrency, previous_step['p99_ms']))
+    return violations
+
+def parse_config(config: str) -> Tuple[int, int]:
+    workers, threads = config.lower().split('x')
+    return int(workers), int(threads)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configs', default='1x8', help='comma separated gunicorn <workers>x<threads> to test')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32', help='comma separated numbers of clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per step')
+    parser.add_argument('--users', type=int, default=10000, help='distinct users, i.e. access tokens')
+    parser.add_argument('--profile-latency-ms', type=float, default=50, help='latency of the profile API stub')
+    parser.add_argument('--slo-concurrency', type=int, default=8)
+    parser.add_argument('--p99-budget-ms', type=float, default=LOAD_TEST_P99_BUDGET_MS)
+    parser.add_argument('--tolerance', type=float, default=LOAD_TEST_TOLERANCE)
+    parser.add_argument('--baseline', type=Path, help='report of an earlier run to compare with')
+    parser.add_argument('--output', type=Path, help='file to write the report to')
+    parser.add_argument('--report-only', action='store_true', help='print SLO violations without failing')
+    args = parser.parse_args()
+
+    concurrencies = sorted(int(value) for value in args.concurrency.split(','))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sqlite_path = Path(tmp_dir) / 'documents.sqlite3'
+        seed_documents(sqlite_path, args.users)
+        cert_path = Path(tmp_dir) / 'loadtest.pem'
+        key = create_certificate(cert_path)
+        profile_port = free_port()
+        profile_stub = multiprocessing.get_context('spawn').Process(
+            target=serve_profile_stub, args=(profile_port, args.profile_latency_ms / 1000), daemon=True)
+        profile_stub.start()
+
+        env = dict(os.environ)
+        env.update({
+            'ALEXA_SKILL_ID': SKILL_ID,
+            'DOCUMENT_STORE_BACKEND': 'sqlite',
+            'SQLITE_PATH': str(sqlite_path),
+            'AMAZON_PROFILE_URL': f'http://127.0.0.1:{profile_port}/user/profile'
+        })
+        if COMMON_DIR.exists():
+            # In the container the shared modules are copied next to the skill
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(COMMON_DIR), env.get('PYTHONPATH')]))
+
+        specs = build_requests(20000, args.users)
+        results = {}
+        try:
+            for config in args.configs.split(','):
+                workers, threads = parse_config(config)
+                results[f'{workers}x{threads}'] = load_test(
+                    workers, threads, concurrencies, args.duration, specs, env, cert_path, key, args.p99_budget_ms)
+        finally:
+            profile_stub.terminate()
+
+    for config, result in results.items():
+        saturation = result['saturation']
+        print('{:s} saturates at concurrency {:d} with {:.1f} req/s, p99 {:.1f} ms'.format(
+            config, saturation['concurrency'], saturation['throughput'], saturation['p99_ms']))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    violations = check_slo(results, args.slo_concurrency, args.p99_budget_ms, baseline, args.tolerance)
+    for violation in violations:
+        print('SLO violation:', violation)
+    sys.exit(1 if violations and not args.report_only else 0)
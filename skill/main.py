@@ -1,20 +1,28 @@
 import os
+import time
+
+# Measured from the start of the import to the end of it as startup stage
+_import_start = time.perf_counter()
 
 from flask import Flask
 from ask_sdk_core.skill_builder import SkillBuilder
 from flask_ask_sdk.skill_adapter import SkillAdapter
 
-try:
-  import googleclouddebugger
-  googleclouddebugger.enable(breakpoint_enable_canary=True)
-except ImportError:
-  pass
+# The debugger delays the start by seconds, so it is only enabled on demand
+if os.getenv('CLOUD_DEBUGGER_ENABLED', '0') == '1':
+  try:
+    import googleclouddebugger
+    googleclouddebugger.enable(breakpoint_enable_canary=True)
+  except ImportError:
+    pass
 
+import instrumentation
 from intendhandlers import *
 
 SKILL_ID = os.environ['ALEXA_SKILL_ID']
 
 app = Flask(__name__)
+instrumentation.add_metrics_endpoint(app)
 
 sb = SkillBuilder()
 
@@ -29,10 +37,17 @@ sb.add_exception_handler(AllExceptionHandler())
 
 skill_adapter = SkillAdapter(skill=sb.create(), skill_id=SKILL_ID, app=app)
 
+# 'lazy' creates the clients on the first request, 'background' right after the start without blocking it
+if os.getenv('CLIENT_STARTUP', 'background') == 'background':
+    warm_up()
+
 @app.route("/", methods=['POST'])
+@instrumentation.timed('skill_request')
 def invoke_skill():
     return skill_adapter.dispatch_request()
 
+instrumentation.observe('startup', time.perf_counter() - _import_start)
+
 if __name__ == '__main__':
     PORT = int(os.getenv('PORT')) if os.getenv('PORT') else 8080
     app.run(host='127.0.0.1', port=PORT, debug=True)
@@ -0,0 +1,142 @@
+"""module with a process local cache of the menu documents"""
+from typing import List, Optional
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+import instrumentation
+
+
+class MenuDocumentCache:
+    """
+    read-through cache of menu documents keyed by the id of their owner, a user or a Kita, bounded in size with LRU and
+    TTL eviction. A document holds the menus of all weeks, so each owner has one entry. Up to max_watched entries are
+    kept up to date by a firestore snapshot listener, whose first snapshot is the read of the miss, the others are
+    only read again after the TTL, as each listener holds a watch stream. Listeners of expired entries are removed with
+    the next miss, and as a listener may miss updates while Cloud Run throttles the CPU, a document is read again after
+    the TTL anyway.
+    """
+
+    def __init__(self, db, max_size: int = 256, ttl: float = 600, watch: bool = True, collection: str = u'menus',
+                 max_watched: int = 32, snapshot_timeout: float = 5):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.watch = watch
+        self.collection = collection
+        self.max_watched = max_watched
+        self.snapshot_timeout = snapshot_timeout
+        self._entries = OrderedDict()
+        # Entries with a listener or one being registered
+        self._watched = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[dict]:
+        """
+        returns the menu document of a user or a Kita
+
+        Parameters
+        ----------
+        user_id : str
+            amazon user id or id of the Kita
+
+        Returns
+        -------
+        Optional[dict]
+            menu document or None if the user has no document
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry['expires_at'] >= time.time():
+                self._entries.move_to_end(user_id)
+                instrumentation.count('menu_document_cache_hits')
+                return entry['doc']
+            evicted = self._evict_expired()
+            watched = self.watch and self._watched < self.max_watched
+            if watched:
+                self._watched += 1
+        self._unsubscribe(evicted)
+        instrumentation.count('menu_document_cache_misses')
+
+        doc_ref = self.db.collection(self.collection).document(user_id)
+        entry = {'expires_at': None, 'doc': None, 'watch': None, 'watched': watched, 'snapshot': threading.Event()}
+        with instrumentation.stage('menu_document_get'):
+            if watched:
+                self._watch(user_id, doc_ref, entry)
+            if entry['watch'] is None:
+                entry['doc'] = doc_ref.get().to_dict()
+        self._store(user_id, entry)
+        return entry['doc']
+
+    def invalidate(self, user_id: str):
+        """
+        removes the cached document of a user
+
+        Parameters
+        ----------
+        user_id : str
+            amazon user id or id of the Kita
+        """
+        with self._lock:
+            entry = self._pop(user_id)
+        self._unsubscribe([entry] if entry is not None else [])
+
+    def _watch(self, key, doc_ref, entry):
+        # The first snapshot of the listener carries the document, so the miss costs one read instead of two
+        watch = None
+        try:
+            watch = doc_ref.on_snapshot(self._on_snapshot_callback(key, entry))
+            if entry['snapshot'].wait(self.snapshot_timeout):
+                entry['watch'] = watch
+            else:
+                logging.warning('no snapshot of the menu document of %s within %s s', key, self.snapshot_timeout)
+        finally:
+            if entry['watch'] is None:
+                # The document is read instead and only cached for the TTL
+                if watch is not None:
+                    watch.unsubscribe()
+                with self._lock:
+                    entry['watched'] = False
+                    self._watched -= 1
+
+    def _store(self, key, entry):
+        entry['expires_at'] = time.time() + self.ttl
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                evicted.append(self._pop(key))
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                evicted.append(self._pop(next(iter(self._entries))))
+        self._unsubscribe(evicted)
+
+    def _pop(self, key) -> Optional[dict]:
+        # Called with the lock held, frees the listener slot of the entry
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry['watched']:
+            self._watched -= 1
+        return entry
+
+    def _evict_expired(self) -> List[dict]:
+        # Called with the lock held, on every miss, so listeners aren't kept until the LRU eviction
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if entry['expires_at'] < now]
+        return [self._pop(key) for key in expired]
+
+    def _on_snapshot_callback(self, key, entry):
+        def on_snapshot(doc_snapshots, changes, read_time):
+            doc = doc_snapshots[0].to_dict() if doc_snapshots and doc_snapshots[0].exists else None
+            with self._lock:
+                # Only the entry the listener has been registered for is updated, evicted entries aren't read anymore
+                entry['doc'] = doc
+            entry['snapshot'].set()
+            logging.debug('updated cached menu document of %s', key)
+        return on_snapshot
+
+    @staticmethod
+    def _unsubscribe(entries):
+        # Called outside of the lock, because stopping a listener waits for its callback thread
+        for entry in entries:
+            if entry['watch'] is not None:
+                entry['watch'].unsubscribe()
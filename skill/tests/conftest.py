@@ -0,0 +1,76 @@
+"""
+setup of the skill tests, which run against a local stub of the Amazon profile API and the sqlite document store
+
+    cd skill && python -m pytest tests
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+import json
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+# In the container the shared modules are copied next to the service
+sys.path[:0] = [str(SERVICE_DIR), str(SERVICE_DIR.parent / 'common')]
+
+# The backends read their configuration on import, so it is set before any test module imports them
+_data_dir = Path(tempfile.mkdtemp(prefix='kita-menu-skill-tests-'))
+os.environ.update({
+    'ALEXA_SKILL_ID': 'amzn1.ask.skill.tests',
+    'DOCUMENT_STORE_BACKEND': 'sqlite',
+    'SQLITE_PATH': str(_data_dir / 'documents.sqlite3'),
+    'CLIENT_STARTUP': 'lazy'
+})
+
+
+class ProfileStub:
+    """
+    stub of the Amazon profile API answering with the user id registered for an access token, unknown tokens are
+    answered with 401 like expired ones
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                token = parse_qs(urlparse(self.path).query).get('access_token', [''])[0]
+                stub.requests.append(token)
+                user_id = stub.users.get(token)
+                body = json.dumps({'user_id': user_id} if user_id else {'error': 'invalid_token'}).encode()
+                self.send_response(200 if user_id else 401)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{:d}/user/profile'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture(scope='session')
+def profile_server():
+    stub = ProfileStub()
+    yield stub
+    stub.server.shutdown()
+
+@pytest.fixture
+def profile_stub(profile_server, monkeypatch):
+    import intendhandlers
+    monkeypatch.setattr(intendhandlers, 'AMAZON_PROFILE_URL', profile_server.url)
+    profile_server.users.clear()
+    profile_server.requests.clear()
+    intendhandlers._profile_cache.clear()
+    return profile_server
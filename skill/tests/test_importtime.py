@@ -0,0 +1,14 @@
+import importtime
+from importtime import ImportTime
+
+
+def test_skill_imports_within_budget():
+    import_times = importtime.measure_imports('main')
+    slowest = sorted((entry for entry in import_times if entry.depth == 0), key=lambda entry: -entry.cumulative_us)
+    assert importtime.total_import_ms(import_times) <= importtime.IMPORT_TIME_BUDGET_MS, slowest[:5]
+
+def test_nested_imports_are_counted_once():
+    # python reports the nested imports before the module importing them
+    import_times = [
+        ImportTime('flask.json', 1, 400, 400), ImportTime('flask', 0, 100, 500), ImportTime('menus', 0, 50, 50)]
+    assert importtime.total_import_ms(import_times) == 0.55
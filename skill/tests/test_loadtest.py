@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+import loadtest
+
+
+@pytest.fixture(scope='module')
+def key_and_client(tmp_path_factory):
+    cert_path = tmp_path_factory.mktemp('loadtest') / 'loadtest.pem'
+    key = loadtest.create_certificate(cert_path)
+    return key, loadtest.create_app(str(cert_path)).test_client()
+
+def launch_request(key):
+    return loadtest.signed_request(loadtest.RequestSpec('LaunchRequest', None, loadtest.TOKEN_PREFIX + '0'), key)
+
+
+def test_signed_request_is_verified(key_and_client):
+    key, client = key_and_client
+    body, headers = launch_request(key)
+    response = client.post('/', data=body, headers=headers)
+    assert response.status_code == 200
+    assert 'response' in json.loads(response.data)
+
+def test_tampered_request_is_rejected(key_and_client):
+    key, client = key_and_client
+    body, headers = launch_request(key)
+    assert client.post('/', data=body.replace(b'de-DE', b'en-US'), headers=headers).status_code == 400
+
+def test_unsigned_request_is_rejected(key_and_client):
+    key, client = key_and_client
+    body, _ = launch_request(key)
+    assert client.post('/', data=body, headers={'Content-Type': 'application/json'}).status_code == 400
+
+def test_stale_request_is_rejected(key_and_client, monkeypatch):
+    key, client = key_and_client
+    envelope = loadtest.build_envelope('LaunchRequest', None, loadtest.TOKEN_PREFIX + '0')
+    envelope['request']['timestamp'] = '2020-03-16T08:00:00Z'
+    monkeypatch.setattr(loadtest, 'build_envelope', lambda *args: envelope)
+    body, headers = launch_request(key)
+    assert client.post('/', data=body, headers=headers).status_code == 400
@@ -0,0 +1,127 @@
+import datetime
+import time
+
+import pytest
+
+import backends
+from menucache import MenuDocumentCache
+from menus import week_key
+
+
+class CountingReference:
+
+    def __init__(self, reference, counts: dict):
+        self.reference = reference
+        self.counts = counts
+
+    def get(self):
+        self.counts['reads'] += 1
+        return self.reference.get()
+
+    def on_snapshot(self, callback):
+        self.counts['listeners'] += 1
+        watch = self.reference.on_snapshot(callback)
+        unsubscribe = watch.unsubscribe
+
+        def counted_unsubscribe():
+            self.counts['listeners'] -= 1
+            unsubscribe()
+        watch.unsubscribe = counted_unsubscribe
+        return watch
+
+
+class CountingStore:
+    """
+    document store counting the reads and the listeners of its documents
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.counts = {'reads': 0, 'listeners': 0}
+
+    def collection(self, name: str):
+        return self
+
+    def document(self, document_id: str) -> CountingReference:
+        return CountingReference(self.db.collection(u'menus').document(document_id), self.counts)
+
+
+@pytest.fixture
+def db():
+    return backends.document_store()
+
+@pytest.fixture
+def store(db):
+    return CountingStore(db)
+
+def menu_doc(food: str) -> dict:
+    today = datetime.date.today()
+    return {'weeks': {
+        week_key(today + datetime.timedelta(weeks=offset)): {'Montag': f'{food} {offset}'} for offset in range(3)
+    }}
+
+
+def test_one_listener_per_owner(db, store, request):
+    user_id = request.node.name
+    db.collection(u'menus').document(user_id).set(menu_doc('Nudeln'))
+    cache = MenuDocumentCache(store)
+    for _ in range(3):
+        assert cache.get(user_id) == menu_doc('Nudeln')
+    # The document is taken from the first snapshot of the listener instead of being read as well
+    assert store.counts == {'reads': 0, 'listeners': 1}
+
+def test_listener_updates_the_document(db, store, request):
+    user_id = request.node.name
+    db.collection(u'menus').document(user_id).set(menu_doc('Nudeln'))
+    cache = MenuDocumentCache(store)
+    cache.get(user_id)
+    db.collection(u'menus').document(user_id).set(menu_doc('Reis'))
+    assert cache.get(user_id) == menu_doc('Reis')
+    assert store.counts['reads'] == 0
+
+def test_expired_listeners_are_removed_on_miss(db, store, request):
+    cache = MenuDocumentCache(store, ttl=0.1)
+    owners = [f'{request.node.name}-{idx}' for idx in range(5)]
+    for user_id in owners:
+        cache.get(user_id)
+    assert store.counts['listeners'] == 5
+    time.sleep(0.2)
+    cache.get(request.node.name + '-new')
+    assert store.counts['listeners'] == 1
+
+def test_invalidate_removes_the_listener(store, request):
+    cache = MenuDocumentCache(store)
+    cache.get(request.node.name)
+    cache.invalidate(request.node.name)
+    assert store.counts['listeners'] == 0
+    cache.get(request.node.name)
+    assert store.counts == {'reads': 0, 'listeners': 1}
+
+def test_size_is_bounded(store, request):
+    cache = MenuDocumentCache(store, max_size=2)
+    for idx in range(4):
+        cache.get(f'{request.node.name}-{idx}')
+    assert store.counts['listeners'] == 2
+
+def test_owners_beyond_max_watched_are_read(db, store, request):
+    cache = MenuDocumentCache(store, max_watched=2)
+    owners = [f'{request.node.name}-{idx}' for idx in range(4)]
+    for user_id in owners:
+        db.collection(u'menus').document(user_id).set(menu_doc('Nudeln'))
+        cache.get(user_id)
+    assert store.counts == {'reads': 2, 'listeners': 2}
+    # Unwatched entries are only cached for the TTL
+    db.collection(u'menus').document(owners[3]).set(menu_doc('Reis'))
+    assert cache.get(owners[3]) == menu_doc('Nudeln')
+    # An evicted listener frees its slot for the next miss
+    cache.invalidate(owners[0])
+    cache.get(request.node.name + '-new')
+    assert store.counts == {'reads': 2, 'listeners': 2}
+
+def test_missing_snapshot_falls_back_to_a_read(store, request, monkeypatch):
+    # The listener never delivers a snapshot, like a watch stream which doesn't connect
+    on_snapshot = CountingReference.on_snapshot
+    monkeypatch.setattr(CountingReference, 'on_snapshot', lambda self, callback: on_snapshot(self, lambda *args: None))
+    cache = MenuDocumentCache(store, snapshot_timeout=0.05)
+    assert cache.get(request.node.name) is None
+    assert store.counts == {'reads': 1, 'listeners': 0}
@@ -0,0 +1,92 @@
+import base64
+import datetime
+import json
+import time
+
+import pytest
+import requests
+from ask_sdk_core.handler_input import HandlerInput
+from ask_sdk_core.serialize import DefaultSerializer
+from ask_sdk_model import RequestEnvelope
+
+import intendhandlers
+from menus import week_key
+from speech import build_responses
+
+
+def jwt(claims: dict) -> str:
+    def encode(part: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip('=')
+    return '{:s}.{:s}.signature'.format(encode({'alg': 'RS256'}), encode(claims))
+
+def handler_input(intent: str, token: str = None, api_expiry: float = None) -> HandlerInput:
+    user = {'userId': 'amzn1.ask.account.test'}
+    if token is not None:
+        user['accessToken'] = token
+    system = {'application': {'applicationId': 'amzn1.ask.skill.tests'}, 'user': user}
+    if api_expiry is not None:
+        system['apiAccessToken'] = jwt({'exp': api_expiry})
+    envelope = {
+        'version': '1.0',
+        'context': {'System': system},
+        'request': {
+            'type': 'IntentRequest',
+            'requestId': 'amzn1.echo-api.request.test',
+            'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'locale': 'de-DE',
+            'intent': {'name': intent, 'confirmationStatus': 'NONE', 'slots': {}}
+        }
+    }
+    return HandlerInput(request_envelope=DefaultSerializer().deserialize(json.dumps(envelope), RequestEnvelope))
+
+
+def test_user_id_is_looked_up_once(profile_stub):
+    profile_stub.users['token-a'] = 'amzn1.account.a'
+    for _ in range(3):
+        assert intendhandlers.get_amazon_user_id(handler_input('FoodForWeek', 'token-a')) == 'amzn1.account.a'
+    assert profile_stub.requests == ['token-a']
+
+def test_missing_token_asks_for_account_linking(profile_stub):
+    assert intendhandlers.get_amazon_user_id(handler_input('FoodForWeek')) is None
+    assert profile_stub.requests == []
+
+def test_rejected_token_is_not_cached(profile_stub):
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            intendhandlers.get_amazon_user_id(handler_input('FoodForWeek', 'expired-token'))
+    assert profile_stub.requests == ['expired-token', 'expired-token']
+
+def test_entry_outlives_the_api_access_token(profile_stub):
+    profile_stub.users['token-b'] = 'amzn1.account.b'
+    # The apiAccessToken of a request only lives for minutes, it has nothing to do with the account linking token
+    for _ in range(2):
+        intendhandlers.get_amazon_user_id(handler_input('FoodForWeek', 'token-b', api_expiry=time.time() - 1))
+    assert profile_stub.requests == ['token-b']
+
+def test_rejected_token_evicts_its_entry(profile_stub, monkeypatch):
+    monkeypatch.setattr(intendhandlers, 'PROFILE_CACHE_TTL', -1)
+    profile_stub.users['token-e'] = 'amzn1.account.e'
+    assert intendhandlers.get_amazon_user_id(handler_input('FoodForWeek', 'token-e')) == 'amzn1.account.e'
+    # Revoked after the entry expired
+    del profile_stub.users['token-e']
+    with pytest.raises(requests.HTTPError):
+        intendhandlers.get_amazon_user_id(handler_input('FoodForWeek', 'token-e'))
+    assert not intendhandlers._profile_cache
+
+def test_entry_is_bounded_by_the_fixed_ttl(profile_stub, monkeypatch):
+    monkeypatch.setattr(intendhandlers, 'PROFILE_CACHE_TTL', -1)
+    profile_stub.users['token-c'] = 'amzn1.account.c'
+    for _ in range(2):
+        intendhandlers.get_amazon_user_id(handler_input('FoodForWeek', 'token-c'))
+    assert len(profile_stub.requests) == 2
+
+def test_food_for_week_speaks_the_menu_of_the_user(profile_stub):
+    profile_stub.users['token-d'] = 'amzn1.account.d'
+    menu = {'Montag': 'Nudeln', 'Dienstag': 'Reis', 'Mittwoch': 'Suppe', 'Donnerstag': 'Fisch', 'Freitag': 'Pizza'}
+    weeks = {week_key(datetime.date.today()): menu}
+    intendhandlers.get_menu_cache().db.collection(u'menus').document('amzn1.account.d').set(
+        {'cw': datetime.date.today().isocalendar()[1], 'menu': menu, 'weeks': weeks,
+         'responses': build_responses(weeks)})
+
+    response = intendhandlers.FoodForWeekIntentHandler().handle(handler_input('FoodForWeek', 'token-d'))
+    assert 'Am Montag gibt es Nudeln' in response.output_speech.ssml
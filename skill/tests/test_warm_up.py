@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+import pytest
+
+import backends
+import intendhandlers
+
+
+class FakeFirestore:
+    """
+    Firestore client recording the documents read through its public api
+    """
+
+    def __init__(self):
+        self.reads = []
+
+    def collection(self, collection: str):
+        return SimpleNamespace(document=lambda document_id: SimpleNamespace(
+            get=lambda: self.reads.append((collection, document_id)) or SimpleNamespace(exists=False)))
+
+
+def test_warm_up_reads_the_warm_up_document(monkeypatch):
+    db = FakeFirestore()
+    monkeypatch.setattr(intendhandlers, '_menu_cache', SimpleNamespace(db=db))
+    intendhandlers.warm_up().join(10)
+    assert db.reads == [(backends.WARM_UP_COLLECTION, backends.WARM_UP_DOCUMENT)]
+
+def test_warm_up_of_sqlite_reads_nothing(monkeypatch):
+    db = backends.document_store()
+    monkeypatch.setattr(db, 'collection', lambda name: pytest.fail('read ' + name))
+    backends.warm_up_document_store(db)
@@ -1,16 +1,24 @@
 import base64
+import io
 import os
 import json
 import logging
-import datetime
 import functools
+import queue
+import threading
+import time
 
-from flask import Flask, request, session, render_template, url_for, redirect, flash
+from flask import Flask, Request, Response, request, session, render_template, url_for, redirect, flash, make_response, \
+    stream_with_context
 from authlib.integrations.flask_client import OAuth
 
-from google.cloud import firestore, storage
 import google.auth.credentials
 
+import backends
+import instrumentation
+from kitas import MembershipIndex, create_kita, join_kita, leave_kita
+from menustate import TERMINAL_STATES, MenuStateCache
+
 try:
   import googleclouddebugger
   googleclouddebugger.enable(breakpoint_enable_canary=True)
@@ -19,13 +27,82 @@ except ImportError:
 
 
 BUCKET_NAME = 'kita-menu-images'
+# Larger uploads are rejected with 413 before anything is sent to Cloud Storage
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 10 * 1024 * 1024))
+# Chunk size of the resumable upload, has to be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Seconds after which a progress event stream is closed, the browser reconnects automatically
+EVENT_STREAM_TIMEOUT = int(os.environ.get('EVENT_STREAM_TIMEOUT', 5 * 60))
+EVENT_KEEPALIVE_INTERVAL = 15
+# Every event stream holds one of the gunicorn threads, further streams are refused and the page polls /menu instead
+MAX_EVENT_STREAMS = int(os.environ.get('MAX_EVENT_STREAMS', 4))
+
+
+class UploadStream:
+    """
+    file of a multipart request, which is streamed into a blob while the form is parsed. The upload is finished by the
+    view, an upload which it didn't finish is aborted when the request is closed.
+    """
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.done = False
+
+    def write(self, data: bytes) -> int:
+        return self.upload.write(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # The form parser rewinds the file after writing it, its data is already on its way to the blob though
+        return 0
+
+    def finish(self):
+        self.upload.finish()
+        self.done = True
+
+    def close(self):
+        if not self.done:
+            self.upload.abort()
+            self.done = True
+
+
+class StreamingUploadRequest(Request):
+    """
+    request which streams uploaded menus into their blob while the multipart body is read
+
+    The view is only called after the form parser has read the whole body, so the file would otherwise be held in
+    memory or spooled to disk until then. Its blob is known before though, the owner comes from the session and the
+    extension from the filename. So every UPLOAD_CHUNK_SIZE bytes are sent with a resumable upload as soon as they have
+    arrived, a request holds at most one chunk. Other files are kept in memory, MAX_CONTENT_LENGTH bounds them.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'upload' and 'user_id' in session and filename and allowed_file(filename):
+            blob = menu_blob(memberships.menu_owner(session['user_id']), filename)
+            return UploadStream(backends.start_upload(blob, content_type))
+        return io.BytesIO()
 
 
 app = Flask(__name__)
+app.request_class = StreamingUploadRequest
 app.secret_key = os.environ.get('SECRET_KEY')
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
+instrumentation.add_metrics_endpoint(app)
 oauth = OAuth(app)
 
-db = firestore.Client()
+db = backends.document_store()
+memberships = MembershipIndex(
+    db,
+    max_size=int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('MEMBERSHIP_CACHE_TTL', 10 * 60))
+)
+menu_states = MenuStateCache(
+    db,
+    max_size=int(os.environ.get('MENU_STATE_CACHE_SIZE', 256)),
+    ttl=int(os.environ.get('MENU_STATE_CACHE_TTL', 10 * 60))
+)
+# The cloud storage client honours STORAGE_EMULATOR_HOST, so it can be pointed at a local fake GCS server
+storage_client = backends.storage_client()
+event_streams = threading.BoundedSemaphore(MAX_EVENT_STREAMS)
 
 oauth.register(
     name='amazon',
@@ -72,30 +149,68 @@ def login_required(func: callable) -> callable:
 
 @app.route('/', methods=['GET'])
 @login_required
+@instrumentation.timed('webapp_index')
 def index():
-    menu_doc_ref = db.collection(u'menus').document(session['user_id'])
-    menu_doc = menu_doc_ref.get().to_dict()
-    if menu_doc is None:
-        menu_doc_ref.create({'cw': datetime.datetime.now().isocalendar()[1], 'menu': {}})
-
-    
-    progress_doc_ref = db.collection(u'progress').document(session['user_id'])
-    progress_doc = progress_doc_ref.get().to_dict()
-    progress = None
-    if progress_doc is not None:
-        progress = progress_doc['state']
+    membership = memberships.get(session['user_id'])
+    with instrumentation.stage('menu_state_get'):
+        state = menu_states.get(membership.kita_id if membership is not None else session['user_id'])
+    return render_template('index.html', menu=state.menu, progress=state.progress, kita=membership)
 
-    # Keep order of days
-    days = (
-        'Montag',
-        'Dienstag',
-        'Mittwoch',
-        'Donnerstag',
-        'Freitag'
-    )
-    menu = [(day, menu_doc['menu'][day]) for day in days]
 
-    return render_template('index.html', menu=menu, progress=progress)
+@app.route('/menu', methods=['GET'])
+@login_required
+def menu_fragment():
+    # The state is kept up to date by snapshot listeners, so an unchanged menu is answered without a document read
+    state = menu_states.get(memberships.menu_owner(session['user_id']))
+    if state.etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = make_response(render_template('_menu.html', menu=state.menu, progress=state.progress))
+    response.set_etag(state.etag)
+    # Browsers have to revalidate, the etag changes with every new menu or progress
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/events', methods=['GET'])
+@login_required
+def events():
+    owner_id = memberships.menu_owner(session['user_id'])
+    # EventSource doesn't reconnect after an error status, the page falls back to polling /menu
+    if not event_streams.acquire(blocking=False):
+        return ('', 503)
+
+    def stream():
+        subscriber, state = menu_states.subscribe(owner_id)
+        try:
+            deadline = time.monotonic() + EVENT_STREAM_TIMEOUT
+            while True:
+                yield 'event: menu\ndata: {:s}\n\n'.format(json.dumps({
+                    'progress': state.progress,
+                    'etag': state.etag,
+                    'html': render_template('_menu.html', menu=state.menu, progress=state.progress)
+                }))
+                # Each stream holds a server thread, so it ends with the processing, the browser reconnects otherwise
+                if state.progress in TERMINAL_STATES:
+                    return
+                state = None
+                while state is None:
+                    if time.monotonic() >= deadline:
+                        return
+                    try:
+                        state = subscriber.get(timeout=EVENT_KEEPALIVE_INTERVAL)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+        finally:
+            menu_states.unsubscribe(owner_id, subscriber)
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    # Also called if the client disconnects before the stream has started
+    response.call_on_close(event_streams.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Disable buffering of reverse proxies
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/login', methods=['GET'])
@@ -134,6 +249,11 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS
 
+def menu_blob(owner_id: str, filename: str):
+    # The recognizer names the menu after the blob, so there is one blob per owner and extension
+    file_ext = filename.rsplit('.', 1)[-1].lower()
+    return storage_client.bucket(BUCKET_NAME).blob('{:s}.{:s}'.format(owner_id, file_ext), chunk_size=UPLOAD_CHUNK_SIZE)
+
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
@@ -152,21 +272,52 @@ def upload():
             return redirect(request.url)
 
         if file and allowed_file(file.filename):
+            # Members upload the menu of their Kita, which is recognized once for all of them
+            owner_id = memberships.menu_owner(session['user_id'])
+
             # Set progress to processing
-            doc_ref = db.collection(u'progress').document(session['user_id'])
+            doc_ref = db.collection(u'progress').document(owner_id)
             doc_ref.set({'state': 'upload'})
 
-            file_ext = file.filename.rsplit('.', 1)[-1].lower()
-            file.save('tmp.{:s}'.format(file_ext))
-            client = storage.Client()
-            bucket = client.bucket(BUCKET_NAME)
-            blob = bucket.blob('{:s}.{:s}'.format(session['user_id'], file_ext))
-            blob.upload_from_filename('tmp.{:s}'.format(file_ext))
+            # The file has been streamed into the blob of the owner while the form was read, finishing the upload
+            # creates the blob, whose notification starts the recognition
+            with instrumentation.stage('upload'):
+                file.stream.finish()
 
             return redirect(https_url_for('index'))
     return redirect(https_url_for('index'))
     
 
+
+@app.route('/kita', methods=['POST'])
+@login_required
+def kita_create():
+    name = request.form.get('name', '').strip()
+    if not name:
+        flash('Bitte gib den Namen der Kita an.')
+        return redirect(https_url_for('index'))
+    create_kita(db, name, session['user_id'])
+    memberships.invalidate(session['user_id'])
+    return redirect(https_url_for('index'))
+
+
+@app.route('/kita/join', methods=['POST'])
+@login_required
+def kita_join():
+    if join_kita(db, request.form.get('kita_id', '').strip(), session['user_id']) is None:
+        flash('Die Kita wurde nicht gefunden.')
+    memberships.invalidate(session['user_id'])
+    return redirect(https_url_for('index'))
+
+
+@app.route('/kita/leave', methods=['POST'])
+@login_required
+def kita_leave():
+    leave_kita(db, session['user_id'])
+    memberships.invalidate(session['user_id'])
+    return redirect(https_url_for('index'))
+
+
 if __name__ == '__main__':
     PORT = int(os.getenv('PORT')) if os.getenv('PORT') else 8080
     app.run(host='127.0.0.1', port=PORT, debug=True)
@@ -0,0 +1,198 @@
+"""module with the per user state of the start page, kept up to date by snapshot listeners"""
+from typing import List, Optional, Tuple
+from collections import OrderedDict, namedtuple
+import datetime
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+
+from menus import get_week_menu
+
+
+# Keep order of days
+DAYS = (
+    'Montag',
+    'Dienstag',
+    'Mittwoch',
+    'Donnerstag',
+    'Freitag'
+)
+
+# Progress states after which the state only changes with a new upload
+TERMINAL_STATES = ('complete', 'failed')
+
+MenuState = namedtuple('MenuState', ['progress', 'menu', 'etag'])
+
+
+def menu_state(progress_doc: Optional[dict], menu_doc: Optional[dict]) -> MenuState:
+    """
+    derives the state of the start page from the documents of a user
+
+    Parameters
+    ----------
+    progress_doc : Optional[dict]
+        progress document
+    menu_doc : Optional[dict]
+        menu document
+
+    Returns
+    -------
+    MenuState
+        progress state, menu of the current week as list of day and food and an etag of both
+    """
+    progress = progress_doc['state'] if progress_doc is not None else None
+    week_menu = (get_week_menu(menu_doc, datetime.date.today()) if menu_doc is not None else None) or {}
+    menu = [(day, week_menu.get(day, '')) for day in DAYS]
+    # The week is part of the etag, so a cached page of the last week isn't valid anymore
+    year, week = datetime.date.today().isocalendar()[:2]
+    etag = hashlib.sha1(json.dumps([progress, menu, year, week]).encode()).hexdigest()
+    return MenuState(progress, menu, etag)
+
+
+class MenuStateCache:
+    """
+    cache of the start page state per user, bounded in size with LRU and TTL eviction. The progress and menu documents
+    of cached users are watched by snapshot listeners, which update the state and publish it to the subscribers of the
+    user, so unchanged pages are answered without reading a document. Users with subscribers aren't evicted.
+    """
+
+    def __init__(self, db, max_size: int = 256, ttl: float = 600):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> MenuState:
+        """
+        returns the state of a user, the menu document is created if the user has none
+
+        Parameters
+        ----------
+        user_id : str
+            amazon user id
+
+        Returns
+        -------
+        MenuState
+            state of the start page
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and (entry['subscribers'] or entry['expires_at'] >= time.time()):
+                entry['expires_at'] = time.time() + self.ttl
+                self._entries.move_to_end(user_id)
+                # Derived on every call, because the current week changes while the documents don't
+                return menu_state(entry['docs']['progress'], entry['docs']['menus'])
+        return self._load(user_id)['state']
+
+    def subscribe(self, user_id: str) -> Tuple[queue.Queue, MenuState]:
+        """
+        subscribes to the state changes of a user
+
+        Parameters
+        ----------
+        user_id : str
+            amazon user id
+
+        Returns
+        -------
+        Tuple[queue.Queue, MenuState]
+            queue receiving every new state and the current state
+        """
+        subscriber = queue.Queue()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry['subscribers'].add(subscriber)
+                return subscriber, menu_state(entry['docs']['progress'], entry['docs']['menus'])
+        entry = self._load(user_id)
+        with self._lock:
+            entry['subscribers'].add(subscriber)
+            return subscriber, entry['state']
+
+    def unsubscribe(self, user_id: str, subscriber: queue.Queue):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry['subscribers'].discard(subscriber)
+                entry['expires_at'] = time.time() + self.ttl
+
+    def _load(self, user_id: str) -> dict:
+        progress_doc_ref = self.db.collection(u'progress').document(user_id)
+        menu_doc_ref = self.db.collection(u'menus').document(user_id)
+        menu_doc = menu_doc_ref.get().to_dict()
+        if menu_doc is None:
+            menu_doc = {'cw': datetime.datetime.now().isocalendar()[1], 'menu': {}, 'weeks': {}}
+            menu_doc_ref.create(menu_doc)
+        docs = {'progress': progress_doc_ref.get().to_dict(), 'menus': menu_doc}
+        entry = {
+            'expires_at': time.time() + self.ttl,
+            'docs': docs,
+            'state': menu_state(docs['progress'], docs['menus']),
+            'subscribers': set(),
+            'watches': []
+        }
+
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(user_id, None)
+            if previous is not None:
+                # Keep the subscribers of a concurrently loaded entry
+                entry['subscribers'] = previous['subscribers']
+                evicted.append(previous)
+            self._entries[user_id] = entry
+            evicted.extend(self._evict())
+        self._unsubscribe(evicted)
+
+        watches = [
+            doc_ref.on_snapshot(self._on_snapshot_callback(user_id, entry, name))
+            for name, doc_ref in (('progress', progress_doc_ref), ('menus', menu_doc_ref))
+        ]
+        with self._lock:
+            still_cached = self._entries.get(user_id) is entry
+            if still_cached:
+                entry['watches'] = watches
+        if not still_cached:
+            for watch in watches:
+                watch.unsubscribe()
+        return entry
+
+    def _evict(self) -> List[dict]:
+        # Called with the lock held, users with subscribers are kept
+        evicted = []
+        now = time.time()
+        for user_id in list(self._entries):
+            if len(self._entries) - len(evicted) <= self.max_size and self._entries[user_id]['expires_at'] >= now:
+                continue
+            if not self._entries[user_id]['subscribers']:
+                evicted.append(user_id)
+        return [self._entries.pop(user_id) for user_id in evicted]
+
+    def _on_snapshot_callback(self, user_id: str, entry: dict, name: str):
+        def on_snapshot(doc_snapshots, changes, read_time):
+            doc = doc_snapshots[0].to_dict() if doc_snapshots and doc_snapshots[0].exists else None
+            with self._lock:
+                # Only update the entry the listener has been registered for
+                if self._entries.get(user_id) is not entry:
+                    return
+                entry['docs'][name] = doc
+                state = menu_state(entry['docs']['progress'], entry['docs']['menus'])
+                changed = state.etag != entry['state'].etag
+                entry['state'] = state
+                subscribers = list(entry['subscribers'])
+            if changed:
+                logging.debug('publishing new state of %s to %d subscribers', user_id, len(subscribers))
+                for subscriber in subscribers:
+                    subscriber.put(state)
+        return on_snapshot
+
+    @staticmethod
+    def _unsubscribe(entries: List[dict]):
+        # Called outside of the lock, because stopping a listener waits for its callback thread
+        for entry in entries:
+            for watch in entry['watches']:
+                watch.unsubscribe()
@@ -0,0 +1,46 @@
+"""
+setup of the webapp tests, which run against the local storage and the sqlite document store backend
+
+    cd webapp && python -m pytest tests
+"""
+from pathlib import Path
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+# In the container the shared modules are copied next to the service
+sys.path[:0] = [str(SERVICE_DIR), str(SERVICE_DIR.parent / 'common')]
+
+# The backends read their configuration on import, so it is set before any test module imports them
+_data_dir = Path(tempfile.mkdtemp(prefix='kita-menu-webapp-tests-'))
+os.environ.update({
+    'STORAGE_BACKEND': 'local',
+    'LOCAL_STORAGE_DIR': str(_data_dir / 'storage'),
+    'DOCUMENT_STORE_BACKEND': 'sqlite',
+    'SQLITE_PATH': str(_data_dir / 'documents.sqlite3'),
+    'SECRET_KEY': 'webapp-tests'
+})
+os.environ.pop('LOCAL_NOTIFICATION_URL', None)
+
+
+def login(client, user_id: str):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['name'] = user_id
+
+
+@pytest.fixture
+def app():
+    import main
+    main.app.config['TESTING'] = True
+    return main.app
+
+@pytest.fixture
+def client(app):
+    with app.test_client() as client:
+        login(client, 'amzn1.account.webapp-test')
+        yield client
@@ -0,0 +1,69 @@
+import json
+import threading
+
+import pytest
+
+import main
+from conftest import login
+
+
+def set_progress(user_id: str, state: str):
+    main.db.collection(u'progress').document(user_id).set({'state': state})
+
+def menu_events(response) -> list:
+    return [
+        json.loads(line[len('data: '):])
+        for line in response.get_data(as_text=True).splitlines() if line.startswith('data: ')
+    ]
+
+@pytest.fixture
+def user(client, request):
+    # Separate users, so the cached states of the tests don't interfere
+    user_id = 'amzn1.account.' + request.node.name
+    login(client, user_id)
+    return user_id
+
+
+@pytest.mark.parametrize('progress', ['complete', 'failed'])
+def test_stream_ends_in_terminal_state(client, user, progress):
+    set_progress(user, progress)
+    events = menu_events(client.get('/events'))
+    assert [event['progress'] for event in events] == [progress]
+
+def test_stream_publishes_the_failure(client, user):
+    set_progress(user, 'processing')
+    # The listener is registered when the stream starts, the failure is written afterwards
+    timer = threading.Timer(0.5, set_progress, (user, 'failed'))
+    timer.start()
+    events = menu_events(client.get('/events'))
+    timer.join()
+    assert [event['progress'] for event in events] == ['processing', 'failed']
+    assert 'nicht erkannt' in events[-1]['html']
+
+def test_streams_are_capped(client, user, monkeypatch):
+    monkeypatch.setattr(main, 'event_streams', threading.BoundedSemaphore(1))
+    set_progress(user, 'processing')
+    first = client.get('/events', buffered=False)
+    assert first.status_code == 200
+    assert client.get('/events').status_code == 503
+    first.close()
+    set_progress(user, 'complete')
+    assert client.get('/events').status_code == 200
+
+def test_menu_fragment_is_revalidated(client, user):
+    set_progress(user, 'processing')
+    response = client.get('/menu')
+    assert response.status_code == 200
+    assert 'data-progress="processing"' in response.get_data(as_text=True)
+    assert client.get('/menu', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    set_progress(user, 'failed')
+    changed = client.get('/menu', headers={'If-None-Match': response.headers['ETag']})
+    assert changed.status_code == 200
+    assert 'data-progress="failed"' in changed.get_data(as_text=True)
+
+def test_index_polls_the_menu_fragment(client, user):
+    set_progress(user, 'failed')
+    page = client.get('/').get_data(as_text=True)
+    assert 'nicht erkannt' in page
+    assert "fetch(\"/menu\"" in page
@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import threading
+
+import pytest
+import werkzeug.formparser
+
+import main
+from conftest import login
+
+
+class FakeUploadSession(BaseHTTPRequestHandler):
+    # Resumable upload session of cloud storage, which persists every chunk and creates the object with the last one
+
+    def do_PUT(self):
+        chunk = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(('PUT', self.headers['Content-Range'], len(chunk)))
+        self.server.data += chunk
+        if self.headers['Content-Range'].endswith('/*'):
+            self.send_response(308)
+            self.send_header('Range', f'bytes=0-{len(self.server.data) - 1}')
+        else:
+            self.server.finished = True
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_DELETE(self):
+        self.server.requests.append(('DELETE', None, 0))
+        self.send_response(499)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class StubBlob:
+    # Blob of google-cloud-storage, whose resumable session is served by the fake
+
+    def __init__(self, name, chunk_size, session_url, sessions):
+        self.name = name
+        self.chunk_size = chunk_size
+        self._session_url = session_url
+        self._sessions = sessions
+
+    def create_resumable_upload_session(self, content_type=None, size=None):
+        self._sessions.append((self.name, self.chunk_size, content_type))
+        return self._session_url
+
+class StubStorageClient:
+
+    def __init__(self, session_url):
+        self.session_url = session_url
+        self.sessions = []
+
+    def bucket(self, name):
+        return type('StubBucket', (), {
+            'blob': lambda _, blob_name, chunk_size=None: StubBlob(blob_name, chunk_size, self.session_url,
+                                                                   self.sessions)
+        })()
+
+
+def post_file(client, data: bytes, filename: str = 'menu.jpg'):
+    return client.post('/upload', data={'file': (io.BytesIO(data), filename)}, content_type='multipart/form-data')
+
+def stored_blob(name: str):
+    return main.storage_client.bucket(main.BUCKET_NAME).get_blob(name)
+
+
+@pytest.fixture
+def upload_session(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeUploadSession)
+    server.requests, server.data, server.finished = [], b'', False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    storage_client = StubStorageClient(f'http://127.0.0.1:{server.server_port}/upload?upload_id=test')
+    monkeypatch.setattr(main, 'storage_client', storage_client)
+    yield server, storage_client.sessions
+    server.shutdown()
+    server.server_close()
+
+
+def test_upload_is_stored_under_the_user(client):
+    data = os.urandom(3 * main.UPLOAD_CHUNK_SIZE + 123)
+    response = post_file(client, data, 'Speiseplan.JPG')
+    assert response.status_code == 302
+    assert stored_blob('amzn1.account.webapp-test.jpg').download_as_bytes() == data
+    progress = main.db.collection(u'progress').document('amzn1.account.webapp-test').get().to_dict()
+    assert progress == {'state': 'upload'}
+
+def test_upload_is_not_spooled_to_disk(client, monkeypatch):
+    def no_disk(*args, **kwargs):
+        raise AssertionError('the upload has been spooled to a temporary file')
+    # Werkzeug spools files larger than 500 KiB to a temporary file by default
+    monkeypatch.setattr(werkzeug.formparser, 'SpooledTemporaryFile', no_disk)
+    data = os.urandom(2 * 1024 * 1024)
+    assert post_file(client, data).status_code == 302
+    assert stored_blob('amzn1.account.webapp-test.jpg').download_as_bytes() == data
+
+def test_oversized_upload_is_rejected(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    response = post_file(client, os.urandom(4096), 'too-large.png')
+    assert response.status_code == 413
+    assert stored_blob('amzn1.account.webapp-test.png') is None
+
+def test_disallowed_extension_is_not_uploaded(client):
+    post_file(client, b'#!/bin/sh', 'menu.sh')
+    assert stored_blob('amzn1.account.webapp-test.sh') is None
+
+def test_concurrent_uploads_are_kept_apart(app):
+    uploads = {f'amzn1.account.concurrent-{idx}': os.urandom(512 * 1024 + idx) for idx in range(8)}
+
+    def upload(user_id):
+        with app.test_client() as client:
+            login(client, user_id)
+            return post_file(client, uploads[user_id], 'menu.pdf').status_code
+
+    with ThreadPoolExecutor(8) as executor:
+        assert set(executor.map(upload, uploads)) == {302}
+    for user_id, data in uploads.items():
+        assert stored_blob(f'{user_id}.pdf').download_as_bytes() == data
+
+def test_upload_is_streamed_to_cloud_storage_in_chunks(client, upload_session):
+    server, sessions = upload_session
+    size = 2 * main.UPLOAD_CHUNK_SIZE + 123
+    data = os.urandom(size)
+    response = client.post('/upload', data={'file': (io.BytesIO(data), 'Speiseplan.JPG', 'image/jpeg')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert sessions == [('amzn1.account.webapp-test.jpg', main.UPLOAD_CHUNK_SIZE, 'image/jpeg')]
+    chunk = main.UPLOAD_CHUNK_SIZE
+    assert server.requests == [
+        ('PUT', f'bytes 0-{chunk - 1}/*', chunk),
+        ('PUT', f'bytes {chunk}-{2 * chunk - 1}/*', chunk),
+        ('PUT', f'bytes {2 * chunk}-{size - 1}/{size}', 123)
+    ]
+    assert server.finished and server.data == data
+
+def test_unfinished_upload_is_aborted(app, upload_session):
+    server, sessions = upload_session
+    # The request is closed once the client leaves the request context
+    with app.test_client() as client:
+        login(client, 'amzn1.account.webapp-test')
+        # The view only finishes the upload of the file field
+        response = client.post('/upload', data={'other': (io.BytesIO(b'menu'), 'menu.png', 'image/png')},
+                               content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert len(sessions) == 1
+    assert server.requests == [('DELETE', None, 0)]
+    assert not server.finished
+
+def test_unfinished_local_upload_leaves_nothing_behind(app):
+    with app.test_client() as client:
+        login(client, 'amzn1.account.webapp-test')
+        client.post('/upload', data={'other': (io.BytesIO(b'menu'), 'menu.gif')}, content_type='multipart/form-data')
+    bucket = main.storage_client.bucket(main.BUCKET_NAME)
+    assert bucket.get_blob('amzn1.account.webapp-test.gif') is None
+    assert not list(bucket.path.glob('*.part'))